@@ -11,6 +11,7 @@ from django.utils.timezone import utc as timezone_utc
 
 from analytics.lib.counts import COUNT_STATS, logger, process_count_stat
 from scripts.lib.zulip_tools import ENDC, WARNING
+from zerver.lib.actions import update_realm_streams_traffic_caches
 from zerver.lib.timestamp import floor_to_hour
 from zerver.models import Realm
 
@@ -80,6 +81,9 @@ class Command(BaseCommand):
                 print("Updated %s in %.3fs" % (stat.property, time.time() - last))
                 last = time.time()
 
+        if COUNT_STATS['messages_in_stream:is_bot:day'] in stats:
+            update_realm_streams_traffic_caches()
+
         if options['verbose']:
             print("Finished updating analytics counts through %s in %.3fs" %
                   (fill_to_time, time.time() - start))
@@ -18,12 +18,14 @@ class zulip::app_frontend_base {
     source  => 'puppet:///modules/zulip/nginx/zulip-include-frontend/app',
     notify  => Service['nginx'],
   }
+  # Number of Tornado processes to run; see zerver/tornado/sharding.py.
+  $tornado_processes = zulipconf('application_server', 'tornado_processes', 1)
   file { '/etc/nginx/zulip-include/upstreams':
     require => Package['nginx-full'],
     owner   => 'root',
     group   => 'root',
     mode    => '0644',
-    source  => 'puppet:///modules/zulip/nginx/zulip-include-frontend/upstreams',
+    content => template('zulip/nginx/upstreams.template.erb'),
     notify  => Service['nginx'],
   }
   file { '/etc/nginx/zulip-include/uploads.types':
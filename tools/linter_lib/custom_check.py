@@ -357,6 +357,8 @@ def build_custom_checkers(by_lang):
         {'pattern': ' % [a-zA-Z0-9_."\']*\)?$',
          'exclude_line': set([
              ('tools/tests/test_template_parser.py', '{% foo'),
+             # Integer modulo, not string formatting.
+             ('zerver/tornado/sharding.py', 'return user_profile_id % settings.TORNADO_PROCESSES'),
          ]),
          'description': 'Used % comprehension without a tuple',
          'good_lines': ['"foo %s bar" % ("baz",)'],
@@ -32,6 +32,8 @@ from zerver.lib.bot_config import (
 )
 from zerver.lib.cache import (
     bot_dict_fields,
+    bump_realm_mention_index_version,
+    bump_realm_state_version,
     delete_user_profile_caches,
     to_dict_cache_key_id,
 )
@@ -43,6 +45,8 @@ from zerver.lib.message import (
     access_message,
     MessageDict,
     render_markdown,
+    render_markdown_many,
+    stringify_message_dict,
 )
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.retention import move_message_to_archive
@@ -83,9 +87,9 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     get_display_recipient_by_id, query_for_ids, get_huddle_recipient, \
     UserGroup, UserGroupMembership, get_default_stream_groups, \
     get_bot_services, get_bot_dicts_in_realm, DomainNotAllowedForRealmError, \
-    DisposableEmailError
+    DisposableEmailError, MutedTopic
 
-from zerver.lib.alert_words import alert_words_in_realm
+from zerver.lib.alert_words import get_alert_word_matcher
 from zerver.lib.avatar import avatar_url, avatar_url_from_dict
 from zerver.lib.stream_recipient import StreamRecipientMap
 from zerver.lib.validator import check_widget_content
@@ -110,7 +114,10 @@ from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, user_profile_cache_key, \
-    cache_set_many, cache_delete, cache_delete_many
+    cache_set_many, cache_delete, cache_delete_many, invalidate_unread_indexes, \
+    realm_streams_traffic_cache_key, cache_get_many, remote_cache_set_many, \
+    stream_subscribers_cache_key, stream_subscribers_version_cache_key, \
+    invalidate_stream_subscribers
 from zerver.decorator import statsd_increment
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
@@ -120,17 +127,22 @@ from zerver.lib.alert_words import user_alert_words, add_user_alert_words, \
 from zerver.lib.notifications import clear_scheduled_emails, \
     clear_scheduled_invitation_emails, enqueue_welcome_emails
 from zerver.lib.narrow import check_supported_events_narrow_filter
+from zerver.lib.unread_index import remove_read_messages
+from zerver.lib.presence import update_presence_snapshots, \
+    get_status_dict_by_realm as get_presence_status_dict_by_realm
 from zerver.lib.exceptions import JsonableError, ErrorCode
 from zerver.lib.sessions import delete_user_sessions
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image, upload_emoji_image
 from zerver.lib.str_utils import NonBinaryStr, force_str
-from zerver.tornado.event_queue import request_event_queue, send_event
+from zerver.tornado.event_queue import batch_events, request_event_queue, send_event
 from zerver.lib.types import ProfileFieldData
 
 from analytics.models import StreamCount
 
 import DNS
+import array
+import io
 import ujson
 import time
 import traceback
@@ -731,6 +743,7 @@ def do_deactivate_stream(stream: Stream, log: bool=True) -> None:
     affected_user_ids = can_access_stream_user_ids(stream)
 
     get_active_subscriptions_for_stream_id(stream.id).update(active=False)
+    invalidate_stream_subscribers([get_stream_recipient(stream.id).id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -859,14 +872,14 @@ def render_incoming_message(message: Message,
                             realm: Realm,
                             mention_data: Optional[bugdown.MentionData]=None,
                             email_gateway: Optional[bool]=False) -> str:
-    realm_alert_words = alert_words_in_realm(realm)
+    alert_word_matcher = get_alert_word_matcher(realm)
     try:
         rendered_content = render_markdown(
             message=message,
             content=content,
             realm=realm,
-            realm_alert_words=realm_alert_words,
             user_ids=user_ids,
+            alert_word_matcher=alert_word_matcher,
             mention_data=mention_data,
             email_gateway=email_gateway,
         )
@@ -874,6 +887,18 @@ def render_incoming_message(message: Message,
         raise JsonableError(_('Unable to render message'))
     return rendered_content
 
+def render_incoming_messages(requests: List[Dict[str, Any]]) -> List[str]:
+    '''
+    Like render_incoming_message, for a list of dicts of its
+    arguments; see render_markdown_many.
+    '''
+    for request in requests:
+        request['alert_word_matcher'] = get_alert_word_matcher(request['realm'])
+    try:
+        return render_markdown_many(requests)
+    except BugdownRenderingException:
+        raise JsonableError(_('Unable to render message'))
+
 def get_typing_user_profiles(recipient: Recipient, sender_id: int) -> List[UserProfile]:
     if recipient.type == Recipient.STREAM:
         '''
@@ -908,59 +933,107 @@ RecipientInfoResult = TypedDict('RecipientInfoResult', {
     'service_bot_tuples': List[Tuple[int, int]],
 })
 
+# (recipient, sender_id, stream_topic, possibly_mentioned_user_ids)
+RecipientInfoTarget = Tuple[Recipient, int, Optional[StreamTopicTarget], Optional[Set[int]]]
+
 def get_recipient_info(recipient: Recipient,
                        sender_id: int,
                        stream_topic: Optional[StreamTopicTarget],
                        possibly_mentioned_user_ids: Optional[Set[int]]=None) -> RecipientInfoResult:
-    stream_push_user_ids = set()  # type: Set[int]
-
-    if recipient.type == Recipient.PERSONAL:
-        # The sender and recipient may be the same id, so
-        # de-duplicate using a set.
-        message_to_user_ids = list({recipient.type_id, sender_id})
-        assert(len(message_to_user_ids) in [1, 2])
-
-    elif recipient.type == Recipient.STREAM:
-        # Anybody calling us w/r/t a stream message needs to supply
-        # stream_topic.  We may eventually want to have different versions
-        # of this function for different message types.
-        assert(stream_topic is not None)
+    return bulk_get_recipient_info([
+        (recipient, sender_id, stream_topic, possibly_mentioned_user_ids),
+    ])[0]
 
-        subscription_rows = stream_topic.get_active_subscriptions().values(
+def bulk_get_recipient_info(targets: Sequence[RecipientInfoTarget]) -> List[RecipientInfoResult]:
+    '''
+    Batched version of get_recipient_info.  Rather than doing a
+    subscription query and a UserProfile query for every message, we
+    fetch the subscriptions for all the streams and huddles in the
+    batch at once, and then fetch every UserProfile row we need with
+    a single query.  This keeps the number of database queries for
+    do_send_messages constant in the number of messages being sent.
+
+    Returns one RecipientInfoResult per target, in the same order.
+    '''
+    stream_ids = set()  # type: Set[int]
+    stream_topics = set()  # type: Set[Tuple[int, str]]
+    huddle_recipient_ids = set()  # type: Set[int]
+    for recipient, sender_id, stream_topic, _ in targets:
+        if recipient.type == Recipient.STREAM:
+            # Anybody calling us w/r/t a stream message needs to supply
+            # stream_topic.  We may eventually want to have different versions
+            # of this function for different message types.
+            assert(stream_topic is not None)
+            stream_ids.add(stream_topic.stream_id)
+            stream_topics.add((stream_topic.stream_id, stream_topic.topic_name.lower()))
+        elif recipient.type == Recipient.HUDDLE:
+            huddle_recipient_ids.add(recipient.id)
+        elif recipient.type != Recipient.PERSONAL:
+            raise ValueError('Bad recipient type')
+
+    subscription_rows_by_stream = defaultdict(list)  # type: Dict[int, List[Dict[str, Any]]]
+    muting_user_ids_by_topic = defaultdict(set)  # type: Dict[Tuple[int, str], Set[int]]
+    if stream_ids:
+        subscription_rows = get_active_subscriptions_for_stream_ids(list(stream_ids)).values(
+            'recipient__type_id',
             'user_profile_id',
             'push_notifications',
             'in_home_view',
         ).order_by('user_profile_id')
+        for row in subscription_rows:
+            subscription_rows_by_stream[row['recipient__type_id']].append(row)
+        muting_user_ids_by_topic = get_user_ids_muting_topics(stream_topics)
+
+    huddle_user_ids = defaultdict(list)  # type: Dict[int, List[int]]
+    if huddle_recipient_ids:
+        huddle_rows = Subscription.objects.filter(
+            recipient_id__in=huddle_recipient_ids,
+            active=True,
+        ).order_by('user_profile_id').values('recipient_id', 'user_profile_id')
+        for row in huddle_rows:
+            huddle_user_ids[row['recipient_id']].append(row['user_profile_id'])
+
+    target_user_ids = []  # type: List[Tuple[List[int], Set[int]]]
+    user_ids = set()  # type: Set[int]
+    for recipient, sender_id, stream_topic, possibly_mentioned_user_ids in targets:
+        stream_push_user_ids = set()  # type: Set[int]
+
+        if recipient.type == Recipient.PERSONAL:
+            # The sender and recipient may be the same id, so
+            # de-duplicate using a set.
+            message_to_user_ids = list({recipient.type_id, sender_id})
+            assert(len(message_to_user_ids) in [1, 2])
+
+        elif recipient.type == Recipient.STREAM:
+            assert(stream_topic is not None)
+            rows = subscription_rows_by_stream[stream_topic.stream_id]
+            message_to_user_ids = [
+                row['user_profile_id']
+                for row in rows
+            ]
+
+            topic_key = (stream_topic.stream_id, stream_topic.topic_name.lower())
+            stream_push_user_ids = {
+                row['user_profile_id']
+                for row in rows
+                # Note: muting a stream overrides stream_push_notify
+                if row['push_notifications'] and row['in_home_view']
+            } - muting_user_ids_by_topic.get(topic_key, set())
 
-        message_to_user_ids = [
-            row['user_profile_id']
-            for row in subscription_rows
-        ]
-
-        stream_push_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_push_notify
-            if row['push_notifications'] and row['in_home_view']
-        } - stream_topic.user_ids_muting_topic()
-
-    elif recipient.type == Recipient.HUDDLE:
-        message_to_user_ids = get_huddle_user_ids(recipient)
-
-    else:
-        raise ValueError('Bad recipient type')
+        else:
+            message_to_user_ids = huddle_user_ids[recipient.id]
 
-    message_to_user_id_set = set(message_to_user_ids)
+        target_user_ids.append((message_to_user_ids, stream_push_user_ids))
 
-    user_ids = set(message_to_user_id_set)
-    if possibly_mentioned_user_ids:
-        # Important note: Because we haven't rendered bugdown yet, we
-        # don't yet know which of these possibly-mentioned users was
-        # actually mentioned in the message (in other words, the
-        # mention syntax might have been in a code block or otherwise
-        # escaped).  `get_ids_for` will filter these extra user rows
-        # for our data structures not related to bots
-        user_ids |= possibly_mentioned_user_ids
+        user_ids |= set(message_to_user_ids)
+        if possibly_mentioned_user_ids:
+            # Important note: Because we haven't rendered bugdown yet, we
+            # don't yet know which of these possibly-mentioned users was
+            # actually mentioned in the message (in other words, the
+            # mention syntax might have been in a code block or otherwise
+            # escaped).  `get_ids_for` will filter these extra user rows
+            # for our data structures not related to bots
+            user_ids |= possibly_mentioned_user_ids
 
     if user_ids:
         query = UserProfile.objects.filter(
@@ -980,7 +1053,10 @@ def get_recipient_info(recipient: Recipient,
             user_ids=sorted(list(user_ids)),
             field='id'
         )
-        rows = list(query)
+        rows_by_id = {
+            row['id']: row
+            for row in query
+        }  # type: Dict[int, Dict[str, Any]]
     else:
         # TODO: We should always have at least one user_id as a recipient
         #       of any message we send.  Right now the exception to this
@@ -988,7 +1064,58 @@ def get_recipient_info(recipient: Recipient,
         #       contrived test scenario, can attempt to send messages
         #       to an inactive bot.  When we plug that hole, we can avoid
         #       this `else` clause and just `assert(user_ids)`.
-        rows = []
+        rows_by_id = {}
+
+    return [
+        build_recipient_info(
+            message_to_user_ids=message_to_user_ids,
+            stream_push_user_ids=stream_push_user_ids,
+            possibly_mentioned_user_ids=target[3],
+            rows_by_id=rows_by_id,
+        )
+        for target, (message_to_user_ids, stream_push_user_ids)
+        in zip(targets, target_user_ids)
+    ]
+
+def get_user_ids_muting_topics(stream_topics: Iterable[Tuple[int, str]]) -> Dict[Tuple[int, str], Set[int]]:
+    '''
+    Returns a map from (stream_id, lowercased topic name) to the ids
+    of the users muting that topic, for all the given (stream_id,
+    topic name) pairs.  We only fetch the MutedTopic rows for the
+    topics we were asked about, not every muted topic in the streams.
+    '''
+    result = defaultdict(set)  # type: Dict[Tuple[int, str], Set[int]]
+    query = None  # type: Optional[Q]
+    for stream_id, topic_name in stream_topics:
+        clause = Q(stream_id=stream_id, topic_name__iexact=topic_name)
+        query = clause if query is None else query | clause
+    if query is None:
+        return result
+
+    rows = MutedTopic.objects.filter(query).values(
+        'stream_id',
+        'topic_name',
+        'user_profile_id',
+    )
+    for row in rows:
+        result[(row['stream_id'], row['topic_name'].lower())].add(row['user_profile_id'])
+    return result
+
+def build_recipient_info(message_to_user_ids: List[int],
+                         stream_push_user_ids: Set[int],
+                         possibly_mentioned_user_ids: Optional[Set[int]],
+                         rows_by_id: Dict[int, Dict[str, Any]]) -> RecipientInfoResult:
+    message_to_user_id_set = set(message_to_user_ids)
+
+    user_ids = set(message_to_user_id_set)
+    if possibly_mentioned_user_ids:
+        user_ids |= possibly_mentioned_user_ids
+
+    rows = [
+        rows_by_id[user_id]
+        for user_id in sorted(user_ids)
+        if user_id in rows_by_id
+    ]
 
     def get_ids_for(f: Callable[[Dict[str, Any]], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
@@ -1141,6 +1268,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     messages = new_messages
 
     links_for_embed = set()  # type: Set[str]
+    recipient_info_targets = []  # type: List[RecipientInfoTarget]
     # For consistency, changes to the default values for these gets should also be applied
     # to the default args in do_send_message
     for message in messages:
@@ -1168,13 +1296,19 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         else:
             stream_topic = None
 
-        info = get_recipient_info(
-            recipient=message['message'].recipient,
-            sender_id=message['message'].sender_id,
-            stream_topic=stream_topic,
-            possibly_mentioned_user_ids=mention_data.get_user_ids(),
-        )
+        recipient_info_targets.append((
+            message['message'].recipient,
+            message['message'].sender_id,
+            stream_topic,
+            mention_data.get_user_ids(),
+        ))
 
+    # Fetch the recipient data for the whole batch at once; this
+    # avoids doing a few database queries per message when sending
+    # many messages (e.g. from the email gateway or mirroring bots).
+    infos = bulk_get_recipient_info(recipient_info_targets)
+
+    for message, info in zip(messages, infos):
         message['active_user_ids'] = info['active_user_ids']
         message['push_notify_user_ids'] = info['push_notify_user_ids']
         message['stream_push_user_ids'] = info['stream_push_user_ids']
@@ -1183,17 +1317,23 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['default_bot_user_ids'] = info['default_bot_user_ids']
         message['service_bot_tuples'] = info['service_bot_tuples']
 
-        # Render our messages.
+    # Render our messages, all at once so that bugdown can render
+    # them in parallel.
+    for message in messages:
         assert message['message'].rendered_content is None
-
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_user_ids'],
-            message['realm'],
+    rendered_contents = render_incoming_messages([
+        dict(
+            message=message['message'],
+            content=message['message'].content,
+            user_ids=message['active_user_ids'],
+            realm=message['realm'],
             mention_data=message['mention_data'],
             email_gateway=email_gateway,
         )
+        for message in messages
+    ])
+
+    for message, rendered_content in zip(messages, rendered_contents):
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -1234,10 +1374,9 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 mentioned_user_ids=mentioned_user_ids,
             )
 
-            for um in user_messages:
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
+            user_message_flags[message['message'].id] = user_messages.flags_lists()
 
-            ums.extend(user_messages)
+            ums.append(user_messages)
 
             message['message'].service_queue_events = get_service_bot_events(
                 sender=message['message'].sender,
@@ -1257,22 +1396,44 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         for message in messages:
             do_widget_post_save_actions(message)
 
-    for message in messages:
+    # Check presence for the notification candidates of every message
+    # in the batch with a single UserPresence query.
+    presence_candidate_user_ids = [
+        get_presence_idle_candidate_user_ids(
+            realm=message['message'].sender.realm,
+            sender_id=message['message'].sender_id,
+            message_type=('stream' if message['message'].is_stream_message() else 'private'),
+            active_user_ids=message['active_user_ids'],
+            user_flags=user_message_flags.get(message['message'].id, {}),
+        )
+        for message in messages
+    ]
+    present_user_ids = get_present_user_ids(
+        set().union(*presence_candidate_user_ids)
+    )
+
+    # Likewise, fetch any streams our callers didn't provide in one query.
+    missing_stream_ids = {
+        message['message'].recipient.type_id
+        for message in messages
+        if message['message'].is_stream_message() and message['stream'] is None
+    }
+    if missing_stream_ids:
+        streams_by_id = {
+            stream.id: stream
+            for stream in Stream.objects.select_related("realm").filter(id__in=missing_stream_ids)
+        }
+        for message in messages:
+            if message['message'].is_stream_message() and message['stream'] is None:
+                message['stream'] = streams_by_id[message['message'].recipient.type_id]
+
+    for message, candidate_user_ids in zip(messages, presence_candidate_user_ids):
         # Deliver events to the real-time push system, as well as
         # enqueuing any additional processing triggered by the message.
         wide_message_dict = MessageDict.wide_dict(message['message'])
 
         user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        message_type = wide_message_dict['type']
-
-        presence_idle_user_ids = get_active_presence_idle_user_ids(
-            realm=sender.realm,
-            sender_id=sender.id,
-            message_type=message_type,
-            active_user_ids=message['active_user_ids'],
-            user_flags=user_flags,
-        )
+        presence_idle_user_ids = sorted(list(candidate_user_ids - present_user_ids))
 
         event = dict(
             type='message',
@@ -1311,9 +1472,6 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
             # notify new_message request if it's a public stream,
             # ensuring that in the tornado server, non-public stream
             # messages are only associated to their subscribed users.
-            if message['stream'] is None:
-                stream_id = message['message'].recipient.type_id
-                message['stream'] = Stream.objects.select_related("realm").get(id=stream_id)
             assert message['stream'] is not None  # assert needed because stubs for django are missing
             if message['stream'].is_public():
                 event['realm_id'] = message['stream'].realm_id
@@ -1371,54 +1529,97 @@ class UserMessageLite:
     '''
     The Django ORM is too slow for bulk operations.  This class
     is optimized for the simple use case of inserting a bunch of
-    rows into zerver_usermessage.
+    rows into zerver_usermessage for a single message.
+
+    For messages to large streams, allocating a Python object per
+    recipient dominates the cost of sending, so we store the rows
+    column-wise, as parallel arrays of user ids and flag bitmasks.
     '''
-    def __init__(self, user_profile_id: int, message_id: int) -> None:
-        self.user_profile_id = user_profile_id
+    def __init__(self, message_id: int, user_profile_ids: Sequence[int],
+                 flags: Sequence[int]) -> None:
+        assert(len(user_profile_ids) == len(flags))
         self.message_id = message_id
-        self.flags = 0
+        self.user_profile_ids = array.array('q', user_profile_ids)
+        self.flags = array.array('q', flags)
 
-    def flags_list(self) -> List[str]:
-        return UserMessage.flags_list_for_flags(self.flags)
+    def __len__(self) -> int:
+        return len(self.user_profile_ids)
+
+    def rows(self) -> Iterable[Tuple[int, int, int]]:
+        message_id = self.message_id
+        for user_profile_id, flags in zip(self.user_profile_ids, self.flags):
+            yield (user_profile_id, message_id, flags)
+
+    def flags_lists(self) -> Dict[int, List[str]]:
+        '''
+        Returns the decoded flags of every user whose flags are
+        nonzero; callers should treat a missing user as having no
+        flags.  Each distinct bitmask (there are only ever a few) is
+        decoded just once.
+        '''
+        decoded = {}  # type: Dict[int, List[str]]
+        result = {}  # type: Dict[int, List[str]]
+        for user_profile_id, flags in zip(self.user_profile_ids, self.flags):
+            if flags == 0:
+                continue
+            if flags not in decoded:
+                decoded[flags] = UserMessage.flags_list_for_flags(flags)
+            result[user_profile_id] = list(decoded[flags])
+        return result
 
 def create_user_messages(message: Message,
                          um_eligible_user_ids: Set[int],
                          long_term_idle_user_ids: Set[int],
-                         mentioned_user_ids: Set[int]) -> List[UserMessageLite]:
-    ums_to_create = []
-
-    for user_profile_id in um_eligible_user_ids:
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-        )
-        ums_to_create.append(um)
-
+                         mentioned_user_ids: Set[int]) -> UserMessageLite:
     # These properties on the Message are set via
     # render_markdown by code in the bugdown inline patterns
     wildcard = message.mentions_wildcard
     ids_with_alert_words = message.user_ids_with_alert_words
 
-    for um in ums_to_create:
-        if um.user_profile_id == message.sender.id and \
-                message.sent_by_human():
-            um.flags |= UserMessage.flags.read
-        if wildcard:
-            um.flags |= UserMessage.flags.wildcard_mentioned
-        if um.user_profile_id in mentioned_user_ids:
-            um.flags |= UserMessage.flags.mentioned
-        if um.user_profile_id in ids_with_alert_words:
-            um.flags |= UserMessage.flags.has_alert_word
-
-    user_messages = []
-    for um in ums_to_create:
-        if (um.user_profile_id in long_term_idle_user_ids and
-                message.is_stream_message() and
-                int(um.flags) == 0):
-            continue
-        user_messages.append(um)
+    base_flags = 0
+    if wildcard:
+        base_flags |= int(UserMessage.flags.wildcard_mentioned)
+
+    # Only a handful of recipients ever get flags of their own, so we
+    # compute those with set operations rather than examining every
+    # recipient of the message.
+    user_flags = defaultdict(int)  # type: Dict[int, int]
+    if message.sender_id in um_eligible_user_ids and message.sent_by_human():
+        user_flags[message.sender_id] |= int(UserMessage.flags.read)
+    for user_profile_id in mentioned_user_ids & um_eligible_user_ids:
+        user_flags[user_profile_id] |= int(UserMessage.flags.mentioned)
+    for user_profile_id in ids_with_alert_words & um_eligible_user_ids:
+        user_flags[user_profile_id] |= int(UserMessage.flags.has_alert_word)
+
+    # Long-term idle users only get UserMessage rows for stream
+    # messages if the message is somehow special to them.
+    if message.is_stream_message() and base_flags == 0:
+        user_profile_ids = (um_eligible_user_ids - long_term_idle_user_ids) | set(user_flags)
+    else:
+        user_profile_ids = um_eligible_user_ids
+    sorted_user_profile_ids = sorted(user_profile_ids)
+
+    if user_flags:
+        flags = [
+            base_flags | user_flags.get(user_profile_id, 0)
+            for user_profile_id in sorted_user_profile_ids
+        ]  # type: Sequence[int]
+    else:
+        flags = array.array('q', [base_flags]) * len(sorted_user_profile_ids)
+
+    return UserMessageLite(
+        message_id=message.id,
+        user_profile_ids=sorted_user_profile_ids,
+        flags=flags,
+    )
 
-    return user_messages
+# Above this many rows, bulk_insert_ums streams the rows to
+# postgres with COPY rather than building a single (potentially
+# multi-megabyte) INSERT statement that postgres must then parse.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
+# Number of rows sent to postgres in each COPY; this bounds the size
+# of the buffer we build in memory for large streams.
+BULK_INSERT_UMS_COPY_CHUNK_SIZE = 10000
 
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     '''
@@ -1426,13 +1627,23 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    For very large batches (e.g. a message to a stream with
+    thousands of subscribers), we use COPY instead; see
+    copy_insert_ums.
     '''
-    if not ums:
+    num_rows = sum(len(um) for um in ums)
+    if num_rows == 0:
+        return
+
+    if num_rows >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_insert_ums(ums)
         return
 
     vals = ','.join([
-        '(%d, %d, %d)' % (um.user_profile_id, um.message_id, um.flags)
+        '(%d, %d, %d)' % (user_profile_id, message_id, flags)
         for um in ums
+        for (user_profile_id, message_id, flags) in um.rows()
     ])
     query = '''
         INSERT into
@@ -1443,6 +1654,27 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     with connection.cursor() as cursor:
         cursor.execute(query)
 
+def copy_insert_ums(ums: List[UserMessageLite]) -> None:
+    '''
+    Inserts rows into zerver_usermessage using postgres's `COPY ...
+    FROM STDIN`, which avoids building and parsing a giant SQL string.
+    Rows are sent in chunks of BULK_INSERT_UMS_COPY_CHUNK_SIZE; since
+    we're normally called inside a transaction, a failure in any chunk
+    still rolls back the whole batch.
+    '''
+    columns = ('user_profile_id', 'message_id', 'flags')
+    rows = itertools.chain.from_iterable(um.rows() for um in ums)
+    with connection.cursor() as cursor:
+        while True:
+            chunk = list(itertools.islice(rows, BULK_INSERT_UMS_COPY_CHUNK_SIZE))
+            if not chunk:
+                break
+            buf = io.StringIO(''.join([
+                '%d\t%d\t%d\n' % (user_profile_id, message_id, flags)
+                for (user_profile_id, message_id, flags) in chunk
+            ]))
+            cursor.copy_from(buf, 'zerver_usermessage', columns=columns)
+
 def do_add_submessage(sender_id: int,
                       message_id: int,
                       msg_type: str,
@@ -2280,6 +2512,48 @@ def bulk_get_subscriber_user_ids(stream_dicts: Iterable[Mapping[str, Any]],
     if not recipient_ids:
         return result
 
+    # Each stream's subscriber list is cached as a packed array of
+    # user IDs, since in big realms these lists are long and most
+    # users can see most of them.  The lists are stamped with their
+    # stream's version (see invalidate_stream_subscribers), which we
+    # read before fetching any of them from the database.
+    cached = cache_get_many(
+        [stream_subscribers_cache_key(recipient_id) for recipient_id in recipient_ids] +
+        [stream_subscribers_version_cache_key(recipient_id) for recipient_id in recipient_ids])
+    subscribers_by_recipient = {}  # type: Dict[int, List[int]]
+    missing_versions = {}  # type: Dict[int, Optional[int]]
+    for recipient_id in recipient_ids:
+        entry = cached.get(stream_subscribers_cache_key(recipient_id))
+        version = cached.get(stream_subscribers_version_cache_key(recipient_id))
+        if entry is None or entry[0] != version:
+            missing_versions[recipient_id] = version
+        else:
+            subscribers_by_recipient[recipient_id] = unpack_user_ids(entry[1])
+
+    if missing_versions:
+        fetched = fetch_stream_subscriber_ids(list(missing_versions))
+        remote_cache_set_many({
+            stream_subscribers_cache_key(recipient_id): (
+                version, pack_user_ids(fetched[recipient_id]))
+            for recipient_id, version in missing_versions.items()
+        }, timeout=3600*24*7)
+        subscribers_by_recipient.update(fetched)
+
+    recip_to_stream_id = stream_recipient.recipient_to_stream_id_dict()
+    for recipient_id, user_profile_ids in subscribers_by_recipient.items():
+        result[recip_to_stream_id[recipient_id]] = user_profile_ids
+
+    return result
+
+def pack_user_ids(user_profile_ids: List[int]) -> bytes:
+    return array.array('I', user_profile_ids).tobytes()
+
+def unpack_user_ids(packed: bytes) -> List[int]:
+    user_profile_ids = array.array('I')
+    user_profile_ids.frombytes(packed)
+    return user_profile_ids.tolist()
+
+def fetch_stream_subscriber_ids(recipient_ids: List[int]) -> Dict[int, List[int]]:
     '''
     The raw SQL below leads to more than a 2x speedup when tested with
     20k+ total subscribers.  (For large realms with lots of default
@@ -2310,16 +2584,14 @@ def bulk_get_subscriber_user_ids(stream_dicts: Iterable[Mapping[str, Any]],
     rows = cursor.fetchall()
     cursor.close()
 
-    recip_to_stream_id = stream_recipient.recipient_to_stream_id_dict()
+    result = dict((recipient_id, []) for recipient_id in recipient_ids)  # type: Dict[int, List[int]]
 
     '''
     Using groupby/itemgetter here is important for performance, at scale.
     It makes it so that all interpreter overhead is just O(N) in nature.
     '''
     for recip_id, recip_rows in itertools.groupby(rows, itemgetter(0)):
-        user_profile_ids = [r[1] for r in recip_rows]
-        stream_id = recip_to_stream_id[recip_id]
-        result[stream_id] = list(user_profile_ids)
+        result[recip_id] = [r[1] for r in recip_rows]
 
     return result
 
@@ -2434,6 +2706,7 @@ def get_user_ids_for_streams(streams: Iterable[Stream]) -> Dict[int, List[int]]:
     return all_subscribers_by_stream
 
 SubT = Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
+@batch_events()
 def bulk_add_subscriptions(streams: Iterable[Stream],
                            users: Iterable[UserProfile],
                            from_stream_creation: bool=False,
@@ -2492,6 +2765,12 @@ def bulk_add_subscriptions(streams: Iterable[Stream],
         Subscription.objects.filter(id__in=sub_ids).update(active=True)
         occupied_streams_after = list(get_occupied_streams(user_profile.realm))
 
+    invalidate_stream_subscribers(set(
+        sub.recipient_id for (sub, stream) in subs_to_add + subs_to_activate))
+    # Unread indexes leave out streams their users were unsubscribed
+    # from when they were built.
+    invalidate_unread_indexes(sub.user_profile_id for (sub, stream) in subs_to_activate)
+
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
     event_last_message_id = Message.objects.aggregate(Max('id'))['id__max']
@@ -2616,6 +2895,7 @@ def notify_subscriptions_removed(user_profile: UserProfile, streams: Iterable[St
     send_event(event, [user_profile.id])
 
 SubAndRemovedT = Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
+@batch_events()
 def bulk_remove_subscriptions(users: Iterable[UserProfile],
                               streams: Iterable[Stream],
                               acting_user: Optional[UserProfile]=None) -> SubAndRemovedT:
@@ -2670,6 +2950,8 @@ def bulk_remove_subscriptions(users: Iterable[UserProfile],
         ) .update(active=False)
         occupied_streams_after = list(get_occupied_streams(our_realm))
 
+    invalidate_stream_subscribers(set(sub.recipient_id for (sub, stream) in subs_to_deactivate))
+
     # Log Subscription Activities in RealmAuditLog
     event_time = timezone_now()
     event_last_message_id = Message.objects.aggregate(Max('id'))['id__max']
@@ -2863,6 +3145,9 @@ def do_change_tos_version(user_profile: UserProfile, tos_version: str) -> None:
                                  event_time=event_time)
 
 def do_regenerate_api_key(user_profile: UserProfile, acting_user: UserProfile) -> None:
+    # Stop the old key from authenticating via the cache.
+    delete_user_profile_caches([user_profile])
+
     user_profile.api_key = random_api_key()
     user_profile.save(update_fields=["api_key"])
     event_time = timezone_now()
@@ -3346,8 +3631,10 @@ def default_stream_groups_to_dicts_sorted(groups: List[DefaultStreamGroup]) -> L
     return sorted([group.to_dict() for group in groups], key=lambda elt: elt["name"])
 
 def do_update_user_activity_interval(user_profile: UserProfile,
-                                     log_time: datetime.datetime) -> None:
-    effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+                                     log_time: datetime.datetime,
+                                     effective_end: Optional[datetime.datetime]=None) -> None:
+    if effective_end is None:
+        effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
     # This code isn't perfect, because with various races we might end
     # up creating two overlapping intervals, but that shouldn't happen
     # often, and can be corrected for in post-processing
@@ -3370,20 +3657,105 @@ def do_update_user_activity_interval(user_profile: UserProfile,
     UserActivityInterval.objects.create(user_profile=user_profile, start=log_time,
                                         end=effective_end)
 
-@statsd_increment('user_activity')
-def do_update_user_activity(user_profile: UserProfile,
-                            client: Client,
-                            query: str,
-                            log_time: datetime.datetime) -> None:
-    (activity, created) = UserActivity.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        query = query,
-        defaults={'last_visit': log_time, 'count': 0})
-
-    activity.count += 1
-    activity.last_visit = log_time
-    activity.save(update_fields=["last_visit", "count"])
+def do_update_user_activity_intervals(log_times: Dict[int, List[datetime.datetime]]) -> None:
+    '''
+    Records the activity of many users at once; log_times maps user ids
+    to times they were active at.  Each user's times are merged into as
+    few intervals as possible before we touch the database.
+    '''
+    for user_profile_id, times in log_times.items():
+        user_profile = get_user_profile_by_id(user_profile_id)
+        intervals = []  # type: List[List[datetime.datetime]]
+        for log_time in sorted(times):
+            effective_end = log_time + UserActivityInterval.MIN_INTERVAL_LENGTH
+            if intervals and log_time <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], effective_end)
+            else:
+                intervals.append([log_time, effective_end])
+        for start, end in intervals:
+            do_update_user_activity_interval(user_profile, start, end)
+
+def update_rows_from_values(table: str, set_clause: str, columns: str,
+                            row_template: str, rows: Sequence[Sequence[Any]]) -> None:
+    '''
+    Updates many rows of table with a single UPDATE ... FROM (VALUES
+    ...); unlike INSERT ... ON CONFLICT, this works with every
+    postgres version we support.  Each row holds the values for
+    columns, the first of which is the id of the row to update, and
+    row_template has a placeholder (with any casts) for each of them.
+    set_clause refers to the new values as updates.<column>.
+    '''
+    if not rows:
+        return
+    query = '''
+        UPDATE %s
+        SET %s
+        FROM (VALUES %s) AS updates(%s)
+        WHERE %s.id = updates.id
+    ''' % (table, set_clause, ', '.join([row_template] * len(rows)), columns, table)
+    with connection.cursor() as cursor:
+        cursor.execute(query, list(itertools.chain.from_iterable(rows)))
+
+ResultT = TypeVar('ResultT')
+
+def retry_on_integrity_error(update: Callable[[], ResultT]) -> ResultT:
+    '''
+    Runs update in a transaction, and once more if it fails with an
+    IntegrityError.  This is for bulk updates that create the rows
+    they don't find: if another process created one of them first,
+    the second attempt will update it instead.
+    '''
+    try:
+        with transaction.atomic():
+            return update()
+    except IntegrityError:
+        with transaction.atomic():
+            return update()
+
+def bulk_update_user_activity(
+        activities: Dict[Tuple[int, int, str], Tuple[int, datetime.datetime]]) -> None:
+    user_profile_ids = {user_profile_id for (user_profile_id, client_id, query) in activities}
+    client_ids = {client_id for (user_profile_id, client_id, query) in activities}
+    queries = {query for (user_profile_id, client_id, query) in activities}
+    existing_ids = {
+        (row['user_profile_id'], row['client_id'], row['query']): row['id']
+        for row in UserActivity.objects.filter(
+            user_profile_id__in=user_profile_ids,
+            client_id__in=client_ids,
+            query__in=queries).values('id', 'user_profile_id', 'client_id', 'query')
+    }
+
+    new_rows = []  # type: List[UserActivity]
+    updates = []  # type: List[Tuple[int, int, datetime.datetime]]
+    for key, (count, last_visit) in activities.items():
+        if key in existing_ids:
+            updates.append((existing_ids[key], count, last_visit))
+        else:
+            (user_profile_id, client_id, activity_query) = key
+            new_rows.append(UserActivity(user_profile_id=user_profile_id, client_id=client_id,
+                                         query=activity_query, count=count,
+                                         last_visit=last_visit))
+
+    UserActivity.objects.bulk_create(new_rows)
+    update_rows_from_values(
+        'zerver_useractivity',
+        '''count = zerver_useractivity.count + updates.count,
+           last_visit = GREATEST(zerver_useractivity.last_visit, updates.last_visit)''',
+        'id, count, last_visit',
+        '(%s, %s, %s::timestamptz)',
+        updates)
+
+def do_update_user_activity_many(
+        activities: Dict[Tuple[int, int, str], Tuple[int, datetime.datetime]]) -> None:
+    '''
+    Applies many visits at once; activities maps (user_profile_id,
+    client_id, query) to the number of visits and the time of the
+    latest one.
+    '''
+    if not activities:
+        return
+    statsd.incr('user_activity', sum(count for (count, last_visit) in activities.values()))
+    retry_on_integrity_error(lambda: bulk_update_user_activity(activities))
 
 def send_presence_changed(user_profile: UserProfile, presence: UserPresence) -> None:
     presence_dict = presence.to_dict()
@@ -3404,53 +3776,116 @@ def consolidate_client(client: Client) -> Client:
     else:
         return client
 
-@statsd_increment('user_presence')
+def bulk_update_user_presence(
+        updates: Dict[Tuple[int, int], List[Tuple[datetime.datetime, int]]],
+        user_profiles: Dict[int, UserProfile],
+        clients: Dict[int, Client]) -> List[Tuple[UserPresence, bool]]:
+    user_profile_ids = {user_profile_id for (user_profile_id, client_id) in updates}
+    client_ids = {client_id for (user_profile_id, client_id) in updates}
+    existing = {
+        (presence.user_profile_id, presence.client_id): presence
+        for presence in UserPresence.objects.filter(user_profile_id__in=user_profile_ids,
+                                                    client_id__in=client_ids)
+    }
+
+    changed = []  # type: List[Tuple[UserPresence, bool]]
+    new_rows = []  # type: List[UserPresence]
+    rows_to_update = []  # type: List[UserPresence]
+    for key, pings in updates.items():
+        (user_profile_id, client_id) = key
+        presence = existing.get(key)
+        created = presence is None
+        became_online = False
+        updated = False
+        for log_time, status in sorted(pings, key=lambda ping: ping[0]):
+            if presence is None:
+                presence = UserPresence(user_profile_id=user_profile_id, client_id=client_id,
+                                        timestamp=log_time, status=status)
+                continue
+
+            stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
+            was_idle = presence.status == UserPresence.IDLE
+            became_online = became_online or (
+                (status == UserPresence.ACTIVE) and (stale_status or was_idle))
+
+            # We suppress changes from ACTIVE to IDLE before
+            # stale_status is reached; this protects us from the user
+            # having two clients open: one active, the other idle.
+            # Without this check, we would constantly toggle their
+            # status between the two states.
+            if stale_status or was_idle or status == presence.status:
+                presence.timestamp = log_time
+                presence.status = status
+                updated = True
+
+        presence.user_profile = user_profiles[user_profile_id]
+        presence.client = clients[client_id]
+        if created:
+            new_rows.append(presence)
+        elif updated:
+            rows_to_update.append(presence)
+        if created or updated:
+            changed.append((presence, created or became_online))
+
+    UserPresence.objects.bulk_create(new_rows)
+    # Since we don't go through save(), this doesn't drop the realm
+    # presence snapshots, which our caller patches instead.
+    update_rows_from_values(
+        'zerver_userpresence',
+        'timestamp = updates.timestamp, status = updates.status',
+        'id, timestamp, status',
+        '(%s, %s::timestamptz, %s)',
+        [(presence.id, presence.timestamp, presence.status) for presence in rows_to_update])
+    return changed
+
+def do_update_user_presence_many(
+        updates: List[Tuple[UserProfile, Client, datetime.datetime, int]]) -> None:
+    '''
+    Applies many presence pings, each a (user_profile, client,
+    log_time, status), at once.  Pings for the same user and client
+    are folded together in time order, so a batch costs one query to
+    read the rows it touches and at most two to write them.
+    '''
+    if not updates:
+        return
+    statsd.incr('user_presence', len(updates))
+    user_profiles = {}  # type: Dict[int, UserProfile]
+    clients = {}  # type: Dict[int, Client]
+    pings = defaultdict(list)  # type: Dict[Tuple[int, int], List[Tuple[datetime.datetime, int]]]
+    for user_profile, client, log_time, status in updates:
+        client = consolidate_client(client)
+        user_profiles[user_profile.id] = user_profile
+        clients[client.id] = client
+        pings[(user_profile.id, client.id)].append((log_time, status))
+
+    changed = retry_on_integrity_error(
+        lambda: bulk_update_user_presence(pings, user_profiles, clients))
+
+    update_presence_snapshots([
+        (presence.user_profile, presence.client, presence.status, presence.timestamp)
+        for (presence, notify) in changed
+    ])
+
+    for presence, notify in changed:
+        user_profile = presence.user_profile
+        if not user_profile.realm.presence_disabled and notify:
+            # Push event to all users in the realm so they see the new user
+            # appear in the presence list immediately, or the newly online
+            # user without delay.  Note that we won't send an update here for a
+            # timestamp update, because we rely on the browser to ping us every 50
+            # seconds for realm-wide status updates, and those updates should have
+            # recent timestamps, which means the browser won't think active users
+            # have gone idle.  If we were more aggressive in this function about
+            # sending timestamp updates, we could eliminate the ping responses, but
+            # that's not a high priority for now, considering that most of our non-MIT
+            # realms are pretty small.
+            send_presence_changed(user_profile, presence)
+
 def do_update_user_presence(user_profile: UserProfile,
                             client: Client,
                             log_time: datetime.datetime,
                             status: int) -> None:
-    client = consolidate_client(client)
-    (presence, created) = UserPresence.objects.get_or_create(
-        user_profile = user_profile,
-        client = client,
-        defaults = {'timestamp': log_time,
-                    'status': status})
-
-    stale_status = (log_time - presence.timestamp) > datetime.timedelta(minutes=1, seconds=10)
-    was_idle = presence.status == UserPresence.IDLE
-    became_online = (status == UserPresence.ACTIVE) and (stale_status or was_idle)
-
-    # If an object was created, it has already been saved.
-    #
-    # We suppress changes from ACTIVE to IDLE before stale_status is reached;
-    # this protects us from the user having two clients open: one active, the
-    # other idle. Without this check, we would constantly toggle their status
-    # between the two states.
-    if not created and stale_status or was_idle or status == presence.status:
-        # The following block attempts to only update the "status"
-        # field in the event that it actually changed.  This is
-        # important to avoid flushing the UserPresence cache when the
-        # data it would return to a client hasn't actually changed
-        # (see the UserPresence post_save hook for details).
-        presence.timestamp = log_time
-        update_fields = ["timestamp"]
-        if presence.status != status:
-            presence.status = status
-            update_fields.append("status")
-        presence.save(update_fields=update_fields)
-
-    if not user_profile.realm.presence_disabled and (created or became_online):
-        # Push event to all users in the realm so they see the new user
-        # appear in the presence list immediately, or the newly online
-        # user without delay.  Note that we won't send an update here for a
-        # timestamp update, because we rely on the browser to ping us every 50
-        # seconds for realm-wide status updates, and those updates should have
-        # recent timestamps, which means the browser won't think active users
-        # have gone idle.  If we were more aggressive in this function about
-        # sending timestamp updates, we could eliminate the ping responses, but
-        # that's not a high priority for now, considering that most of our non-MIT
-        # realms are pretty small.
-        send_presence_changed(user_profile, presence)
+    do_update_user_presence_many([(user_profile, client, log_time, status)])
 
 def update_user_activity_interval(user_profile: UserProfile, log_time: datetime.datetime) -> None:
     event = {'user_profile_id': user_profile.id,
@@ -3483,6 +3918,7 @@ def do_update_pointer(user_profile: UserProfile, pointer: int, update_flags: boo
                                    message__id__lte=pointer,
                                    flags=~UserMessage.flags.read)        \
                            .update(flags=F('flags').bitor(UserMessage.flags.read))
+        invalidate_unread_indexes([user_profile.id])
 
     event = dict(type='pointer', pointer=pointer)
     send_event(event, [user_profile.id])
@@ -3499,6 +3935,7 @@ def do_mark_all_as_read(user_profile: UserProfile) -> int:
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    invalidate_unread_indexes([user_profile.id])
 
     event = dict(
         type='update_message_flags',
@@ -3536,6 +3973,7 @@ def do_mark_stream_messages_as_read(user_profile: UserProfile,
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    remove_read_messages(user_profile.id, message_ids)
 
     event = dict(
         type='update_message_flags',
@@ -3582,6 +4020,11 @@ def do_update_message_flags(user_profile: UserProfile,
     else:
         raise AssertionError("Invalid message flags operation")
 
+    if flag == 'read' and operation == 'add':
+        remove_read_messages(user_profile.id, messages)
+    elif flag in ['read', 'mentioned']:
+        invalidate_unread_indexes([user_profile.id])
+
     event = {'type': 'update_message_flags',
              'operation': operation,
              'flag': flag,
@@ -3650,48 +4093,175 @@ def get_user_info_for_message_updates(message_id: int) -> MessageUpdateUserInfoR
         mention_user_ids=mention_user_ids,
     )
 
-def update_user_message_flags(message: Message, ums: Iterable[UserMessage]) -> None:
-    wildcard = message.mentions_wildcard
-    mentioned_ids = message.mentions_user_ids
-    ids_with_alert_words = message.user_ids_with_alert_words
-    changed_ums = set()  # type: Set[UserMessage]
-
-    def update_flag(um: UserMessage, should_set: bool, flag: int) -> None:
-        if should_set:
-            if not (um.flags & flag):
-                um.flags |= flag
-                changed_ums.add(um)
-        else:
-            if (um.flags & flag):
-                um.flags &= ~flag
-                changed_ums.add(um)
-
-    for um in ums:
-        has_alert_word = um.user_profile_id in ids_with_alert_words
-        update_flag(um, has_alert_word, UserMessage.flags.has_alert_word)
+MessageUpdateRecipientInfoResult = TypedDict('MessageUpdateRecipientInfoResult', {
+    'active_user_ids': Set[int],
+    'push_notify_user_ids': Set[int],
+    'stream_push_user_ids': Set[int],
+})
 
-        mentioned = um.user_profile_id in mentioned_ids
-        update_flag(um, mentioned, UserMessage.flags.mentioned)
+def get_recipient_info_for_message_update(
+        message: Message,
+        stream_topic: Optional[StreamTopicTarget]) -> MessageUpdateRecipientInfoResult:
+    '''
+    A leaner get_recipient_info for do_update_message, which only needs
+    to know which recipients are active and which of them want push
+    notifications; it gets that with one query for the recipients,
+    plus one for topic mutes for stream messages.
+    '''
+    recipient = message.recipient
+    if recipient.type == Recipient.PERSONAL:
+        # The sender and recipient may be the same id, so
+        # de-duplicate using a set.
+        user_rows = UserProfile.objects.filter(
+            id__in={recipient.type_id, message.sender_id},
+            is_active=True,
+        ).values('id', 'enable_online_push_notifications')
+        rows = [
+            dict(user_profile_id=row['id'],
+                 enable_online_push_notifications=row['enable_online_push_notifications'],
+                 push_notifications=False,
+                 in_home_view=False)
+            for row in user_rows
+        ]  # type: List[Dict[str, Any]]
+    else:
+        rows = [
+            dict(user_profile_id=row['user_profile_id'],
+                 enable_online_push_notifications=row[
+                     'user_profile__enable_online_push_notifications'],
+                 push_notifications=row['push_notifications'],
+                 in_home_view=row['in_home_view'])
+            for row in Subscription.objects.filter(
+                recipient_id=recipient.id,
+                active=True,
+                user_profile__is_active=True,
+            ).values(
+                'user_profile_id',
+                'user_profile__enable_online_push_notifications',
+                'push_notifications',
+                'in_home_view',
+            )
+        ]
 
-        update_flag(um, wildcard, UserMessage.flags.wildcard_mentioned)
+    stream_push_user_ids = set()  # type: Set[int]
+    if recipient.type == Recipient.STREAM:
+        assert(stream_topic is not None)
+        muting_user_ids = set(MutedTopic.objects.filter(
+            stream_id=stream_topic.stream_id,
+            topic_name__iexact=stream_topic.topic_name,
+        ).values_list('user_profile_id', flat=True))
+        stream_push_user_ids = {
+            row['user_profile_id']
+            for row in rows
+            # Note: muting a stream overrides stream_push_notify
+            if row['push_notifications'] and row['in_home_view']
+        } - muting_user_ids
 
-    for um in changed_ums:
-        um.save(update_fields=['flags'])
+    return dict(
+        active_user_ids={row['user_profile_id'] for row in rows},
+        push_notify_user_ids={
+            row['user_profile_id']
+            for row in rows
+            if row['enable_online_push_notifications']
+        },
+        stream_push_user_ids=stream_push_user_ids,
+    )
 
-def update_to_dict_cache(changed_messages: List[Message]) -> List[int]:
-    """Updates the message as stored in the to_dict cache (for serving
-    messages)."""
+def update_user_message_flags(message: Message, um_rows: List[Dict[str, Any]]) -> None:
+    '''
+    Updates the mention and alert word flags of a message's UserMessage
+    rows (from a .values() query with id, user_profile_id and flags)
+    after its content changed, both in the database and in um_rows.
+    '''
+    if message.mentions_wildcard:
+        wildcard_ids = {row['user_profile_id'] for row in um_rows}
+    else:
+        wildcard_ids = set()
+    changed_user_ids = set()  # type: Set[int]
+
+    for flag, user_ids_to_flag in [
+            (UserMessage.flags.has_alert_word, message.user_ids_with_alert_words),
+            (UserMessage.flags.mentioned, message.mentions_user_ids),
+            (UserMessage.flags.wildcard_mentioned, wildcard_ids),
+    ]:
+        mask = int(flag)
+        ids_to_set = []  # type: List[int]
+        ids_to_clear = []  # type: List[int]
+        for row in um_rows:
+            flags = int(row['flags'])
+            if row['user_profile_id'] in user_ids_to_flag:
+                if not (flags & mask):
+                    row['flags'] = flags | mask
+                    ids_to_set.append(row['id'])
+                    changed_user_ids.add(row['user_profile_id'])
+            else:
+                if (flags & mask):
+                    row['flags'] = flags & ~mask
+                    ids_to_clear.append(row['id'])
+                    changed_user_ids.add(row['user_profile_id'])
+
+        if ids_to_set:
+            UserMessage.objects.filter(id__in=ids_to_set).update(
+                flags=F('flags').bitor(mask))
+        if ids_to_clear:
+            UserMessage.objects.filter(id__in=ids_to_clear).update(
+                flags=F('flags').bitand(~mask))
+
+    # Unread indexes record which messages mention their users.
+    invalidate_unread_indexes(changed_user_ids)
+
+def update_to_dict_cache(message_ids: List[int]) -> None:
+    """Updates the messages as stored in the to_dict cache (for serving
+    messages), with the same few queries however many there are."""
     items_for_remote_cache = {}
-    message_ids = []
-    for changed_message in changed_messages:
-        message_ids.append(changed_message.id)
-        key = to_dict_cache_key_id(changed_message.id)
-        value = MessageDict.to_dict_uncached(changed_message)
+    for row in MessageDict.get_raw_db_rows(message_ids):
+        key = to_dict_cache_key_id(row['id'])
+        value = stringify_message_dict(MessageDict.build_dict_from_raw_db_row(row))
         items_for_remote_cache[key] = (value,)
 
     cache_set_many(items_for_remote_cache)
+
+def propagate_topic_edit(message: Message, orig_topic_name: str, topic_name: str,
+                         propagate_mode: str) -> List[int]:
+    '''
+    Moves the other messages in the edited message's topic that
+    propagate_mode covers to the new topic, with a single query, and
+    returns their IDs.
+    '''
+    where = ['recipient_id = %s', 'subject = %s']
+    params = [message.recipient_id, orig_topic_name]  # type: List[Any]
+
+    # We only change messages up to 2 days in the past, to avoid hammering our
+    # DB by changing an unbounded amount of messages
+    if propagate_mode == 'change_all':
+        before_bound = timezone_now() - datetime.timedelta(days=2)
+        where += ['id <> %s', 'pub_date BETWEEN %s AND %s']
+        params += [message.id, before_bound, timezone_now()]
+    if propagate_mode == 'change_later':
+        where.append('id > %s')
+        params.append(message.id)
+
+    query = '''
+        UPDATE zerver_message
+        SET subject = %%s
+        WHERE %s
+        RETURNING id
+    ''' % (' AND '.join(where),)
+
+    cursor = connection.cursor()
+    cursor.execute(query, [topic_name] + params)
+    message_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
     return message_ids
 
+def user_info_for_update_message_event(um_rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            'id': row['user_profile_id'],
+            'flags': UserMessage.flags_list_for_flags(int(row['flags'])),
+        }
+        for row in um_rows
+    ]
+
 # We use transaction.atomic to support select_for_update in the attachment codepath.
 @transaction.atomic
 def do_update_embedded_data(user_profile: UserProfile,
@@ -3702,12 +4272,12 @@ def do_update_embedded_data(user_profile: UserProfile,
         'type': 'update_message',
         'sender': user_profile.email,
         'message_id': message.id}  # type: Dict[str, Any]
-    changed_messages = [message]
 
-    ums = UserMessage.objects.filter(message=message.id)
+    um_rows = list(UserMessage.objects.filter(message=message.id).values(
+        'id', 'user_profile_id', 'flags'))
 
     if content is not None:
-        update_user_message_flags(message, ums)
+        update_user_message_flags(message, um_rows)
         message.content = content
         message.rendered_content = rendered_content
         message.rendered_content_version = bugdown_version
@@ -3716,14 +4286,10 @@ def do_update_embedded_data(user_profile: UserProfile,
 
     message.save(update_fields=["content", "rendered_content"])
 
-    event['message_ids'] = update_to_dict_cache(changed_messages)
+    event['message_ids'] = [message.id]
+    update_to_dict_cache(event['message_ids'])
 
-    def user_info(um: UserMessage) -> Dict[str, Any]:
-        return {
-            'id': um.user_profile_id,
-            'flags': um.flags_list()
-        }
-    send_event(event, list(map(user_info, ums)))
+    send_event(event, user_info_for_update_message_event(um_rows))
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
 @transaction.atomic
@@ -3740,16 +4306,17 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
     edit_history_event = {
         'user_id': user_profile.id,
     }  # type: Dict[str, Any]
-    changed_messages = [message]
+    changed_message_ids = [message.id]
 
     if message.is_stream_message():
         stream_id = message.recipient.type_id
         event['stream_name'] = Stream.objects.get(id=stream_id).name
 
-    ums = UserMessage.objects.filter(message=message.id)
+    um_rows = list(UserMessage.objects.filter(message=message.id).values(
+        'id', 'user_profile_id', 'flags'))
 
     if content is not None:
-        update_user_message_flags(message, ums)
+        update_user_message_flags(message, um_rows)
 
         # One could imagine checking realm.allow_edit_history here and
         # modifying the events based on that setting, but doing so
@@ -3789,12 +4356,7 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
         else:
             stream_topic = None
 
-        # TODO: We may want a slightly leaner of this function for updates.
-        info = get_recipient_info(
-            recipient=message.recipient,
-            sender_id=message.sender_id,
-            stream_topic=stream_topic,
-        )
+        info = get_recipient_info_for_message_update(message, stream_topic)
 
         event['push_notify_user_ids'] = list(info['push_notify_user_ids'])
         event['stream_push_user_ids'] = list(info['stream_push_user_ids'])
@@ -3814,29 +4376,13 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
         edit_history_event["prev_subject"] = orig_topic_name
 
         if propagate_mode in ["change_later", "change_all"]:
-            propagate_query = Q(recipient = message.recipient, subject = orig_topic_name)
-            # We only change messages up to 2 days in the past, to avoid hammering our
-            # DB by changing an unbounded amount of messages
-            if propagate_mode == 'change_all':
-                before_bound = timezone_now() - datetime.timedelta(days=2)
-
-                propagate_query = (propagate_query & ~Q(id = message.id) &
-                                   Q(pub_date__range=(before_bound, timezone_now())))
-            if propagate_mode == 'change_later':
-                propagate_query = propagate_query & Q(id__gt = message.id)
-
-            messages = Message.objects.filter(propagate_query).select_related()
+            changed_message_ids += propagate_topic_edit(message, orig_topic_name,
+                                                        topic_name, propagate_mode)
 
-            # Evaluate the query before running the update
-            messages_list = list(messages)
-            messages.update(subject=topic_name)
-
-            for m in messages_list:
-                # The cached ORM object is not changed by messages.update()
-                # and the remote cache update requires the new value
-                m.subject = topic_name
-
-            changed_messages += messages_list
+        # Everyone who could have these messages in their unread
+        # index is (or was) subscribed to the stream.
+        invalidate_unread_indexes(Subscription.objects.filter(
+            recipient=message.recipient).values_list('user_profile_id', flat=True))
 
     message.last_edit_time = timezone_now()
     assert message.last_edit_time is not None  # assert needed because stubs for django are missing
@@ -3853,15 +4399,11 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
                                 "rendered_content_version", "last_edit_time",
                                 "edit_history"])
 
-    event['message_ids'] = update_to_dict_cache(changed_messages)
+    event['message_ids'] = changed_message_ids
+    update_to_dict_cache(changed_message_ids)
 
-    def user_info(um: UserMessage) -> Dict[str, Any]:
-        return {
-            'id': um.user_profile_id,
-            'flags': um.flags_list()
-        }
-    send_event(event, list(map(user_info, ums)))
-    return len(changed_messages)
+    send_event(event, user_info_for_update_message_event(um_rows))
+    return len(changed_message_ids)
 
 
 def do_delete_message(user_profile: UserProfile, message: Message) -> None:
@@ -3885,14 +4427,14 @@ def do_delete_message(user_profile: UserProfile, message: Message) -> None:
     move_message_to_archive(message.id)
     send_event(event, ums)
 
-def get_streams_traffic(streams: Optional[Iterable[Stream]]=None) -> Dict[int, int]:
+def stream_traffic_query() -> QuerySet:
     stat = COUNT_STATS['messages_in_stream:is_bot:day']
     traffic_from = timezone_now() - datetime.timedelta(days=28)
+    return StreamCount.objects.filter(property=stat.property,
+                                      end_time__gt=traffic_from)
 
-    query = StreamCount.objects.filter(property=stat.property,
-                                       end_time__gt=traffic_from)
-    if streams is not None:
-        query = query.filter(stream__in=streams)
+def get_streams_traffic(streams: Iterable[Stream]) -> Dict[int, int]:
+    query = stream_traffic_query().filter(stream__in=streams)
 
     traffic_list = query.values('stream_id').annotate(value=Sum('value'))
     traffic_dict = {}
@@ -3901,6 +4443,30 @@ def get_streams_traffic(streams: Optional[Iterable[Stream]]=None) -> Dict[int, i
 
     return traffic_dict
 
+# StreamCount only changes when update_analytics_counts runs, which
+# refreshes these with update_realm_streams_traffic_caches.
+@cache_with_key(realm_streams_traffic_cache_key, timeout=3600*24)
+def get_realm_streams_traffic(realm_id: int) -> Dict[int, int]:
+    traffic_list = stream_traffic_query().filter(
+        realm_id=realm_id).values('stream_id').annotate(value=Sum('value'))
+    return {traffic["stream_id"]: traffic["value"] for traffic in traffic_list}
+
+def update_realm_streams_traffic_caches() -> None:
+    traffic_by_realm = {
+        realm_id: {}
+        for realm_id in Realm.objects.values_list('id', flat=True)
+    }  # type: Dict[int, Dict[int, int]]
+    traffic_list = stream_traffic_query().values('realm_id', 'stream_id').annotate(
+        value=Sum('value'))
+    for traffic in traffic_list:
+        traffic_by_realm.setdefault(traffic["realm_id"], {})[traffic["stream_id"]] = \
+            traffic["value"]
+
+    cache_set_many({
+        realm_streams_traffic_cache_key(realm_id): (traffic_dict,)
+        for realm_id, traffic_dict in traffic_by_realm.items()
+    }, timeout=3600*24)
+
 def round_to_2_significant_digits(number: int) -> int:
     return int(round(number, 2 - len(str(number))))
 
@@ -4026,7 +4592,7 @@ def gather_subscriptions_helper(user_profile: UserProfile,
     stream_recipient.populate_for_recipient_ids(sub_recipient_ids)
 
     stream_ids = set()  # type: Set[int]
-    recent_traffic = get_streams_traffic()
+    recent_traffic = get_realm_streams_traffic(user_profile.realm_id)
     for sub in sub_dicts:
         sub['stream_id'] = stream_recipient.stream_id_for(sub['recipient_id'])
         stream_ids.add(sub['stream_id'])
@@ -4172,9 +4738,27 @@ def get_active_presence_idle_user_ids(realm: Realm,
         * They are no longer "present" according to the
           UserPresence table.
     '''
+    user_ids = get_presence_idle_candidate_user_ids(
+        realm=realm,
+        sender_id=sender_id,
+        message_type=message_type,
+        active_user_ids=active_user_ids,
+        user_flags=user_flags,
+    )
+    return filter_presence_idle_user_ids(user_ids)
 
+def get_presence_idle_candidate_user_ids(realm: Realm,
+                                         sender_id: int,
+                                         message_type: str,
+                                         active_user_ids: Set[int],
+                                         user_flags: Dict[int, List[str]]) -> Set[int]:
+    '''
+    The users among active_user_ids who are likely to need
+    notifications (either due to mentions or being PM'ed), before
+    taking presence into account.
+    '''
     if realm.presence_disabled:
-        return []
+        return set()
 
     is_pm = message_type == 'private'
 
@@ -4186,11 +4770,11 @@ def get_active_presence_idle_user_ids(realm: Realm,
         if mentioned or private_message:
             user_ids.add(user_id)
 
-    return filter_presence_idle_user_ids(user_ids)
+    return user_ids
 
-def filter_presence_idle_user_ids(user_ids: Set[int]) -> List[int]:
+def get_present_user_ids(user_ids: Set[int]) -> Set[int]:
     if not user_ids:
-        return []
+        return set()
 
     # 140 seconds is consistent with presence.js:OFFLINE_THRESHOLD_SECS
     recent = timezone_now() - datetime.timedelta(seconds=140)
@@ -4199,8 +4783,13 @@ def filter_presence_idle_user_ids(user_ids: Set[int]) -> List[int]:
         status=UserPresence.ACTIVE,
         timestamp__gte=recent
     ).distinct('user_profile_id').values('user_profile_id')
-    active_user_ids = {row['user_profile_id'] for row in rows}
-    idle_user_ids = user_ids - active_user_ids
+    return {row['user_profile_id'] for row in rows}
+
+def filter_presence_idle_user_ids(user_ids: Set[int]) -> List[int]:
+    if not user_ids:
+        return []
+
+    idle_user_ids = user_ids - get_present_user_ids(user_ids)
     return sorted(list(idle_user_ids))
 
 def get_status_dict(requesting_user_profile: UserProfile) -> Dict[str, Dict[str, Dict[str, Any]]]:
@@ -4208,7 +4797,7 @@ def get_status_dict(requesting_user_profile: UserProfile) -> Dict[str, Dict[str,
         # Return an empty dict if presence is disabled in this realm
         return defaultdict(dict)
 
-    return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
+    return get_presence_status_dict_by_realm(requesting_user_profile.realm_id)
 
 def get_cross_realm_dicts() -> List[Dict[str, Any]]:
     users = bulk_get_users(list(settings.CROSS_REALM_BOT_EMAILS), None,
@@ -4915,6 +5504,8 @@ def bulk_add_members_to_user_group(user_group: UserGroup,
                                        user_profile=user_profile)
                    for user_profile in user_profiles]
     UserGroupMembership.objects.bulk_create(memberships)
+    bump_realm_mention_index_version(user_group.realm_id)
+    bump_realm_state_version(user_group.realm_id)
 
     user_ids = [up.id for up in user_profiles]
     do_send_user_group_members_update_event('add_members', user_group, user_ids)
@@ -4924,6 +5515,7 @@ def remove_members_from_user_group(user_group: UserGroup,
     UserGroupMembership.objects.filter(
         user_group_id=user_group.id,
         user_profile__in=user_profiles).delete()
+    bump_realm_mention_index_version(user_group.realm_id)
 
     user_ids = [up.id for up in user_profiles]
     do_send_user_group_members_update_event('remove_members', user_group, user_ids)
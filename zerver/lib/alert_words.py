@@ -1,9 +1,135 @@
 
 from django.db.models import Q
 from zerver.models import UserProfile, Realm
-from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
+from zerver.lib.cache import cache_with_key, local_cache_with_key, \
+    realm_alert_words_cache_key, realm_alert_word_matcher_cache_key
 import ujson
-from typing import Dict, Iterable, List
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+# An alert word only matches if it is surrounded by whitespace, the
+# start or end of the message, or one of these characters.
+ALERT_WORD_ALLOWED_BEFORE = frozenset('(".,\';[*`>')
+ALERT_WORD_ALLOWED_AFTER = frozenset(')"?:.,\';]!*`')
+
+class AlertWordMatcher:
+    '''
+    Finds every alert word in a realm in a single pass over a message,
+    using an Aho-Corasick automaton over the lowercased words, rather
+    than running a regex per word.  get_alert_word_matcher shares one
+    per realm between messages, so it must not be modified after
+    construction.
+    '''
+
+    def __init__(self, realm_alert_words: Mapping[int, Iterable[str]]) -> None:
+        # Lowercased word -> {word as the user entered it -> user ids}
+        self.users_by_word = {}  # type: Dict[str, Dict[str, Set[int]]]
+        for user_id, words in realm_alert_words.items():
+            for word in words:
+                lower_word = word.lower()
+                if not lower_word:
+                    continue
+                self.users_by_word.setdefault(lower_word, {}).setdefault(word, set()).add(user_id)
+
+        # The trie of all the words; state 0 is the root.
+        self.transitions = [{}]  # type: List[Dict[str, int]]
+        self.outputs = [[]]  # type: List[List[str]]
+        for lower_word in self.users_by_word:
+            state = 0
+            for char in lower_word:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append(lower_word)
+
+        # A state's failure link points at the state for the longest
+        # proper suffix of its prefix that is also in the trie.  We
+        # compute them breadth-first, so that each state can also
+        # inherit the words that end at its failure state.
+        self.failures = [0] * len(self.transitions)
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                self.outputs[next_state] = (self.outputs[next_state] +
+                                            self.outputs[self.failures[next_state]])
+
+    def find_words(self, content: str) -> Set[str]:
+        '''Returns the lowercased alert words in (lowercased) content.'''
+        found = set()  # type: Set[str]
+        if not self.users_by_word:
+            return found
+
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        content_length = len(content)
+        state = 0
+        for end, char in enumerate(content, start=1):
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            for word in outputs[state]:
+                if word in found:
+                    continue
+                start = end - len(word)
+                if start > 0:
+                    before = content[start - 1]
+                    if not (before.isspace() or before in ALERT_WORD_ALLOWED_BEFORE):
+                        continue
+                if end < content_length:
+                    after = content[end]
+                    if not (after.isspace() or after in ALERT_WORD_ALLOWED_AFTER):
+                        continue
+                found.add(word)
+        return found
+
+    def match(self, content: str, user_ids: Set[int]) -> Tuple[Set[str], Set[int]]:
+        '''
+        Returns the alert words of the given users that appear in
+        content, as those users entered them, and which of the users
+        have one of those words.
+        '''
+        alert_words = set()  # type: Set[str]
+        user_ids_with_alert_words = set()  # type: Set[int]
+        for lower_word in self.find_words(content.lower()):
+            for word, word_user_ids in self.users_by_word[lower_word].items():
+                matched_user_ids = word_user_ids & user_ids
+                if matched_user_ids:
+                    alert_words.add(word)
+                    user_ids_with_alert_words |= matched_user_ids
+        return alert_words, user_ids_with_alert_words
+
+    def restrict(self, content: str, user_ids: Set[int]) -> Optional['AlertWordMatcher']:
+        '''
+        Returns a matcher for just the given users' alert words that
+        appear in content, or None if there are none.  It is much
+        cheaper to send to a render process than the realm's matcher.
+        '''
+        words_by_user = defaultdict(list)  # type: Dict[int, List[str]]
+        for lower_word in self.find_words(content.lower()):
+            for word, word_user_ids in self.users_by_word[lower_word].items():
+                for user_id in word_user_ids & user_ids:
+                    words_by_user[user_id].append(word)
+        if not words_by_user:
+            return None
+        return AlertWordMatcher(words_by_user)
+
+    def get_user_ids(self) -> Set[int]:
+        user_ids = set()  # type: Set[int]
+        for word_user_ids in self.users_by_word.values():
+            for ids in word_user_ids.values():
+                user_ids |= ids
+        return user_ids
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
@@ -13,6 +139,10 @@ def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
     user_ids_with_words = dict((user_id, w) for (user_id, w) in all_user_words.items() if len(w))
     return user_ids_with_words
 
+@local_cache_with_key(realm_alert_word_matcher_cache_key, pickled=False)
+def get_alert_word_matcher(realm: Realm) -> AlertWordMatcher:
+    return AlertWordMatcher(alert_words_in_realm(realm))
+
 def user_alert_words(user_profile: UserProfile) -> List[str]:
     return ujson.loads(user_profile.alert_words)
 
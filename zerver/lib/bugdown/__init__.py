@@ -1,6 +1,6 @@
 # Zulip's main markdown implementation.  See docs/subsystems/markdown.md for
 # detailed documentation on our markdown syntax.
-from typing import (Any, Callable, Dict, Iterable, List, NamedTuple,
+from typing import (Any, Callable, Dict, Iterable, List, NamedTuple, Sequence,
                     Optional, Set, Tuple, TypeVar, Union, cast)
 from mypy_extensions import TypedDict
 from typing.re import Match
@@ -15,41 +15,41 @@ import html
 import twitter
 import platform
 import time
-import functools
 import ujson
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 
 import requests
 
 from django.core import mail
 from django.conf import settings
-from django.db.models import Q
 
 from markdown.extensions import codehilite
+from zerver.lib.alert_words import AlertWordMatcher
 from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
 from zerver.lib.camo import get_camo_url
 from zerver.lib.emoji import translate_emoticons, emoticon_regex
 from zerver.lib.mention import possible_mentions, \
     possible_user_group_mentions, extract_user_group
+from zerver.lib.mention_index import RealmMentionIndex, get_realm_mention_index
 from zerver.lib.notifications import encode_stream
+from zerver.lib.process_pool import get_process_pool
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, NotFoundInCache
+from zerver.lib.cache import cache_with_key, cache_get_many, cache_set_many, \
+    rendered_content_cache_key, NotFoundInCache
 from zerver.lib.url_preview import preview as link_preview
+from zerver.lib.utils import make_safe_digest
 from zerver.models import (
     all_realm_filters,
-    get_active_streams,
     MAX_MESSAGE_LENGTH,
     Message,
     Realm,
     RealmFilter,
     realm_filters_for_realm,
-    UserProfile,
     UserGroup,
-    UserGroupMembership,
 )
 import zerver.lib.mention as mention
 from zerver.lib.tex import render_tex
@@ -93,7 +93,12 @@ def rewrite_local_links_to_relative(link: str) -> str:
 
     return link
 
-def url_embed_preview_enabled_for_realm(message: Optional[Message]) -> bool:
+def mark_uncacheable() -> None:
+    if current_message is not None:
+        current_message.cacheable = False
+
+def url_embed_preview_enabled_for_realm(
+        message: Optional[Union[Message, 'MessageRenderingData']]) -> bool:
     if message is not None:
         realm = message.get_realm()  # type: Optional[Realm]
     else:
@@ -828,6 +833,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
 
             dropbox_image = self.dropbox_image(url)
             if dropbox_image is not None:
+                mark_uncacheable()
                 class_attr = "message_inline_ref"
                 is_image = dropbox_image["is_image"]
                 if is_image:
@@ -842,6 +848,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                 self.handle_image_inlining(root, found_url)
                 continue
             if get_tweet_id(url) is not None:
+                mark_uncacheable()
                 if rendered_tweet_count >= self.TWITTER_MAX_TO_PREVIEW:
                     # Only render at most one tweet per message
                     continue
@@ -867,6 +874,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
 
             if current_message is None or not url_embed_preview_enabled_for_realm(current_message):
                 continue
+            mark_uncacheable()
             try:
                 extracted_data = link_preview.link_embed_data_from_cache(url)
             except NotFoundInCache:
@@ -1431,25 +1439,17 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
             # We check for alert words here, the set of which are
             # dependent on which users may see this message.
             #
-            # Our caller passes in the list of possible_words.  We
-            # don't do any special rendering; we just append the alert words
-            # we find to the set current_message.alert_words.
-
-            realm_words = db_data['possible_words']
-
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for word in realm_words:
-                escaped = re.escape(word.lower())
-                match_re = re.compile('(?:%s)%s(?:%s)' %
-                                      (allowed_before_punctuation,
-                                       escaped,
-                                       allowed_after_punctuation))
-                if re.search(match_re, content):
-                    current_message.alert_words.add(word)
+            # prepare_render passes in a matcher for the alert words
+            # of the users who may see the message that appear
+            # anywhere in its content, and those users' ids.  We don't
+            # do any special rendering; we just record the alert words
+            # we find, and whose they are, on current_message.
+            matcher = db_data['alert_word_matcher']
+            if matcher is not None:
+                alert_words, user_ids = matcher.match('\n'.join(lines),
+                                                      db_data['alert_word_user_ids'])
+                current_message.alert_words.update(alert_words)
+                current_message.user_ids_with_alert_words.update(user_ids)
 
         return lines
 
@@ -1565,10 +1565,6 @@ class Bugdown(markdown.Extension):
         md.inlinePatterns.add('unicodeemoji', UnicodeEmoji(unicode_emoji_regex), '_end')
         md.inlinePatterns.add('link', AtomicLinkPattern(markdown.inlinepatterns.LINK_RE, md), '>avatar')
 
-        for (pattern, format_string, id) in self.getConfig("realm_filters"):
-            md.inlinePatterns.add('realm_filters/%s' % (pattern,),
-                                  RealmFilterPattern(pattern, format_string), '>link')
-
         # A link starts at a word boundary, and ends at space, punctuation, or end-of-input.
         #
         # We detect a url either by the `https?://` or by building around the TLD.
@@ -1616,6 +1612,8 @@ class Bugdown(markdown.Extension):
                    r"| (?:file://(/[^/ ]*)+/?)" if settings.ENABLE_FILE_LINKS else r"")
         md.inlinePatterns.add('autolink', AutoLink(link_regex), '>link')
 
+        set_realm_filter_patterns(md, self.getConfig("realm_filters"))
+
         md.preprocessors.add('hanging_ulists',
                              BugdownUListPreprocessor(md),
                              "_begin")
@@ -1647,9 +1645,26 @@ class Bugdown(markdown.Extension):
                 if k not in ["paragraph"]:
                     del md.parser.blockprocessors[k]
 
-md_engines = {}  # type: Dict[Tuple[int, bool], markdown.Markdown]
+# The most markdown engines we keep in each process.  Engines are only
+# built for the realms that actually send messages, and the least
+# recently used one is dropped when we'd go over this.
+MAX_MD_ENGINES = 100
+
+md_engines = OrderedDict()  # type: OrderedDict[Tuple[int, bool], markdown.Markdown]
 realm_filter_data = {}  # type: Dict[int, List[Tuple[str, str, int]]]
 
+def set_realm_filter_patterns(md: markdown.Markdown,
+                              realm_filters: List[Tuple[str, str, int]]) -> None:
+    """Replaces md's realm filter patterns with ones for realm_filters,
+    leaving the rest of the engine as it is.  The filters run after
+    autolink, so that they don't rewrite parts of URLs."""
+    for k in list(md.inlinePatterns.keys()):
+        if k.startswith('realm_filters/'):
+            del md.inlinePatterns[k]
+    for (pattern, format_string, id) in realm_filters:
+        md.inlinePatterns.add('realm_filters/%s' % (pattern,),
+                              RealmFilterPattern(pattern, format_string), '>autolink')
+
 class EscapeHtml(markdown.Extension):
     def extendMarkdown(self, md: markdown.Markdown, md_globals: Dict[str, Any]) -> None:
         del md.preprocessors['html_block']
@@ -1659,6 +1674,8 @@ def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
     md_engine_key = (realm_filters_key, email_gateway)
     if md_engine_key in md_engines:
         del md_engines[md_engine_key]
+    while len(md_engines) >= MAX_MD_ENGINES:
+        md_engines.popitem(last=False)
 
     realm_filters = realm_filter_data[realm_filters_key]
     md_engines[md_engine_key] = markdown.Markdown(
@@ -1688,32 +1705,42 @@ def subject_links(realm_filters_key: int, subject: str) -> List[str]:
     return matches
 
 def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gateway: bool) -> None:
-    # If realm_filters_key is None, load all filters
-    global realm_filter_data
+    # If realm_filters_key is None, load all filters.  Engines are
+    # still only built when a realm first needs one.
     if realm_filters_key is None:
         all_filters = all_realm_filters()
         all_filters[DEFAULT_BUGDOWN_KEY] = []
-        for realm_filters_key, filters in all_filters.items():
-            realm_filter_data[realm_filters_key] = filters
-            make_md_engine(realm_filters_key, email_gateway)
         # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
-        realm_filter_data[ZEPHYR_MIRROR_BUGDOWN_KEY] = []
-        make_md_engine(ZEPHYR_MIRROR_BUGDOWN_KEY, False)
+        all_filters[ZEPHYR_MIRROR_BUGDOWN_KEY] = []
+        for realm_filters_key, filters in all_filters.items():
+            update_realm_filters(realm_filters_key, filters)
     else:
-        realm_filters = realm_filters_for_realm(realm_filters_key)
-        if realm_filters_key not in realm_filter_data or    \
-                realm_filter_data[realm_filters_key] != realm_filters:
-            # Realm filters data has changed, update `realm_filter_data` and any
-            # of the existing markdown engines using this set of realm filters.
-            realm_filter_data[realm_filters_key] = realm_filters
-            for email_gateway_flag in [True, False]:
-                if (realm_filters_key, email_gateway_flag) in md_engines:
-                    # Update only existing engines(if any), don't create new one.
-                    make_md_engine(realm_filters_key, email_gateway_flag)
-
-        if (realm_filters_key, email_gateway) not in md_engines:
-            # Markdown engine corresponding to this key doesn't exists so create one.
-            make_md_engine(realm_filters_key, email_gateway)
+        get_md_engine(realm_filters_key, email_gateway,
+                      realm_filters_for_realm(realm_filters_key))
+
+def update_realm_filters(realm_filters_key: int,
+                         realm_filters: List[Tuple[str, str, int]]) -> None:
+    if realm_filter_data.get(realm_filters_key) == realm_filters:
+        return
+    # Realm filters data has changed, update `realm_filter_data` and swap
+    # the new patterns into any existing markdown engines using this set
+    # of realm filters; rebuilding the whole engine is much slower.
+    realm_filter_data[realm_filters_key] = realm_filters
+    for email_gateway_flag in [True, False]:
+        md_engine = md_engines.get((realm_filters_key, email_gateway_flag))
+        if md_engine is not None:
+            set_realm_filter_patterns(md_engine, realm_filters)
+
+def get_md_engine(realm_filters_key: int, email_gateway: bool,
+                  realm_filters: List[Tuple[str, str, int]]) -> markdown.Markdown:
+    update_realm_filters(realm_filters_key, realm_filters)
+
+    md_engine_key = (realm_filters_key, email_gateway)
+    if md_engine_key not in md_engines:
+        # Markdown engine corresponding to this key doesn't exists so create one.
+        make_md_engine(realm_filters_key, email_gateway)
+    md_engines.move_to_end(md_engine_key)
+    return md_engines[md_engine_key]
 
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
@@ -1726,13 +1753,42 @@ def privacy_clean_markdown(content: str) -> str:
     return repr(_privacy_re.sub('x', content))
 
 
+class MessageRenderingData:
+    """What the markdown processors know about the message being
+    rendered, and what they find out about it.  Unlike a Message, it
+    can be sent to a render process and back; do_convert copies the
+    results onto the Message afterwards."""
+
+    def __init__(self, realm: Realm) -> None:
+        self.realm = realm
+        self.mentions_wildcard = False
+        self.mentions_user_ids = set()  # type: Set[int]
+        self.mentions_user_group_ids = set()  # type: Set[int]
+        self.alert_words = set()  # type: Set[str]
+        self.user_ids_with_alert_words = set()  # type: Set[int]
+        self.links_for_preview = set()  # type: Set[str]
+        # Cleared if the rendering used data from outside Zulip (e.g.
+        # tweets), which may change; see get_render_cache_key.
+        self.cacheable = True
+
+    def get_realm(self) -> Realm:
+        return self.realm
+
+    def update_message(self, message: Message) -> None:
+        message.mentions_wildcard = self.mentions_wildcard
+        message.mentions_user_ids = self.mentions_user_ids
+        message.mentions_user_group_ids = self.mentions_user_group_ids
+        message.alert_words = self.alert_words
+        message.user_ids_with_alert_words = self.user_ids_with_alert_words
+        message.links_for_preview = self.links_for_preview
+
 # Filters such as UserMentionPattern need a message, but python-markdown
 # provides no way to pass extra params through to a pattern. Thus, a global.
-current_message = None  # type: Optional[Message]
+current_message = None  # type: Optional[MessageRenderingData]
 
-# We avoid doing DB queries in our markdown thread to avoid the overhead of
-# opening a new DB connection. These connections tend to live longer than the
-# threads themselves, as well.
+# We avoid doing DB queries while rendering, since we may be in a render
+# process or thread (see render_content); do_convert prefetches the data
+# from the DB that rendering needs into this global.
 db_data = None  # type: Optional[Dict[str, Any]]
 
 def log_bugdown_error(msg: str) -> None:
@@ -1742,74 +1798,63 @@ def log_bugdown_error(msg: str) -> None:
     could cause an infinite exception loop."""
     logging.getLogger('').error(msg)
 
-def get_email_info(realm_id: int, emails: Set[str]) -> Dict[str, FullNameInfo]:
+# The lookups below take the realm's mention index, when the caller
+# already has it, to save checking its version once per lookup.
+
+def get_email_info(realm_id: int, emails: Set[str],
+                   mention_index: Optional[RealmMentionIndex]=None) -> Dict[str, FullNameInfo]:
     if not emails:
         return dict()
 
-    q_list = {
-        Q(email__iexact=email.strip().lower())
-        for email in emails
-    }
-
-    rows = UserProfile.objects.filter(
-        realm_id=realm_id
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'email',
-    )
-
-    dct = {
-        row['email'].strip().lower(): row
-        for row in rows
-    }
+    if mention_index is None:
+        mention_index = get_realm_mention_index(realm_id)
+    users_by_email = mention_index.users_by_email
+    dct = {}  # type: Dict[str, FullNameInfo]
+    for email in emails:
+        row = users_by_email.get(email.strip().lower())
+        if row is not None:
+            dct[row['email'].strip().lower()] = row
     return dct
 
-def get_full_name_info(realm_id: int, full_names: Set[str]) -> Dict[str, FullNameInfo]:
+def get_full_name_info(realm_id: int, full_names: Set[str],
+                       mention_index: Optional[RealmMentionIndex]=None) -> Dict[str, FullNameInfo]:
     if not full_names:
         return dict()
 
-    q_list = {
-        Q(full_name__iexact=full_name)
-        for full_name in full_names
-    }
-
-    rows = UserProfile.objects.filter(
-        realm_id=realm_id,
-        is_active=True,
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'full_name',
-        'email',
-    )
-
-    dct = {
-        row['full_name'].lower(): row
-        for row in rows
-    }
+    if mention_index is None:
+        mention_index = get_realm_mention_index(realm_id)
+    users_by_full_name = mention_index.users_by_full_name
+    dct = {}  # type: Dict[str, FullNameInfo]
+    for full_name in full_names:
+        row = users_by_full_name.get(full_name.lower())
+        if row is not None:
+            dct[row['full_name'].lower()] = row
     return dct
 
 class MentionData:
-    def __init__(self, realm_id: int, content: str) -> None:
+    def __init__(self, realm_id: int, content: str,
+                 mention_index: Optional[RealmMentionIndex]=None) -> None:
         full_names = possible_mentions(content)
-        self.full_name_info = get_full_name_info(realm_id, full_names)
+        user_group_names = possible_user_group_mentions(content)
+        # We don't keep the index, since MentionData is sent on to
+        # the render processes.
+        if mention_index is None and (full_names or user_group_names):
+            mention_index = get_realm_mention_index(realm_id)
+
+        self.full_name_info = get_full_name_info(realm_id, full_names, mention_index)
         self.user_ids = {
             row['id']
             for row in self.full_name_info.values()
         }
 
-        user_group_names = possible_user_group_mentions(content)
-        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
-        group_ids = [group.id for group in self.user_group_name_info.values()]
-        membership = UserGroupMembership.objects.filter(user_group_id__in=group_ids)
+        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names,
+                                                             mention_index)
         self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
-        for info in membership.values('user_group_id', 'user_profile_id'):
-            group_id = info['user_group_id']
-            user_profile_id = info['user_profile_id']
-            self.user_group_members[group_id].append(user_profile_id)
+        if self.user_group_name_info:
+            assert mention_index is not None
+            all_group_members = mention_index.user_group_members
+            for user_group in self.user_group_name_info.values():
+                self.user_group_members[user_group.id] = all_group_members.get(user_group.id, [])
 
     def get_user(self, name: str) -> Optional[FullNameInfo]:
         return self.full_name_info.get(name.lower(), None)
@@ -1829,48 +1874,52 @@ class MentionData:
     def get_group_members(self, user_group_id: int) -> List[int]:
         return self.user_group_members.get(user_group_id, [])
 
-def get_user_group_name_info(realm_id: int, user_group_names: Set[str]) -> Dict[str, UserGroup]:
+def get_user_group_name_info(realm_id: int, user_group_names: Set[str],
+                             mention_index: Optional[RealmMentionIndex]=None
+                             ) -> Dict[str, UserGroup]:
     if not user_group_names:
         return dict()
 
-    rows = UserGroup.objects.filter(realm_id=realm_id,
-                                    name__in=user_group_names)
-    dct = {row.name.lower(): row for row in rows}
+    if mention_index is None:
+        mention_index = get_realm_mention_index(realm_id)
+    user_groups_by_name = mention_index.user_groups_by_name
+    dct = {
+        name.lower(): user_groups_by_name[name]
+        for name in user_group_names
+        if name in user_groups_by_name
+    }
     return dct
 
-def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, FullNameInfo]:
+def get_stream_name_info(realm: Realm, stream_names: Set[str],
+                         mention_index: Optional[RealmMentionIndex]=None
+                         ) -> Dict[str, FullNameInfo]:
     if not stream_names:
         return dict()
 
-    q_list = {
-        Q(name=name)
-        for name in stream_names
-    }
-
-    rows = get_active_streams(
-        realm=realm,
-    ).filter(
-        functools.reduce(lambda a, b: a | b, q_list),
-    ).values(
-        'id',
-        'name',
-    )
-
+    if mention_index is None:
+        mention_index = get_realm_mention_index(realm.id)
+    streams_by_name = mention_index.streams_by_name
     dct = {
-        row['name']: row
-        for row in rows
+        name: streams_by_name[name]
+        for name in stream_names
+        if name in streams_by_name
     }
     return dct
 
 
-def do_convert(content: str,
-               message: Optional[Message]=None,
-               message_realm: Optional[Realm]=None,
-               possible_words: Optional[Set[str]]=None,
-               sent_by_bot: Optional[bool]=False,
-               mention_data: Optional[MentionData]=None,
-               email_gateway: Optional[bool]=False) -> str:
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+RenderJob = Tuple[str, int, bool, List[Tuple[str, str, int]],
+                  Optional['MessageRenderingData'], Optional[Dict[str, Any]]]
+
+def prepare_render(content: str,
+                   message: Optional[Message]=None,
+                   message_realm: Optional[Realm]=None,
+                   alert_word_matcher: Optional[AlertWordMatcher]=None,
+                   alert_word_user_ids: Optional[Set[int]]=None,
+                   sent_by_bot: Optional[bool]=False,
+                   mention_data: Optional[MentionData]=None,
+                   email_gateway: Optional[bool]=False) -> RenderJob:
+    """Fetches everything rendering needs from the database, returning
+    the arguments for render_content."""
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
     # * message is passed, but no realm is -> look up realm from message
@@ -1889,28 +1938,26 @@ def do_convert(content: str,
         # delivered via zephyr_mirror
         realm_filters_key = ZEPHYR_MIRROR_BUGDOWN_KEY
 
-    maybe_update_markdown_engines(realm_filters_key, email_gateway)
-    md_engine_key = (realm_filters_key, email_gateway)
-
-    if md_engine_key in md_engines:
-        _md_engine = md_engines[md_engine_key]
-    else:
-        if DEFAULT_BUGDOWN_KEY not in md_engines:
-            maybe_update_markdown_engines(realm_filters_key=None, email_gateway=False)
-
-        _md_engine = md_engines[(DEFAULT_BUGDOWN_KEY, email_gateway)]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
-
-    global current_message
-    current_message = message
+    realm_filters = realm_filters_for_realm(realm_filters_key)
 
     # Pre-fetch data from the DB that is used in the bugdown thread
-    global db_data
+    message_data = None  # type: Optional[MessageRenderingData]
+    render_db_data = None  # type: Optional[Dict[str, Any]]
     if message is not None:
         assert message_realm is not None  # ensured above if message is not None
-        if possible_words is None:
-            possible_words = set()  # Set[str]
+        if alert_word_user_ids is None:
+            alert_word_user_ids = set()
+        if alert_word_matcher is not None:
+            # Rather than send the realm's matcher to a render process
+            # with every message, we find the alert words anywhere in
+            # the content here, and send a matcher for just those.
+            # AlertWordsNotificationProcessor then only counts the
+            # ones outside of code blocks and the like.
+            alert_word_matcher = alert_word_matcher.restrict(content, alert_word_user_ids)
+            if alert_word_matcher is None:
+                alert_word_user_ids = set()
+            else:
+                alert_word_user_ids = alert_word_matcher.get_user_ids()
 
         # Here we fetch the data structures needed to render
         # mentions/avatars/stream mentions from the database, but only
@@ -1918,22 +1965,30 @@ def do_convert(content: str,
         # the fetches are somewhat expensive and these types of syntax
         # are uncommon enough that it's a useful optimization.
 
-        if mention_data is None:
-            mention_data = MentionData(message_realm.id, content)
-
         emails = possible_avatar_emails(content)
-        email_info = get_email_info(message_realm.id, emails)
-
         stream_names = possible_linked_stream_names(content)
-        stream_name_info = get_stream_name_info(message_realm, stream_names)
+        # Check the mention index's version at most once for all of
+        # the lookups below.
+        mention_index = None  # type: Optional[RealmMentionIndex]
+        if emails or stream_names or (mention_data is None and (
+                possible_mentions(content) or possible_user_group_mentions(content))):
+            mention_index = get_realm_mention_index(message_realm.id)
+
+        if mention_data is None:
+            mention_data = MentionData(message_realm.id, content, mention_index)
+
+        email_info = get_email_info(message_realm.id, emails, mention_index)
+        stream_name_info = get_stream_name_info(message_realm, stream_names, mention_index)
 
         if content_has_emoji_syntax(content):
             active_realm_emoji = message_realm.get_active_emoji()
         else:
             active_realm_emoji = dict()
 
-        db_data = {
-            'possible_words': possible_words,
+        message_data = MessageRenderingData(message.get_realm())
+        render_db_data = {
+            'alert_word_matcher': alert_word_matcher,
+            'alert_word_user_ids': alert_word_user_ids,
             'email_info': email_info,
             'mention_data': mention_data,
             'active_realm_emoji': active_realm_emoji,
@@ -1943,13 +1998,56 @@ def do_convert(content: str,
             'translate_emoticons': message.sender.translate_emoticons,
         }
 
+    return (content, realm_filters_key, bool(email_gateway), realm_filters,
+            message_data, render_db_data)
+
+def render_content(content: str, realm_filters_key: int, email_gateway: bool,
+                   realm_filters: List[Tuple[str, str, int]],
+                   message_data: Optional[MessageRenderingData],
+                   render_db_data: Optional[Dict[str, Any]]
+                   ) -> Tuple[str, Optional[MessageRenderingData]]:
+    """Runs the markdown engine, in a render process (or a timeout thread
+    if BUGDOWN_RENDER_PROCESSES is 0), so it must not use the database.
+    What we learn about the message is returned in message_data."""
+    global current_message
+    global db_data
+    _md_engine = get_md_engine(realm_filters_key, email_gateway, realm_filters)
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
+
+    current_message = message_data
+    db_data = render_db_data
+    try:
+        return _md_engine.convert(content), message_data
+    finally:
+        current_message = None
+        db_data = None
+
+def run_render_jobs(render_jobs: List[RenderJob]) -> List[Any]:
+    """Returns the result of render_content for each job, or the exception
+    it failed with."""
+    # Spend at most BUGDOWN_TIMEOUT seconds rendering each message;
+    # this protects the backend from being overloaded by bugs
+    # (e.g. markdown logic that is extremely inefficient in corner
+    # cases) as well as user errors (e.g. a realm filter that makes
+    # some syntax infinite-loop).
+    if settings.BUGDOWN_RENDER_PROCESSES > 0:
+        pool = get_process_pool('bugdown', settings.BUGDOWN_RENDER_PROCESSES)
+        return pool.map(render_content, render_jobs, settings.BUGDOWN_TIMEOUT)
+
+    results = []  # type: List[Any]
+    for render_job in render_jobs:
+        try:
+            results.append(timeout(settings.BUGDOWN_TIMEOUT, render_content, *render_job))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def finish_render(content: str, message: Optional[Message], result: Any) -> str:
     try:
-        # Spend at most 5 seconds rendering; this protects the backend
-        # from being overloaded by bugs (e.g. markdown logic that is
-        # extremely inefficient in corner cases) as well as user
-        # errors (e.g. a realm filter that makes some syntax
-        # infinite-loop).
-        rendered_content = timeout(5, _md_engine.convert, content)
+        if isinstance(result, Exception):
+            raise result
+        rendered_content, message_data = result
 
         # Throw an exception if the content is huge; this protects the
         # rest of the codebase from any bugs where we end up rendering
@@ -1957,6 +2055,8 @@ def do_convert(content: str,
         if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
             raise BugdownRenderingException('Rendered content exceeds %s characters' %
                                             (MAX_MESSAGE_LENGTH * 10,))
+        if message is not None:
+            message_data.update_message(message)
         return rendered_content
     except Exception:
         cleaned = privacy_clean_markdown(content)
@@ -1970,9 +2070,107 @@ def do_convert(content: str,
             fail_silently=False)
 
         raise BugdownRenderingException()
-    finally:
-        current_message = None
-        db_data = None
+
+def get_render_cache_key(render_job: RenderJob) -> Optional[str]:
+    """Returns the key to cache the rendering of a message under, which
+    covers everything the rendering depends on; or None if its content
+    has syntax that renders differently for different senders or
+    recipients (mentions, avatars, stream links and alert words)."""
+    if not settings.BUGDOWN_RENDER_CACHE:
+        return None
+    (content, realm_filters_key, email_gateway, realm_filters,
+     message_data, render_db_data) = render_job
+    if message_data is None or render_db_data is None:
+        return None
+
+    if (re.search(mention.find_mentions, content) or
+            re.search(mention.user_group_mentions, content) or
+            possible_avatar_emails(content) or
+            possible_linked_stream_names(content)):
+        return None
+    # prepare_render only keeps a matcher if the content has alert words.
+    if render_db_data['alert_word_matcher'] is not None:
+        return None
+
+    realm = message_data.get_realm()
+    context = [
+        version,
+        content,
+        realm_filters_key,
+        email_gateway,
+        realm_filters,
+        render_db_data['active_realm_emoji'],
+        render_db_data['realm_uri'],
+        render_db_data['sent_by_bot'],
+        render_db_data['translate_emoticons'],
+        realm.inline_image_preview,
+        realm.inline_url_embed_preview,
+        settings.INLINE_IMAGE_PREVIEW,
+        settings.INLINE_URL_EMBED_PREVIEW,
+        settings.CAMO_URI,
+        settings.ENABLE_FILE_LINKS,
+    ]
+    return rendered_content_cache_key(make_safe_digest(ujson.dumps(context, sort_keys=True)))
+
+def render_jobs_with_cache(render_jobs: List[RenderJob]) -> List[Any]:
+    """Like run_render_jobs, but only renders the messages whose
+    rendering isn't in the cache, and caches the new ones it can."""
+    cache_keys = [get_render_cache_key(render_job) for render_job in render_jobs]
+    cached = cache_get_many([key for key in cache_keys if key is not None])
+
+    results = [None] * len(render_jobs)  # type: List[Any]
+    uncached_indexes = []  # type: List[int]
+    for index, (render_job, key) in enumerate(zip(render_jobs, cache_keys)):
+        if key is not None and key in cached:
+            # Having no mentions, alert words or links to preview, a
+            # message we get from the cache needs no message_data.
+            results[index] = (cached[key], render_job[4])
+        else:
+            uncached_indexes.append(index)
+
+    uncached_results = run_render_jobs([render_jobs[index] for index in uncached_indexes])
+    to_cache = {}  # type: Dict[str, str]
+    for index, result in zip(uncached_indexes, uncached_results):
+        results[index] = result
+        key = cache_keys[index]
+        if key is None or isinstance(result, Exception):
+            continue
+        rendered_content, message_data = result
+        if (message_data.cacheable and not message_data.links_for_preview and
+                len(rendered_content) <= MAX_MESSAGE_LENGTH * 10):
+            to_cache[key] = rendered_content
+    if to_cache:
+        cache_set_many(to_cache, timeout=3600*24)
+    return results
+
+def do_convert_many(requests: Sequence[Dict[str, Any]]) -> List[str]:
+    """Like do_convert, for a list of dicts of its arguments.  The
+    messages are rendered in parallel when the render pool is enabled."""
+    render_jobs = [prepare_render(**request) for request in requests]
+    results = render_jobs_with_cache(render_jobs)
+    return [finish_render(request['content'], request.get('message'), result)
+            for request, result in zip(requests, results)]
+
+def do_convert(content: str,
+               message: Optional[Message]=None,
+               message_realm: Optional[Realm]=None,
+               alert_word_matcher: Optional[AlertWordMatcher]=None,
+               alert_word_user_ids: Optional[Set[int]]=None,
+               sent_by_bot: Optional[bool]=False,
+               mention_data: Optional[MentionData]=None,
+               email_gateway: Optional[bool]=False) -> str:
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    [rendered_content] = do_convert_many([dict(
+        content=content,
+        message=message,
+        message_realm=message_realm,
+        alert_word_matcher=alert_word_matcher,
+        alert_word_user_ids=alert_word_user_ids,
+        sent_by_bot=sent_by_bot,
+        mention_data=mention_data,
+        email_gateway=email_gateway,
+    )])
+    return rendered_content
 
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
@@ -1988,22 +2186,30 @@ def bugdown_stats_start() -> None:
     global bugdown_time_start
     bugdown_time_start = time.time()
 
-def bugdown_stats_finish() -> None:
+def bugdown_stats_finish(requests: int=1) -> None:
     global bugdown_total_time
     global bugdown_total_requests
     global bugdown_time_start
-    bugdown_total_requests += 1
+    bugdown_total_requests += requests
     bugdown_total_time += (time.time() - bugdown_time_start)
 
 def convert(content: str,
             message: Optional[Message]=None,
             message_realm: Optional[Realm]=None,
-            possible_words: Optional[Set[str]]=None,
+            alert_word_matcher: Optional[AlertWordMatcher]=None,
+            alert_word_user_ids: Optional[Set[int]]=None,
             sent_by_bot: Optional[bool]=False,
             mention_data: Optional[MentionData]=None,
             email_gateway: Optional[bool]=False) -> str:
     bugdown_stats_start()
     ret = do_convert(content, message, message_realm,
-                     possible_words, sent_by_bot, mention_data, email_gateway)
+                     alert_word_matcher, alert_word_user_ids,
+                     sent_by_bot, mention_data, email_gateway)
     bugdown_stats_finish()
     return ret
+
+def convert_many(requests: Sequence[Dict[str, Any]]) -> List[str]:
+    bugdown_stats_start()
+    ret = do_convert_many(requests)
+    bugdown_stats_finish(len(requests))
+    return ret
@@ -1,5 +1,6 @@
 from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple
 
+from zerver.lib.cache import bump_realm_mention_index_version, bump_realm_state_version
 from zerver.lib.initial_password import initial_password
 from zerver.models import Realm, Stream, UserProfile, Huddle, \
     Subscription, Recipient, Client, RealmAuditLog, get_huddle_hash
@@ -29,6 +30,8 @@ def bulk_create_users(realm: Realm,
                                       enter_sends=True)
         profiles_to_create.append(profile)
     UserProfile.objects.bulk_create(profiles_to_create)
+    bump_realm_mention_index_version(realm.id)
+    bump_realm_state_version(realm.id)
 
     RealmAuditLog.objects.bulk_create(
         [RealmAuditLog(realm=realm, modified_user=profile_,
@@ -92,6 +95,7 @@ def bulk_create_streams(realm: Realm,
     # for python 3.3 and later versions.
     streams_to_create.sort(key=lambda x: x.name)
     Stream.objects.bulk_create(streams_to_create)
+    bump_realm_mention_index_version(realm.id)
 
     recipients_to_create = []  # type: List[Recipient]
     for stream in Stream.objects.filter(realm=realm).values('id', 'name'):
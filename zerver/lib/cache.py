@@ -1,10 +1,12 @@
 
+from collections import OrderedDict
 from functools import wraps
 
 from django.utils.lru_cache import lru_cache
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
@@ -18,6 +20,7 @@ import random
 import sys
 import os
 import hashlib
+import pickle
 
 if False:
     from zerver.models import UserProfile, Realm, Message
@@ -51,6 +54,137 @@ def remote_cache_stats_finish() -> None:
     remote_cache_total_requests += 1
     remote_cache_total_time += (time.time() - remote_cache_time_start)
 
+# A process-local ("L1") cache in front of the remote cache, for the
+# hot key families that rarely change, mapping each family (the part
+# of the key before the first ':') to how long we keep its values.
+#
+# Deleting or setting a key in one of these families, which is how all
+# the flush_* functions below invalidate, drops it from this process's
+# L1 cache and bumps a per-family generation counter in the remote
+# cache.  Other processes fetch those counters (in one get_many) the
+# first time they use their L1 cache in each request or queue event,
+# and drop the families whose counters changed.  Code outside of
+# requests and queue workers revalidates every
+# LOCAL_CACHE_MAX_STALENESS_SECS.
+LOCAL_CACHE_TIMEOUTS = {
+    'get_realm': 300,
+    'realm_alert_words': 600,
+    'stream_by_realm_and_name': 60,
+    'user_id_by_api_key': 60,
+}  # type: Dict[str, int]
+LOCAL_CACHE_MAX_ENTRIES = 10000
+LOCAL_CACHE_MAX_STALENESS_SECS = 5
+
+# Maps KEY_PREFIX + key to (expiry time, pickled value).  We store
+# values pickled, like the remote cache does, so that callers never
+# share (and mutate) the same object.  Values that are expensive to
+# build, never mutated and not picklable (e.g. compiled matchers) are
+# stored as a bare (value,) tuple instead; see local_cache_set.
+local_cache = OrderedDict()  # type: OrderedDict[str, Tuple[float, Union[bytes, Tuple[Any]]]]
+local_cache_generations = {}  # type: Dict[str, Any]
+local_cache_validated_at = None  # type: Optional[float]
+
+local_cache_total_hits = 0
+local_cache_total_misses = 0
+
+def get_local_cache_hits() -> int:
+    return local_cache_total_hits
+
+def get_local_cache_misses() -> int:
+    return local_cache_total_misses
+
+def get_local_cache_family(key: str) -> Optional[str]:
+    family = key.split(':', 1)[0]
+    if family in LOCAL_CACHE_TIMEOUTS:
+        return family
+    return None
+
+def local_cache_generation_key(family: str) -> str:
+    return "local_cache_generation:%s" % (family,)
+
+def expire_local_cache_validation() -> None:
+    '''Called at the start of each request and queue event.'''
+    global local_cache_validated_at
+    local_cache_validated_at = None
+
+def drop_local_cache_families(families: Iterable[str]) -> None:
+    families = set(families)
+    for key in [key for key in local_cache
+                if get_local_cache_family(key[len(KEY_PREFIX):]) in families]:
+        del local_cache[key]
+
+def validate_local_cache() -> None:
+    global local_cache_validated_at
+    now = time.time()
+    if (local_cache_validated_at is not None and
+            now - local_cache_validated_at < LOCAL_CACHE_MAX_STALENESS_SECS):
+        return
+
+    generations = cache_get_many([local_cache_generation_key(family)
+                                  for family in LOCAL_CACHE_TIMEOUTS])
+    changed_families = []
+    for family in LOCAL_CACHE_TIMEOUTS:
+        generation = generations.get(local_cache_generation_key(family))
+        if local_cache_generations.get(family) != generation:
+            changed_families.append(family)
+        local_cache_generations[family] = generation
+    drop_local_cache_families(changed_families)
+    local_cache_validated_at = now
+
+def local_cache_get(key: str) -> Any:
+    global local_cache_total_hits
+    global local_cache_total_misses
+    validate_local_cache()
+    entry = local_cache.get(KEY_PREFIX + key)
+    if entry is None or entry[0] < time.time():
+        local_cache_total_misses += 1
+        return None
+    local_cache.move_to_end(KEY_PREFIX + key)
+    local_cache_total_hits += 1
+    if isinstance(entry[1], bytes):
+        return pickle.loads(entry[1])
+    return entry[1]
+
+def local_cache_set(key: str, val: Any, family: str, pickled: bool=True) -> None:
+    if pickled:
+        data = pickle.dumps((val,))  # type: Union[bytes, Tuple[Any]]
+    else:
+        data = (val,)
+    local_cache[KEY_PREFIX + key] = (time.time() + LOCAL_CACHE_TIMEOUTS[family], data)
+    local_cache.move_to_end(KEY_PREFIX + key)
+    while len(local_cache) > LOCAL_CACHE_MAX_ENTRIES:
+        local_cache.popitem(last=False)
+
+def invalidate_local_cache(keys: Iterable[str]) -> None:
+    families = set()  # type: Set[str]
+    for key in keys:
+        family = get_local_cache_family(key)
+        if family is not None:
+            local_cache.pop(KEY_PREFIX + key, None)
+            families.add(family)
+    if families:
+        bump_local_cache_generations(families)
+
+def bump_local_cache_generations(families: Iterable[str]) -> None:
+    '''Makes every process drop the given families from its L1 cache.'''
+    drop_local_cache_families(families)
+    for family in families:
+        remote_cache_bump_counter(local_cache_generation_key(family))
+
+def remote_cache_bump_counter(key: str) -> int:
+    '''Increments a counter that never expires, creating it if needed,
+    and returns its new value.'''
+    cache_backend = get_cache_backend(None)
+    remote_cache_stats_start()
+    try:
+        value = cache_backend.incr(KEY_PREFIX + key)
+    except ValueError:
+        # add() is a no-op if another process just created it.
+        cache_backend.add(KEY_PREFIX + key, 0, timeout=None)
+        value = cache_backend.incr(KEY_PREFIX + key)
+    remote_cache_stats_finish()
+    return value
+
 def get_or_create_key_prefix() -> str:
     if settings.CASPER_TESTS:
         # This sets the prefix for the benefit of the Casper tests.
@@ -145,12 +279,21 @@ def cache_with_key(
         def func_with_caching(*args: Any, **kwargs: Any) -> ReturnT:
             key = keyfunc(*args, **kwargs)
 
-            val = cache_get(key, cache_name=cache_name)
-
             extra = ""
             if cache_name == 'database':
                 extra = ".dbcache"
 
+            local_family = None
+            if cache_name is None:
+                local_family = get_local_cache_family(key)
+            if local_family is not None:
+                val = local_cache_get(key)
+                if val is not None:
+                    statsd.incr("cache%s.%s.local_hit" % (extra, local_family))
+                    return val[0]
+
+            val = cache_get(key, cache_name=cache_name)
+
             if with_statsd_key is not None:
                 metric_key = with_statsd_key
             else:
@@ -162,11 +305,15 @@ def cache_with_key(
             # Values are singleton tuples so that we can distinguish
             # a result of None from a missing key.
             if val is not None:
+                if local_family is not None:
+                    local_cache_set(key, val[0], local_family)
                 return val[0]
 
             val = func(*args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            remote_cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            if local_family is not None:
+                local_cache_set(key, val, local_family)
 
             return val
 
@@ -174,7 +321,43 @@ def cache_with_key(
 
     return decorator
 
+def local_cache_with_key(
+        keyfunc: Callable[..., str], pickled: bool=True
+) -> Callable[[Callable[..., ReturnT]], Callable[..., ReturnT]]:
+    """Decorator which caches a function's results in the process-local
+       cache only, for cheap lookups that every request does anyway.
+       The keys must be in a family in LOCAL_CACHE_TIMEOUTS, and
+       callers invalidate them with bump_local_cache_generations.
+       With pickled=False, every caller shares the same object, so
+       it must never be mutated."""
+
+    def decorator(func: Callable[..., ReturnT]) -> Callable[..., ReturnT]:
+        @wraps(func)
+        def func_with_caching(*args: Any, **kwargs: Any) -> ReturnT:
+            key = keyfunc(*args, **kwargs)
+            family = get_local_cache_family(key)
+            assert family is not None
+
+            val = local_cache_get(key)
+            if val is not None:
+                return val[0]
+
+            val = func(*args, **kwargs)
+            local_cache_set(key, val, family, pickled=pickled)
+            return val
+
+        return func_with_caching
+
+    return decorator
+
 def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> None:
+    if cache_name is None:
+        invalidate_local_cache([key])
+    remote_cache_set(key, val, cache_name=cache_name, timeout=timeout)
+
+def remote_cache_set(key: str, val: Any, cache_name: Optional[str]=None,
+                     timeout: Optional[int]=None) -> None:
+    '''Like cache_set, but for filling the cache rather than changing it.'''
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
@@ -196,6 +379,13 @@ def cache_get_many(keys: List[str], cache_name: Optional[str]=None) -> Dict[str,
 
 def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
                    timeout: Optional[int]=None) -> None:
+    if cache_name is None:
+        invalidate_local_cache(items.keys())
+    remote_cache_set_many(items, cache_name=cache_name, timeout=timeout)
+
+def remote_cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
+                          timeout: Optional[int]=None) -> None:
+    '''Like cache_set_many, but for filling the cache rather than changing it.'''
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
@@ -205,11 +395,16 @@ def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
     remote_cache_stats_finish()
 
 def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
+    if cache_name is None:
+        invalidate_local_cache([key])
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
 
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    items = list(items)
+    if cache_name is None:
+        invalidate_local_cache(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
@@ -274,7 +469,7 @@ def generic_bulk_cached_fetch(
         items_for_remote_cache[key] = (setter(item),)
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+        remote_cache_set_many(items_for_remote_cache)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -315,8 +510,8 @@ def bot_profile_cache_key(email: str) -> str:
 def user_profile_by_id_cache_key(user_profile_id: int) -> str:
     return "user_profile_by_id:%s" % (user_profile_id,)
 
-def user_profile_by_api_key_cache_key(api_key: str) -> str:
-    return "user_profile_by_api_key:%s" % (api_key,)
+def user_id_by_api_key_cache_key(api_key: str) -> str:
+    return "user_id_by_api_key:%s" % (api_key,)
 
 realm_user_dict_fields = [
     'id', 'full_name', 'short_name', 'email',
@@ -325,6 +520,9 @@ realm_user_dict_fields = [
     'date_joined'
 ]  # type: List[str]
 
+def realm_streams_traffic_cache_key(realm_id: int) -> str:
+    return "realm_streams_traffic:%s" % (realm_id,)
+
 def realm_user_dicts_cache_key(realm_id: int) -> str:
     return "realm_user_dicts:%s" % (realm_id,)
 
@@ -349,12 +547,19 @@ def get_stream_cache_key(stream_name: str, realm_id: int) -> str:
     return "stream_by_realm_and_name:%s:%s" % (
         realm_id, make_safe_digest(stream_name.strip().lower()))
 
-def delete_user_profile_caches(user_profiles: Iterable['UserProfile']) -> None:
+def delete_user_profile_caches(user_profiles: Iterable['UserProfile'],
+                               api_key_changed: bool=True) -> None:
+    '''
+    The API key cache only maps each key to its user's id, so saves
+    that don't change api_key can leave it be, rather than making every
+    process drop its whole user_id_by_api_key L1 family.
+    '''
     keys = []
     for user_profile in user_profiles:
         keys.append(user_profile_by_email_cache_key(user_profile.email))
         keys.append(user_profile_by_id_cache_key(user_profile.id))
-        keys.append(user_profile_by_api_key_cache_key(user_profile.api_key))
+        if api_key_changed:
+            keys.append(user_id_by_api_key_cache_key(user_profile.api_key))
         keys.append(user_profile_cache_key(user_profile.email, user_profile.realm))
 
     cache_delete_many(keys)
@@ -366,11 +571,35 @@ def delete_display_recipient_cache(user_profile: 'UserProfile') -> None:
     keys = [display_recipient_cache_key(rid) for rid in recipient_ids]
     cache_delete_many(keys)
 
+def stream_subscribers_cache_key(recipient_id: int) -> str:
+    return "stream_subscribers:%s" % (recipient_id,)
+
+def stream_subscribers_version_cache_key(recipient_id: int) -> str:
+    return "stream_subscribers_version:%s" % (recipient_id,)
+
+def invalidate_stream_subscribers(recipient_ids: Iterable[int]) -> None:
+    '''Makes the cached subscriber lists of the streams stale; each list
+    is stamped with its stream's version when it's fetched (see
+    zerver.lib.actions.bulk_get_subscriber_user_ids), so a fetch that
+    raced with the change can't put an old list back.'''
+    keys = [stream_subscribers_version_cache_key(recipient_id)
+            for recipient_id in recipient_ids]
+    for key in keys:
+        remote_cache_bump_counter(key)
+    if keys and transaction.get_connection().in_atomic_block:
+        # Someone could fetch the lists before our transaction
+        # commits, so bump again once it has.
+        transaction.on_commit(lambda: [remote_cache_bump_counter(key) for key in keys])
+
+def delete_stream_subscribers_caches(user_profile: 'UserProfile') -> None:
+    from zerver.models import Subscription  # We need to import here to avoid cyclic dependency.
+    recipient_ids = Subscription.objects.filter(user_profile=user_profile, active=True)
+    invalidate_stream_subscribers(recipient_ids.values_list('recipient_id', flat=True))
+
 # Called by models.py to flush the user_profile cache whenever we save
 # a user_profile object
 def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     user_profile = kwargs['instance']
-    delete_user_profile_caches([user_profile])
 
     def changed(fields: List[str]) -> bool:
         if kwargs.get('update_fields') is None:
@@ -384,10 +613,13 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
 
         return False
 
+    delete_user_profile_caches([user_profile], api_key_changed=changed(['api_key']))
+
     # Invalidate our active_users_in_realm info dict if any user has changed
     # the fields in the dict or become (in)active
     if changed(realm_user_dict_fields):
         cache_delete(realm_user_dicts_cache_key(user_profile.realm_id))
+        bump_realm_state_version(user_profile.realm_id)
 
     if changed(['is_active']):
         cache_delete(active_user_ids_cache_key(user_profile.realm_id))
@@ -399,6 +631,16 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
     if changed(['email', 'full_name', 'short_name', 'id', 'is_mirror_dummy']):
         delete_display_recipient_cache(user_profile)
 
+    # New users don't have any subscriptions yet.
+    if changed(['is_active']) and not kwargs.get('created'):
+        delete_stream_subscribers_caches(user_profile)
+
+    if changed(['email', 'full_name', 'is_active']):
+        bump_realm_mention_index_version(user_profile.realm_id)
+
+    if changed(['email', 'is_active', 'enable_offline_push_notifications']):
+        cache_delete(realm_presence_snapshot_cache_key(user_profile.realm_id))
+
     # Invalidate our bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
     if user_profile.is_bot and changed(bot_dict_fields):
@@ -415,7 +657,8 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
 def flush_realm(sender: Any, **kwargs: Any) -> None:
     realm = kwargs['instance']
     users = realm.get_active_users()
-    delete_user_profile_caches(users)
+    delete_user_profile_caches(users, api_key_changed=False)
+    flush_realm_local_cache(sender, **kwargs)
 
     # Deleting realm or updating message_visibility_limit
     # attribute should clear the first_visible_message_id cache.
@@ -429,9 +672,72 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(realm_alert_words_cache_key(realm))
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
 
+def get_realm_cache_key(string_id: str) -> str:
+    return "get_realm:%s" % (make_safe_digest(string_id),)
+
+# get_realm is only cached locally, and keyed on a field that can
+# change, so we invalidate all of it when any realm changes.
+def flush_realm_local_cache(sender: Any, **kwargs: Any) -> None:
+    bump_local_cache_generations(['get_realm'])
+
 def realm_alert_words_cache_key(realm: 'Realm') -> str:
     return "realm_alert_words:%s" % (realm.string_id,)
 
+def realm_alert_word_matcher_cache_key(realm: 'Realm') -> str:
+    # In the realm_alert_words family, so that flushing
+    # realm_alert_words_cache_key rebuilds the matcher too.
+    return "realm_alert_words:matcher:%s" % (realm.string_id,)
+
+def rendered_content_cache_key(context_digest: str) -> str:
+    return "rendered_content:%s" % (context_digest,)
+
+def realm_mention_index_version_cache_key(realm_id: int) -> str:
+    return "realm_mention_index_version:%s" % (realm_id,)
+
+def bump_realm_mention_index_version(realm_id: int) -> None:
+    '''Makes every process rebuild its zerver.lib.mention_index index
+    for the realm.'''
+    remote_cache_bump_counter(realm_mention_index_version_cache_key(realm_id))
+
+def realm_state_cache_key(realm_id: int, section: str) -> str:
+    return "realm_state:%s:%s" % (realm_id, section)
+
+def realm_state_version_cache_key(realm_id: int) -> str:
+    return "realm_state_version:%s" % (realm_id,)
+
+def bump_realm_state_version(realm_id: int) -> None:
+    '''Makes the next /register in the realm rebuild the realm-wide
+    sections of its initial state; see zerver.lib.events.'''
+    key = realm_state_version_cache_key(realm_id)
+    remote_cache_bump_counter(key)
+    if transaction.get_connection().in_atomic_block:
+        # Someone could rebuild the sections before our transaction
+        # commits, so bump again once it has.
+        transaction.on_commit(lambda: remote_cache_bump_counter(key))
+
+def unread_index_cache_key(user_profile_id: int) -> str:
+    return "unread_index:%s" % (user_profile_id,)
+
+def unread_index_version_cache_key(user_profile_id: int) -> str:
+    return "unread_index_version:%s" % (user_profile_id,)
+
+def invalidate_unread_indexes(user_profile_ids: Iterable[int]) -> None:
+    '''Makes the next read of each user's zerver.lib.unread_index index
+    rebuild it from the database.'''
+    keys = []  # type: List[str]
+    for user_profile_id in user_profile_ids:
+        # Deleting the version counter would restart it, and a process
+        # that is still writing an index it built from before our
+        # change could then find its version current again; so we
+        # bump it instead.
+        remote_cache_bump_counter(unread_index_version_cache_key(user_profile_id))
+        keys.append(unread_index_cache_key(user_profile_id))
+    if keys:
+        cache_delete_many(keys)
+
+def realm_presence_snapshot_cache_key(realm_id: int) -> str:
+    return "realm_presence_snapshot:%s" % (realm_id,)
+
 def realm_first_visible_message_id_cache_key(realm: 'Realm') -> str:
     return u"realm_first_visible_message_id:%s" % (realm.string_id,)
 
@@ -444,12 +750,49 @@ def flush_stream(sender: Any, **kwargs: Any) -> None:
     items_for_remote_cache[get_stream_cache_key(stream.name, stream.realm_id)] = (stream,)
     cache_set_many(items_for_remote_cache)
 
+    if kwargs.get('update_fields') is None or \
+            'name' in kwargs['update_fields'] or 'deactivated' in kwargs['update_fields']:
+        bump_realm_mention_index_version(stream.realm_id)
+
+    # The default streams in the initial state carry their properties.
+    bump_realm_state_version(stream.realm_id)
+
     if kwargs.get('update_fields') is None or 'name' in kwargs['update_fields'] and \
        UserProfile.objects.filter(
            Q(default_sending_stream=stream) |
            Q(default_events_register_stream=stream)).exists():
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
+def flush_user_group(sender: Any, **kwargs: Any) -> None:
+    user_group = kwargs['instance']
+    bump_realm_mention_index_version(user_group.realm_id)
+    bump_realm_state_version(user_group.realm_id)
+
+# Called by models.py when a row that the realm-wide sections of the
+# initial state are built from is saved or deleted.
+def flush_realm_state(sender: Any, **kwargs: Any) -> None:
+    bump_realm_state_version(kwargs['instance'].realm_id)
+
+# Called by models.py when UserMessage rows are saved individually;
+# the bulk updates to their flags update unread indexes themselves.
+def flush_user_message(sender: Any, **kwargs: Any) -> None:
+    invalidate_unread_indexes([kwargs['instance'].user_profile_id])
+
+# Called by models.py when a Subscription is saved or deleted; the bulk
+# operations in zerver.lib.actions invalidate the lists themselves.
+def flush_subscription(sender: Any, **kwargs: Any) -> None:
+    update_fields = kwargs.get('update_fields')
+    if update_fields is None or 'active' in update_fields:
+        invalidate_stream_subscribers([kwargs['instance'].recipient_id])
+
+# Called by models.py when UserPresence rows are saved or deleted
+# directly, rather than by do_update_user_presence_many, which updates
+# the realm's presence snapshot itself.
+def flush_user_presence(sender: Any, **kwargs: Any) -> None:
+    from zerver.models import get_user_profile_by_id
+    user_profile = get_user_profile_by_id(kwargs['instance'].user_profile_id)
+    cache_delete(realm_presence_snapshot_cache_key(user_profile.realm_id))
+
 def to_dict_cache_key_id(message_id: int) -> str:
     return 'message_dict:%d' % (message_id,)
 
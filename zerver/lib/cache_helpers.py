@@ -9,7 +9,7 @@ from zerver.models import Message, UserProfile, Stream, get_stream_cache_key, \
     Recipient, get_recipient_cache_key, Client, get_client_cache_key, \
     Huddle, huddle_hash_cache_key
 from zerver.lib.cache import cache_with_key, cache_set, \
-    user_profile_by_api_key_cache_key, \
+    user_id_by_api_key_cache_key, \
     user_profile_by_email_cache_key, \
     user_profile_by_id_cache_key, \
     user_profile_cache_key, get_remote_cache_time, get_remote_cache_requests, \
@@ -40,11 +40,11 @@ def message_cache_items(items_for_remote_cache: Dict[str, Tuple[bytes]],
     value = MessageDict.to_dict_uncached(message)
     items_for_remote_cache[key] = (value,)
 
-def user_cache_items(items_for_remote_cache: Dict[str, Tuple[UserProfile]],
+def user_cache_items(items_for_remote_cache: Dict[str, Tuple[Any]],
                      user_profile: UserProfile) -> None:
     items_for_remote_cache[user_profile_by_email_cache_key(user_profile.email)] = (user_profile,)
     items_for_remote_cache[user_profile_by_id_cache_key(user_profile.id)] = (user_profile,)
-    items_for_remote_cache[user_profile_by_api_key_cache_key(user_profile.api_key)] = (user_profile,)
+    items_for_remote_cache[user_id_by_api_key_cache_key(user_profile.api_key)] = (user_profile.id,)
     items_for_remote_cache[user_profile_cache_key(user_profile.email, user_profile.realm)] = (user_profile,)
 
 def stream_cache_items(items_for_remote_cache: Dict[str, Tuple[Stream]],
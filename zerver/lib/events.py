@@ -18,6 +18,8 @@ from zerver.lib.alert_words import user_alert_words
 from zerver.lib.attachments import user_attachments
 from zerver.lib.avatar import avatar_url, get_avatar_field
 from zerver.lib.bot_config import load_bot_config_template
+from zerver.lib.cache import cache_get_many, realm_state_cache_key, \
+    realm_state_version_cache_key, remote_cache_set_many
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.integrations import EMBEDDED_BOTS
 from zerver.lib.message import (
@@ -30,7 +32,7 @@ from zerver.lib.push_notifications import push_notifications_enabled
 from zerver.lib.soft_deactivation import maybe_catch_up_soft_deactivated_user
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.request import JsonableError
-from zerver.lib.topic_mutes import get_topic_mutes
+from zerver.lib.topic_mutes import get_topic_mute_keys, get_topic_mutes
 from zerver.lib.actions import (
     validate_user_access_to_subscribers_helper,
     do_get_streams, get_default_streams_for_realm,
@@ -93,6 +95,60 @@ def get_raw_user_data(realm_id: int, client_gravatar: bool) -> Dict[int, Dict[st
         for row in user_dicts
     }
 
+# The realm-wide sections of the initial state are the same for
+# everyone in a realm, so we cache each of them in the remote cache,
+# stamped with the realm's version (see bump_realm_state_version).
+# Saving or deleting any of the rows they are built from bumps the
+# version (see the signal handlers in zerver.models, and the bulk
+# operations that skip them), so a /register just needs one cache get
+# for the version and the sections it wants, and only rebuilds the
+# sections that have gone stale.
+REALM_STATE_TIMEOUT = 24 * 3600
+
+def get_realm_state_builders(realm: Realm) -> Dict[str, Callable[[], Any]]:
+    return {
+        'custom_profile_fields': lambda: [
+            f.as_dict() for f in custom_profile_fields_for_realm(realm.id)],
+        'realm_default_stream_groups': lambda: default_stream_groups_to_dicts_sorted(
+            get_default_stream_groups(realm)),
+        'realm_default_streams': lambda: streams_to_dicts_sorted(
+            get_default_streams_for_realm(realm.id)),
+        'realm_domains': lambda: get_realm_domains(realm),
+        'realm_emoji': lambda: realm.get_emoji(),
+        'realm_filters': lambda: realm_filters_for_realm(realm.id),
+        'realm_user_groups': lambda: user_groups_in_realm_serialized(realm),
+        # Avatar URLs depend on client_gravatar.
+        'raw_users': lambda: get_raw_user_data(realm.id, client_gravatar=False),
+        'raw_users:client_gravatar': lambda: get_raw_user_data(realm.id,
+                                                               client_gravatar=True),
+    }
+
+def fetch_realm_state(realm: Realm, sections: List[str]) -> Dict[str, Any]:
+    builders = get_realm_state_builders(realm)
+    version_key = realm_state_version_cache_key(realm.id)
+    keys = {
+        section: realm_state_cache_key(realm.id, section)
+        for section in sections
+    }
+    # We read the version before building any sections, so that a
+    # change made while we build them always bumps the version past
+    # the one we stamp them with.
+    cached = cache_get_many([version_key] + list(keys.values()))
+    version = cached.get(version_key)
+
+    result = {}  # type: Dict[str, Any]
+    stale = {}  # type: Dict[str, Tuple[Optional[int], Any]]
+    for section, key in keys.items():
+        entry = cached.get(key)
+        if entry is not None and entry[0] == version:
+            result[section] = entry[1]
+        else:
+            result[section] = builders[section]()
+            stale[key] = (version, result[section])
+    if stale:
+        remote_cache_set_many(stale, timeout=REALM_STATE_TIMEOUT)
+    return result
+
 def always_want(msg_type: str) -> bool:
     '''
     This function is used as a helper in
@@ -120,12 +176,27 @@ def fetch_initial_state_data(user_profile: UserProfile,
     else:
         want = set(event_types).__contains__
 
+    raw_users_section = 'raw_users:client_gravatar' if client_gravatar else 'raw_users'
+    realm_sections = [
+        section for (event_type, section) in [
+            ('custom_profile_fields', 'custom_profile_fields'),
+            ('default_stream_groups', 'realm_default_stream_groups'),
+            ('default_streams', 'realm_default_streams'),
+            ('realm_domains', 'realm_domains'),
+            ('realm_emoji', 'realm_emoji'),
+            ('realm_filters', 'realm_filters'),
+            ('realm_user', raw_users_section),
+            ('realm_user_groups', 'realm_user_groups'),
+        ]
+        if want(event_type)
+    ]
+    realm_state = fetch_realm_state(realm, realm_sections)
+
     if want('alert_words'):
         state['alert_words'] = user_alert_words(user_profile)
 
     if want('custom_profile_fields'):
-        fields = custom_profile_fields_for_realm(realm.id)
-        state['custom_profile_fields'] = [f.as_dict() for f in fields]
+        state['custom_profile_fields'] = realm_state['custom_profile_fields']
         state['custom_profile_field_types'] = CustomProfileField.FIELD_TYPE_CHOICES
 
     if want('hotspots'):
@@ -188,22 +259,19 @@ def fetch_initial_state_data(user_profile: UserProfile,
             state['realm_signup_notifications_stream_id'] = -1
 
     if want('realm_domains'):
-        state['realm_domains'] = get_realm_domains(realm)
+        state['realm_domains'] = realm_state['realm_domains']
 
     if want('realm_emoji'):
-        state['realm_emoji'] = realm.get_emoji()
+        state['realm_emoji'] = realm_state['realm_emoji']
 
     if want('realm_filters'):
-        state['realm_filters'] = realm_filters_for_realm(realm.id)
+        state['realm_filters'] = realm_state['realm_filters']
 
     if want('realm_user_groups'):
-        state['realm_user_groups'] = user_groups_in_realm_serialized(realm)
+        state['realm_user_groups'] = realm_state['realm_user_groups']
 
     if want('realm_user'):
-        state['raw_users'] = get_raw_user_data(
-            realm_id=realm.id,
-            client_gravatar=client_gravatar,
-        )
+        state['raw_users'] = realm_state[raw_users_section]
 
         # For the user's own avatar URL, we force
         # client_gravatar=False, since that saves some unnecessary
@@ -261,11 +329,9 @@ def fetch_initial_state_data(user_profile: UserProfile,
         state['stream_name_max_length'] = Stream.MAX_NAME_LENGTH
         state['stream_description_max_length'] = Stream.MAX_DESCRIPTION_LENGTH
     if want('default_streams'):
-        state['realm_default_streams'] = streams_to_dicts_sorted(
-            get_default_streams_for_realm(realm.id))
+        state['realm_default_streams'] = realm_state['realm_default_streams']
     if want('default_stream_groups'):
-        state['realm_default_stream_groups'] = default_stream_groups_to_dicts_sorted(
-            get_default_stream_groups(realm))
+        state['realm_default_stream_groups'] = realm_state['realm_default_stream_groups']
 
     if want('update_display_settings'):
         for prop in UserProfile.property_types:
@@ -595,6 +661,8 @@ def apply_event(state: Dict[str, Any],
         state['alert_words'] = event['alert_words']
     elif event['type'] == "muted_topics":
         state['muted_topics'] = event["muted_topics"]
+        if 'raw_unread_msgs' in state:
+            state['raw_unread_msgs']['muted_topics'] = get_topic_mute_keys(user_profile)
     elif event['type'] == "realm_filters":
         state['realm_filters'] = event["realm_filters"]
     elif event['type'] == "update_display_settings":
@@ -0,0 +1,77 @@
+# A process-local index of a realm's users, streams and user groups
+# by the names messages refer to them with, so that rendering
+# mentions, avatars and stream links usually costs no database
+# queries.
+#
+# Each index is stamped with its realm's version in the remote cache
+# (see bump_realm_mention_index_version), which the flush functions
+# bump whenever something indexed changes.  Checking the version is a
+# single remote cache get; we only rebuild the index, with four
+# queries, when it has moved on.
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from zerver.lib.cache import cache_get, realm_mention_index_version_cache_key
+from zerver.models import Stream, UserGroup, UserGroupMembership, UserProfile
+
+# The most realms we keep indexes for in each process.
+MAX_REALM_MENTION_INDEXES = 100
+
+class RealmMentionIndex:
+    def __init__(self, realm_id: int) -> None:
+        # Bugdown looks users up by full name among active users, and
+        # by email among all of them.
+        self.users_by_full_name = {}  # type: Dict[str, Dict[str, Any]]
+        self.users_by_email = {}  # type: Dict[str, Dict[str, Any]]
+        rows = UserProfile.objects.filter(realm_id=realm_id).values(
+            'id', 'full_name', 'email', 'is_active')
+        for row in rows:
+            self.users_by_email[row['email'].strip().lower()] = dict(
+                id=row['id'],
+                email=row['email'],
+            )
+            if row['is_active']:
+                self.users_by_full_name[row['full_name'].lower()] = dict(
+                    id=row['id'],
+                    full_name=row['full_name'],
+                    email=row['email'],
+                )
+
+        self.streams_by_name = {
+            row['name']: row
+            for row in Stream.objects.filter(realm_id=realm_id, deactivated=False).values(
+                'id', 'name')
+        }  # type: Dict[str, Dict[str, Any]]
+
+        self.user_groups_by_name = {
+            user_group.name: user_group
+            for user_group in UserGroup.objects.filter(realm_id=realm_id)
+        }  # type: Dict[str, UserGroup]
+        self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
+        membership = UserGroupMembership.objects.filter(user_group__realm_id=realm_id)
+        for user_group_id, user_profile_id in membership.values_list('user_group_id',
+                                                                     'user_profile_id'):
+            self.user_group_members[user_group_id].append(user_profile_id)
+
+# realm id -> (version, index)
+realm_mention_indexes = OrderedDict()  # type: OrderedDict[int, Tuple[Optional[int], RealmMentionIndex]]
+
+def get_realm_mention_index(realm_id: int) -> RealmMentionIndex:
+    # We read the version before building the index, so that a change
+    # made while we build it always bumps the version past ours.
+    version = cache_get(realm_mention_index_version_cache_key(realm_id))
+
+    entry = realm_mention_indexes.get(realm_id)
+    if entry is not None and entry[0] == version:
+        realm_mention_indexes.move_to_end(realm_id)
+        return entry[1]
+
+    index = RealmMentionIndex(realm_id)
+    realm_mention_indexes[realm_id] = (version, index)
+    realm_mention_indexes.move_to_end(realm_id)
+    while len(realm_mention_indexes) > MAX_REALM_MENTION_INDEXES:
+        realm_mention_indexes.popitem(last=False)
+    return index
+
+def clear_realm_mention_indexes_for_testing() -> None:
+    realm_mention_indexes.clear()
@@ -1,5 +1,7 @@
 
 import datetime
+from collections import defaultdict
+import heapq
 import ujson
 import zlib
 
@@ -10,6 +12,7 @@ from django.db.models import Sum
 from analytics.lib.counts import COUNT_STATS, RealmCount
 
 from zerver.lib.avatar import get_avatar_field
+from zerver.lib.alert_words import AlertWordMatcher
 import zerver.lib.bugdown as bugdown
 from zerver.lib.cache import (
     cache_with_key,
@@ -25,8 +28,10 @@ from zerver.lib.stream_subscription import (
 )
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.topic_mutes import (
-    build_topic_mute_checker,
-    topic_is_muted,
+    get_topic_mute_keys,
+)
+from zerver.lib.unread_index import (
+    get_unread_index,
 )
 
 from zerver.models import (
@@ -55,7 +60,10 @@ RawUnreadMessagesResult = TypedDict('RawUnreadMessagesResult', {
     'huddle_dict': Dict[int, Any],
     'mentions': Set[int],
     'muted_stream_ids': List[int],
+    'muted_topics': Set[Tuple[int, str]],
     'unmuted_stream_msgs': Set[int],
+    'unlisted_counts': Dict[Tuple[Any, ...], int],
+    'unlisted_count': int,
 })
 
 UnreadMessagesResult = TypedDict('UnreadMessagesResult', {
@@ -66,6 +74,8 @@ UnreadMessagesResult = TypedDict('UnreadMessagesResult', {
     'count': int,
 })
 
+# The most unread message ids we list in /register; we send the
+# numbers of the older ones instead.
 MAX_UNREAD_MESSAGES = 5000
 
 def messages_for_ids(message_ids: List[int],
@@ -529,18 +539,15 @@ def access_message(user_profile: UserProfile, message_id: int) -> Tuple[Message,
             pass
     return (message, user_message)
 
-def render_markdown(message: Message,
-                    content: str,
-                    realm: Optional[Realm]=None,
-                    realm_alert_words: Optional[RealmAlertWords]=None,
-                    user_ids: Optional[Set[int]]=None,
-                    mention_data: Optional[bugdown.MentionData]=None,
-                    email_gateway: Optional[bool]=False) -> str:
-    """Return HTML for given markdown. Bugdown may add properties to the
-    message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
-    `mentions_wildcard`.  These are only on this Django object and are not
-    saved in the database.
-    """
+def markdown_convert_args(message: Message,
+                          content: str,
+                          realm: Optional[Realm]=None,
+                          realm_alert_words: Optional[RealmAlertWords]=None,
+                          user_ids: Optional[Set[int]]=None,
+                          alert_word_matcher: Optional[AlertWordMatcher]=None,
+                          mention_data: Optional[bugdown.MentionData]=None,
+                          email_gateway: Optional[bool]=False) -> Dict[str, Any]:
+    """Returns the arguments to bugdown.convert for render_markdown."""
 
     if user_ids is None:
         message_user_ids = set()  # type: Set[int]
@@ -551,40 +558,59 @@ def render_markdown(message: Message,
     message.mentions_user_ids = set()
     message.mentions_user_group_ids = set()
     message.alert_words = set()
+    message.user_ids_with_alert_words = set()
     message.links_for_preview = set()
 
     if realm is None:
         realm = message.get_realm()
 
-    possible_words = set()  # type: Set[str]
-    if realm_alert_words is not None:
-        for user_id, words in realm_alert_words.items():
-            if user_id in message_user_ids:
-                possible_words.update(set(words))
+    if alert_word_matcher is None and realm_alert_words is not None:
+        alert_word_matcher = AlertWordMatcher(realm_alert_words)
 
     sent_by_bot = get_user_profile_by_id(message.sender_id).is_bot
 
-    # DO MAIN WORK HERE -- call bugdown to convert
-    rendered_content = bugdown.convert(
-        content,
+    return dict(
+        content=content,
         message=message,
         message_realm=realm,
-        possible_words=possible_words,
+        alert_word_matcher=alert_word_matcher,
+        alert_word_user_ids=message_user_ids,
         sent_by_bot=sent_by_bot,
         mention_data=mention_data,
-        email_gateway=email_gateway
+        email_gateway=email_gateway,
     )
 
-    if message is not None:
-        message.user_ids_with_alert_words = set()
+def render_markdown(message: Message,
+                    content: str,
+                    realm: Optional[Realm]=None,
+                    realm_alert_words: Optional[RealmAlertWords]=None,
+                    user_ids: Optional[Set[int]]=None,
+                    alert_word_matcher: Optional[AlertWordMatcher]=None,
+                    mention_data: Optional[bugdown.MentionData]=None,
+                    email_gateway: Optional[bool]=False) -> str:
+    """Return HTML for given markdown. Bugdown may add properties to the
+    message object such as `mentions_user_ids`, `mentions_user_group_ids`, and
+    `mentions_wildcard`.  These are only on this Django object and are not
+    saved in the database.
+    """
 
-        if realm_alert_words is not None:
-            for user_id, words in realm_alert_words.items():
-                if user_id in message_user_ids:
-                    if set(words).intersection(message.alert_words):
-                        message.user_ids_with_alert_words.add(user_id)
+    # DO MAIN WORK HERE -- call bugdown to convert
+    return bugdown.convert(**markdown_convert_args(
+        message,
+        content,
+        realm=realm,
+        realm_alert_words=realm_alert_words,
+        user_ids=user_ids,
+        alert_word_matcher=alert_word_matcher,
+        mention_data=mention_data,
+        email_gateway=email_gateway,
+    ))
 
-    return rendered_content
+def render_markdown_many(requests: List[Dict[str, Any]]) -> List[str]:
+    """Like render_markdown, for a list of dicts of its arguments.  With
+    the bugdown render pool enabled, the messages render in parallel."""
+    return bugdown.convert_many([markdown_convert_args(**request)
+                                 for request in requests])
 
 def huddle_users(recipient_id: int) -> str:
     display_recipient = get_display_recipient_by_id(recipient_id,
@@ -600,7 +626,8 @@ def huddle_users(recipient_id: int) -> str:
 
 def aggregate_message_dict(input_dict: Dict[int, Dict[str, Any]],
                            lookup_fields: List[str],
-                           collect_senders: bool) -> List[Dict[str, Any]]:
+                           collect_senders: bool,
+                           unlisted_counts: Dict[Tuple[Any, ...], int]) -> List[Dict[str, Any]]:
     lookup_dict = dict()  # type: Dict[Tuple[Any, ...], Dict[str, Any]]
 
     '''
@@ -614,6 +641,10 @@ def aggregate_message_dict(input_dict: Dict[int, Dict[str, Any]],
 
     lookup_fields = ['stream_id', 'topic']
 
+    unlisted_counts = {
+        (5, 'foo'): 10,
+    }
+
     The first time through the loop:
         attribute_dict = dict(stream_id=5, topic='foo', sender_id=40)
         lookup_dict = (5, 'foo')
@@ -630,31 +661,41 @@ def aggregate_message_dict(input_dict: Dict[int, Dict[str, Any]],
         dict(stream_id=5, topic='foo',
              unread_message_ids=[1002, 1003],
              sender_ids=[40, 41],
+             unread_count=12,
             ),
         ...
     ]
+
+    unlisted_counts has the number of unread messages in each
+    conversation that we didn't list; a conversation may have only
+    those.
     '''
 
-    for message_id, attribute_dict in input_dict.items():
-        lookup_key = tuple([attribute_dict[f] for f in lookup_fields])
+    def get_bucket(lookup_key: Tuple[Any, ...]) -> Dict[str, Any]:
         if lookup_key not in lookup_dict:
-            obj = {}
-            for f in lookup_fields:
-                obj[f] = attribute_dict[f]
+            obj = dict(zip(lookup_fields, lookup_key))  # type: Dict[str, Any]
             obj['unread_message_ids'] = []
             if collect_senders:
                 obj['sender_ids'] = set()
             lookup_dict[lookup_key] = obj
+        return lookup_dict[lookup_key]
 
-        bucket = lookup_dict[lookup_key]
+    for message_id, attribute_dict in input_dict.items():
+        lookup_key = tuple([attribute_dict[f] for f in lookup_fields])
+        bucket = get_bucket(lookup_key)
         bucket['unread_message_ids'].append(message_id)
         if collect_senders:
             bucket['sender_ids'].add(attribute_dict['sender_id'])
 
-    for dct in lookup_dict.values():
+    for lookup_key in unlisted_counts:
+        get_bucket(lookup_key)
+
+    for lookup_key, dct in lookup_dict.items():
         dct['unread_message_ids'].sort()
         if collect_senders:
             dct['sender_ids'] = sorted(list(dct['sender_ids']))
+        dct['unread_count'] = (len(dct['unread_message_ids']) +
+                               unlisted_counts.get(lookup_key, 0))
 
     sorted_keys = sorted(lookup_dict.keys())
 
@@ -687,36 +728,18 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
     excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
 
-    user_msgs = UserMessage.objects.filter(
-        user_profile=user_profile
-    ).exclude(
-        message__recipient_id__in=excluded_recipient_ids
-    ).extra(
-        where=[UserMessage.where_unread()]
-    ).values(
-        'message_id',
-        'message__sender_id',
-        'message__subject',
-        'message__recipient_id',
-        'message__recipient__type',
-        'message__recipient__type_id',
-        'flags',
-    ).order_by("-message_id")
-
-    # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
-
-    rows = list(reversed(user_msgs))
+    unread_index = get_unread_index(user_profile, excluded_recipient_ids)
+    excluded = set(excluded_recipient_ids)
 
     muted_stream_ids = get_muted_stream_ids(user_profile)
 
-    topic_mute_checker = build_topic_mute_checker(user_profile)
+    muted_topics = get_topic_mute_keys(user_profile)
 
     def is_row_muted(stream_id: int, recipient_id: int, topic: str) -> bool:
         if stream_id in muted_stream_ids:
             return True
 
-        if topic_mute_checker(recipient_id, topic):
+        if (recipient_id, topic.lower()) in muted_topics:
             return True
 
         return False
@@ -736,46 +759,90 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     unmuted_stream_msgs = set()
     huddle_dict = {}
     mentions = set()
-
-    for row in rows:
-        message_id = row['message_id']
-        msg_type = row['message__recipient__type']
-        recipient_id = row['message__recipient_id']
-        sender_id = row['message__sender_id']
+    # By ('pms', sender_id), ('streams', stream_id, topic) or
+    # ('huddles', user_ids_string), like aggregate_unread_data's
+    # output, the number of unread messages we don't list.
+    unlisted_counts = defaultdict(int)  # type: Dict[Tuple[Any, ...], int]
+    # How many of those count towards the total.
+    unlisted_count = 0
+
+    # Each conversation lists the newest of its unread messages, and
+    # counts all of them; see zerver.lib.unread_index.  We list the
+    # newest MAX_UNREAD_MESSAGES across all conversations.
+    conversations = [
+        (key, conversation)
+        for (key, conversation) in unread_index['conversations'].items()
+        if key[0] not in excluded
+    ]
+    listed_message_ids = [
+        message_id
+        for (key, conversation) in conversations
+        for message_id in conversation['messages']
+    ]
+    oldest_listed_id = 0
+    if len(listed_message_ids) > MAX_UNREAD_MESSAGES:
+        oldest_listed_id = heapq.nlargest(MAX_UNREAD_MESSAGES, listed_message_ids)[-1]
+
+    for (key, conversation) in conversations:
+        recipient_id = key[0]
+        msg_type = conversation['recipient_type']
+        messages = {
+            message_id: row
+            for (message_id, row) in conversation['messages'].items()
+            if message_id >= oldest_listed_id
+        }
+        unlisted = conversation['count'] - len(messages)
 
         if msg_type == Recipient.STREAM:
-            stream_id = row['message__recipient__type_id']
-            topic = row['message__subject']
-            stream_dict[message_id] = dict(
-                stream_id=stream_id,
-                topic=topic,
-                sender_id=sender_id,
-            )
+            stream_id = conversation['recipient_type_id']
+            topic = conversation['topic']
+            for (message_id, (sender_id, is_mentioned)) in messages.items():
+                stream_dict[message_id] = dict(
+                    stream_id=stream_id,
+                    topic=topic,
+                    sender_id=sender_id,
+                )
+            lookup_key = ('streams', stream_id, topic)  # type: Tuple[Any, ...]
             if not is_row_muted(stream_id, recipient_id, topic):
-                unmuted_stream_msgs.add(message_id)
+                unmuted_stream_msgs.update(messages)
+                unlisted_count += unlisted
 
         elif msg_type == Recipient.PERSONAL:
-            pm_dict[message_id] = dict(
-                sender_id=sender_id,
-            )
+            for (message_id, (sender_id, is_mentioned)) in messages.items():
+                pm_dict[message_id] = dict(
+                    sender_id=sender_id,
+                )
+            # Private messages are keyed by their sender; see
+            # get_conversation_key.
+            lookup_key = ('pms', key[1])
+            unlisted_count += unlisted
 
         elif msg_type == Recipient.HUDDLE:
             user_ids_string = get_huddle_users(recipient_id)
-            huddle_dict[message_id] = dict(
-                user_ids_string=user_ids_string,
-            )
-
-        is_mentioned = (row['flags'] & UserMessage.flags.mentioned) != 0
-        if is_mentioned:
+            for message_id in messages:
+                huddle_dict[message_id] = dict(
+                    user_ids_string=user_ids_string,
+                )
+            lookup_key = ('huddles', user_ids_string)
+            unlisted_count += unlisted
+
+        if unlisted:
+            unlisted_counts[lookup_key] += unlisted
+
+    for (message_id, key) in unread_index['mentions'].items():
+        if key[0] not in excluded:
             mentions.add(message_id)
 
     return dict(
         pm_dict=pm_dict,
         stream_dict=stream_dict,
         muted_stream_ids=muted_stream_ids,
+        muted_topics=muted_topics,
         unmuted_stream_msgs=unmuted_stream_msgs,
         huddle_dict=huddle_dict,
         mentions=mentions,
+        unlisted_counts=dict(unlisted_counts),
+        unlisted_count=unlisted_count,
     )
 
 def aggregate_unread_data(raw_data: RawUnreadMessagesResult) -> UnreadMessagesResult:
@@ -786,7 +853,15 @@ def aggregate_unread_data(raw_data: RawUnreadMessagesResult) -> UnreadMessagesRe
     huddle_dict = raw_data['huddle_dict']
     mentions = list(raw_data['mentions'])
 
-    count = len(pm_dict) + len(unmuted_stream_msgs) + len(huddle_dict)
+    count = (len(pm_dict) + len(unmuted_stream_msgs) + len(huddle_dict) +
+             raw_data['unlisted_count'])
+
+    def get_unlisted_counts(kind: str) -> Dict[Tuple[Any, ...], int]:
+        return {
+            key[1:]: unlisted
+            for (key, unlisted) in raw_data['unlisted_counts'].items()
+            if key[0] == kind
+        }
 
     pm_objects = aggregate_message_dict(
         input_dict=pm_dict,
@@ -794,6 +869,7 @@ def aggregate_unread_data(raw_data: RawUnreadMessagesResult) -> UnreadMessagesRe
             'sender_id',
         ],
         collect_senders=False,
+        unlisted_counts=get_unlisted_counts('pms'),
     )
 
     stream_objects = aggregate_message_dict(
@@ -803,6 +879,7 @@ def aggregate_unread_data(raw_data: RawUnreadMessagesResult) -> UnreadMessagesRe
             'topic',
         ],
         collect_senders=True,
+        unlisted_counts=get_unlisted_counts('streams'),
     )
 
     huddle_objects = aggregate_message_dict(
@@ -811,6 +888,7 @@ def aggregate_unread_data(raw_data: RawUnreadMessagesResult) -> UnreadMessagesRe
             'user_ids_string',
         ],
         collect_senders=False,
+        unlisted_counts=get_unlisted_counts('huddles'),
     )
 
     result = dict(
@@ -854,8 +932,7 @@ def apply_unread_message_event(user_profile: UserProfile,
         state['stream_dict'][message_id] = new_row
 
         if stream_id not in state['muted_stream_ids']:
-            # This next check hits the database.
-            if not topic_is_muted(user_profile, stream_id, topic):
+            if (message['recipient_id'], topic.lower()) not in state['muted_topics']:
                 state['unmuted_stream_msgs'].add(message_id)
 
     elif message_type == 'private':
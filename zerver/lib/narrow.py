@@ -1,7 +1,12 @@
 from zerver.lib.request import JsonableError
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Dict, Iterable, Mapping, Sequence
+import itertools
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+# The lowercased (stream, topic, sender) a message must have to match a
+# narrow, with None for operators the narrow doesn't use.
+NarrowIndexKey = Tuple[Optional[str], Optional[str], Optional[str]]
 
 
 def check_supported_events_narrow_filter(narrow: Iterable[Sequence[str]]) -> None:
@@ -24,24 +29,28 @@ def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[st
     BuildNarrowFilterTest."""
     check_supported_events_narrow_filter(narrow)
 
+    # Lowercase the operands up front, rather than once per event.
+    normalized_narrow = [
+        (element[0], element[1].lower() if element[0] in ["stream", "topic", "sender"] else element[1])
+        for element in narrow
+    ]
+
     def narrow_filter(event: Mapping[str, Any]) -> bool:
         message = event["message"]
         flags = event["flags"]
-        for element in narrow:
-            operator = element[0]
-            operand = element[1]
+        for operator, operand in normalized_narrow:
             if operator == "stream":
                 if message["type"] != "stream":
                     return False
-                if operand.lower() != message["display_recipient"].lower():
+                if operand != message["display_recipient"].lower():
                     return False
             elif operator == "topic":
                 if message["type"] != "stream":
                     return False
-                if operand.lower() != message["subject"].lower():
+                if operand != message["subject"].lower():
                     return False
             elif operator == "sender":
-                if operand.lower() != message["sender_email"].lower():
+                if operand != message["sender_email"].lower():
                     return False
             elif operator == "is" and operand == "private":
                 if message["type"] != "private":
@@ -58,3 +67,28 @@ def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[st
 
         return True
     return narrow_filter
+
+def narrow_index_key(narrow: Iterable[Sequence[str]]) -> NarrowIndexKey:
+    """The key under which to index a narrowed event queue, so that a
+    message only needs to be run through the narrow filters of the
+    queues under one of message_index_keys(message).  Where a narrow
+    repeats an operator, we use the first operand; the narrow filter
+    still rejects the messages the others don't match."""
+    operands = {}  # type: Dict[str, str]
+    for element in narrow:
+        if element[0] in ["stream", "topic", "sender"]:
+            operands.setdefault(element[0], element[1].lower())
+    return (operands.get("stream"), operands.get("topic"), operands.get("sender"))
+
+def message_index_keys(message: Mapping[str, Any]) -> List[NarrowIndexKey]:
+    """All the narrow_index_key values of narrows that might match message."""
+    sender = message.get("sender_email")
+    senders = [None] if sender is None else [sender.lower(), None]  # type: List[Optional[str]]
+    streams = [None]  # type: List[Optional[str]]
+    topics = [None]  # type: List[Optional[str]]
+    if message.get("type") == "stream":
+        if message.get("display_recipient") is not None:
+            streams.insert(0, message["display_recipient"].lower())
+        if message.get("subject") is not None:
+            topics.insert(0, message["subject"].lower())
+    return list(itertools.product(streams, topics, senders))
@@ -1,20 +1,27 @@
-from typing import Any, AnyStr, Iterable, Dict, Tuple, Callable, Mapping, Optional
+from typing import Any, AnyStr, Iterable, Dict, List, Tuple, Callable, Mapping, Optional
 
 import requests
 import json
 import sys
 import inspect
 import logging
+import os
 import re
+import threading
 import urllib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from requests import Response
+from requests.adapters import HTTPAdapter
 
+from django.conf import settings
 from django.utils.translation import ugettext as _
 
 from zerver.models import Realm, UserProfile, get_user_profile_by_id, get_client, \
     GENERIC_INTERFACE, Service, SLACK_INTERFACE, email_to_domain, get_service_profile
 from zerver.lib.actions import check_send_message
+from zerver.lib.db import reset_queries
 from zerver.lib.notifications import encode_stream
 from zerver.lib.queue import retry_event
 from zerver.lib.validator import check_dict, check_string
@@ -219,11 +226,35 @@ def process_success_response(event: Dict[str, Any],
     if success_message is not None:
         succeed_with_message(event, success_message)
 
+# Requests to bots go through a shared session, so that we reuse
+# connections to hosts we've already talked to.
+session = None  # type: Optional[requests.Session]
+session_pid = None  # type: Optional[int]
+session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    global session, session_pid
+    with session_lock:
+        if session is None or session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=100,
+                pool_maxsize=max(settings.OUTGOING_WEBHOOK_THREADS, 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session_pid = os.getpid()
+        return session
+
+# Handling a bot's response sends messages, which isn't safe to do
+# from several threads at once; it is quick compared to waiting for
+# the bot, so OutgoingWebhookDispatcher threads take turns at it.
+response_lock = threading.RLock()
+
 def do_rest_call(rest_operation: Dict[str, Any],
                  request_data: Optional[Dict[str, Any]],
                  event: Dict[str, Any],
                  service_handler: Any,
-                 timeout: Any=None) -> None:
+                 timeout: Optional[float]=None) -> None:
     rest_operation_validator = check_dict([
         ('method', check_string),
         ('relative_url_path', check_string),
@@ -238,10 +269,18 @@ def do_rest_call(rest_operation: Dict[str, Any],
     http_method = rest_operation['method']
     final_url = urllib.parse.urljoin(rest_operation['base_url'], rest_operation['relative_url_path'])
     request_kwargs = rest_operation['request_kwargs']
+    if timeout is None:
+        timeout = settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS
     request_kwargs['timeout'] = timeout
 
     try:
-        response = requests.request(http_method, final_url, data=request_data, **request_kwargs)
+        response = get_session().request(http_method, final_url, data=request_data, **request_kwargs)
+    except requests.exceptions.RequestException as e:
+        with response_lock:
+            process_request_exception(event, request_data, e)
+        return
+
+    with response_lock:
         if str(response.status_code).startswith('2'):
             process_success_response(event, service_handler, response)
         else:
@@ -255,12 +294,15 @@ def do_rest_call(rest_operation: Dict[str, Any],
             fail_with_message(event, failure_message)
             notify_bot_owner(event, request_data, response.status_code, response.content)
 
-    except requests.exceptions.Timeout as e:
+def process_request_exception(event: Dict[str, Any],
+                              request_data: Optional[Dict[str, Any]],
+                              e: requests.exceptions.RequestException) -> None:
+    if isinstance(e, requests.exceptions.Timeout):
         logging.info("Trigger event %s on %s timed out. Retrying" % (
             event["command"], event['service_name']))
         request_retry(event, request_data, 'Unable to connect with the third party.', exception=e)
 
-    except requests.exceptions.ConnectionError as e:
+    elif isinstance(e, requests.exceptions.ConnectionError):
         response_message = ("The message `%s` resulted in a connection error when "
                             "sending a request to an outgoing "
                             "webhook! See the Zulip server logs for more information." % (event["command"],))
@@ -268,10 +310,76 @@ def do_rest_call(rest_operation: Dict[str, Any],
                      % (event["command"], event['service_name']))
         request_retry(event, request_data, response_message, exception=e)
 
-    except requests.exceptions.RequestException as e:
+    else:
         response_message = ("An exception of type *%s* occurred for message `%s`! "
                             "See the Zulip server logs for more information." % (
                                 type(e).__name__, event["command"],))
         logging.exception("Outhook trigger failed:\n %s" % (e,))
         fail_with_message(event, response_message)
         notify_bot_owner(event, request_data, exception=e)
+
+class OutgoingWebhookDispatcher:
+    '''
+    Runs do_rest_call on a pool of threads, with at most
+    requests_per_service calls for any one service running at once;
+    the rest wait their turn, without holding up other services.
+
+    submit() blocks while max_outstanding calls are running or waiting,
+    so that a backlog stays in the queue rather than in our memory.
+    '''
+
+    def __init__(self, threads: int, requests_per_service: int,
+                 max_outstanding: int) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.requests_per_service = requests_per_service
+        self.max_outstanding = max_outstanding
+        self.outstanding = 0
+        self.running = defaultdict(int)  # type: Dict[int, int]
+        self.waiting = defaultdict(deque)  # type: Dict[int, deque]
+        self.condition = threading.Condition()
+
+    def submit(self, service_id: int, func: Callable[..., None], *args: Any) -> None:
+        with self.condition:
+            while self.outstanding >= self.max_outstanding:
+                self.condition.wait()
+            self.outstanding += 1
+            if self.running[service_id] < self.requests_per_service:
+                self.running[service_id] += 1
+                self.executor.submit(self.run, service_id, func, args)
+            else:
+                self.waiting[service_id].append((func, args))
+
+    def run(self, service_id: int, func: Callable[..., None], args: Tuple[Any, ...]) -> None:
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Problem making outgoing webhook request")
+        finally:
+            reset_queries()
+            with self.condition:
+                self.outstanding -= 1
+                if self.waiting[service_id]:
+                    next_func, next_args = self.waiting[service_id].popleft()
+                    self.executor.submit(self.run, service_id, next_func, next_args)
+                else:
+                    del self.waiting[service_id]
+                    self.running[service_id] -= 1
+                    if not self.running[service_id]:
+                        del self.running[service_id]
+                self.condition.notify_all()
+
+    def wait_until_idle(self, timeout: Optional[float]=None) -> bool:
+        '''Returns whether all submitted calls finished within timeout.'''
+        with self.condition:
+            return self.condition.wait_for(lambda: self.outstanding == 0, timeout)
+
+    def take_waiting(self) -> List[Tuple[Callable[..., None], Tuple[Any, ...]]]:
+        '''Withdraws the calls that haven't started yet, returning them.'''
+        with self.condition:
+            calls = []  # type: List[Tuple[Callable[..., None], Tuple[Any, ...]]]
+            for waiting in self.waiting.values():
+                calls.extend(waiting)
+                waiting.clear()
+            self.outstanding -= len(calls)
+            self.condition.notify_all()
+            return calls
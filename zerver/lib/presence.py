@@ -0,0 +1,100 @@
+# A snapshot of each realm's presence data in the remote cache, so
+# that the presence list every client fetches about once a minute
+# usually costs a single cache get, rather than rereading two weeks
+# of UserPresence rows for the whole realm.
+#
+# do_update_user_presence_many writes each batch of presence updates
+# to the database and then patches them into the snapshots of the
+# realms they belong to; saving or deleting UserPresence rows any
+# other way, or changing the user fields we copy, drops the snapshot
+# (see flush_user_presence and flush_user_profile).  Snapshots also
+# expire after PRESENCE_SNAPSHOT_TIMEOUT, which bounds how long a
+# lost race between a rebuild and a patch can leave one stale.
+import datetime
+from typing import Any, Dict, List, Set, Tuple
+
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.cache import cache_get, cache_set, realm_presence_snapshot_cache_key, \
+    remote_cache_set
+from zerver.models import Client, UserPresence, UserProfile
+
+PRESENCE_SNAPSHOT_TIMEOUT = 5 * 60
+
+# (user_profile_id, client name) ->
+#     (email, enable_offline_push_notifications, status, timestamp)
+PresenceRows = Dict[Tuple[int, str], Tuple[str, bool, int, datetime.datetime]]
+
+def build_presence_snapshot(realm_id: int) -> Tuple[PresenceRows, Set[int]]:
+    presence_rows, mobile_user_ids = UserPresence.get_presence_rows_by_realm(realm_id)
+    rows = {
+        (row['user_profile__id'], row['client__name']): (
+            row['user_profile__email'],
+            row['user_profile__enable_offline_push_notifications'],
+            row['status'],
+            row['timestamp'],
+        )
+        for row in presence_rows
+    }  # type: PresenceRows
+    return rows, mobile_user_ids
+
+def get_presence_snapshot(realm_id: int) -> Tuple[PresenceRows, Set[int]]:
+    key = realm_presence_snapshot_cache_key(realm_id)
+    result = cache_get(key)
+    if result is not None:
+        return result[0]
+    snapshot = build_presence_snapshot(realm_id)
+    remote_cache_set(key, snapshot, timeout=PRESENCE_SNAPSHOT_TIMEOUT)
+    return snapshot
+
+def get_status_dict_by_realm(realm_id: int) -> Dict[str, Dict[str, Any]]:
+    '''
+    Like UserPresence.get_status_dict_by_realm, but served from the
+    realm's presence snapshot.
+    '''
+    rows, mobile_user_ids = get_presence_snapshot(realm_id)
+    two_weeks_ago = timezone_now() - datetime.timedelta(weeks=2)
+    presence_rows = [
+        dict(
+            user_profile__id=user_profile_id,
+            client__name=client_name,
+            user_profile__email=email,
+            user_profile__enable_offline_push_notifications=push_enabled,
+            status=status,
+            timestamp=timestamp,
+        )
+        for ((user_profile_id, client_name),
+             (email, push_enabled, status, timestamp)) in rows.items()
+        if timestamp >= two_weeks_ago
+    ]
+    return UserPresence.get_status_dicts_for_rows(presence_rows, mobile_user_ids)
+
+def update_presence_snapshots(
+        presences: List[Tuple[UserProfile, Client, int, datetime.datetime]]) -> None:
+    '''
+    Patches the current (user_profile, client, status, timestamp) of
+    some UserPresence rows into the snapshots of their realms.  Realms
+    without a snapshot are left alone; the next read builds one.
+    '''
+    by_realm = {}  # type: Dict[int, List[Tuple[UserProfile, Client, int, datetime.datetime]]]
+    for presence in presences:
+        by_realm.setdefault(presence[0].realm_id, []).append(presence)
+
+    for realm_id, realm_presences in by_realm.items():
+        key = realm_presence_snapshot_cache_key(realm_id)
+        result = cache_get(key)
+        if result is None:
+            continue
+        rows, mobile_user_ids = result[0]
+        for user_profile, client, status, timestamp in realm_presences:
+            # The snapshot only covers active humans, like
+            # UserPresence.get_status_dict_by_realm.
+            if user_profile.is_bot or not user_profile.is_active:
+                continue
+            rows[(user_profile.id, client.name)] = (
+                user_profile.email,
+                user_profile.enable_offline_push_notifications,
+                status,
+                timestamp,
+            )
+        cache_set(key, (rows, mobile_user_ids), timeout=PRESENCE_SNAPSHOT_TIMEOUT)
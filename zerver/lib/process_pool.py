@@ -0,0 +1,195 @@
+# A pool of pre-forked worker processes that run functions with hard
+# timeouts.
+#
+# zerver.lib.timeout runs a function in a new thread and tries to stop
+# it with an asynchronous exception, which can't interrupt C code and
+# leaves the thread running if it doesn't work.  A ProcessPool worker
+# that runs past its timeout is killed with SIGKILL and replaced, so a
+# pathological input can't wedge the calling process, and map() runs
+# several calls at once on different cores.
+#
+# Workers are forked from the process that first uses the pool (see
+# get_process_pool).  Like with multiprocessing, the functions they
+# run must be module-level, and arguments and results are pickled.
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, List, Sequence, Tuple, TypeVar
+
+from django.core.cache import caches
+from django.db import connections
+
+from zerver.lib.timeout import TimeoutExpired
+
+ResultT = TypeVar('ResultT')
+
+class RemoteError(Exception):
+    '''Raised in place of an exception from a worker process.'''
+
+    def __init__(self, remote_traceback: str) -> None:
+        super().__init__(remote_traceback)
+        self.remote_traceback = remote_traceback
+
+    def __str__(self) -> str:
+        return 'Exception in worker process:\n%s' % (self.remote_traceback,)
+
+# Database and cache connections inherited from the parent share its
+# sockets.  Using them would interleave our queries with the parent's,
+# and closing them would end the parent's session too (the postgres
+# and memcached clients both say goodbye on close), so workers keep
+# them referenced but untouched, and open their own as needed.
+inherited_connections = []  # type: List[Any]
+
+def forget_inherited_connections() -> None:
+    for conn in connections.all():
+        inherited_connections.append(conn.connection)
+        conn.connection = None
+    inherited_connections.append(caches._caches)
+    caches._caches = threading.local()
+
+def worker_main(conn: Connection) -> None:
+    forget_inherited_connections()
+    # Interrupts and shutdown are our parent's business.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            # Our parent has exited.
+            return
+        try:
+            result = (True, func(*args))  # type: Tuple[bool, Any]
+        except Exception:
+            result = (False, traceback.format_exc())
+        conn.send(result)
+
+class Worker:
+    def __init__(self) -> None:
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn,),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+class ProcessPool:
+    def __init__(self, size: int) -> None:
+        assert size > 0
+        self.size = size
+        self.pid = os.getpid()
+        self.idle_workers = [Worker() for i in range(size)]
+        self.condition = threading.Condition()
+
+    def close(self) -> None:
+        '''Kills the pool's workers, once they have all finished.'''
+        with self.condition:
+            while len(self.idle_workers) < self.size:
+                self.condition.wait()
+            workers = self.idle_workers
+            self.idle_workers = []
+        for worker in workers:
+            worker.kill()
+
+    def acquire_workers(self, count: int) -> List[Worker]:
+        '''Waits for an idle worker, and takes up to count of them.'''
+        with self.condition:
+            while not self.idle_workers:
+                self.condition.wait()
+            workers = self.idle_workers[:count]
+            del self.idle_workers[:count]
+            return workers
+
+    def release_workers(self, workers: List[Worker]) -> None:
+        with self.condition:
+            self.idle_workers.extend(workers)
+            self.condition.notify_all()
+
+    def map(self, func: Callable[..., Any], args_list: Sequence[Sequence[Any]],
+            timeout: float) -> List[Any]:
+        '''
+        Calls func(*args) for each args in args_list, in parallel on
+        up to all of the pool's workers.  Returns, for each call, its
+        result or the exception it failed with: RemoteError if func
+        raised one, or TimeoutExpired if it ran for more than timeout
+        seconds, in which case we killed the worker running it.
+        '''
+        if not args_list:
+            return []
+        results = [None] * len(args_list)  # type: List[Any]
+        pending = list(reversed(list(enumerate(args_list))))
+        running = {}  # type: Dict[Connection, Tuple[Worker, int, float]]
+        workers = self.acquire_workers(len(args_list))
+        try:
+            while pending or running:
+                while pending and workers:
+                    worker = workers.pop()
+                    index, args = pending.pop()
+                    running[worker.conn] = (worker, index, time.monotonic() + timeout)
+                    worker.conn.send((func, tuple(args)))
+
+                next_deadline = min(deadline for (worker, index, deadline) in running.values())
+                for conn in wait(list(running), max(next_deadline - time.monotonic(), 0)):
+                    worker, index, deadline = running.pop(conn)
+                    try:
+                        succeeded, value = conn.recv()
+                    except EOFError:
+                        worker.kill()
+                        worker = Worker()
+                        results[index] = RemoteError('Worker process exited unexpectedly')
+                    else:
+                        results[index] = value if succeeded else RemoteError(value)
+                    workers.append(worker)
+
+                now = time.monotonic()
+                for conn, (worker, index, deadline) in list(running.items()):
+                    if deadline <= now:
+                        del running[conn]
+                        worker.kill()
+                        workers.append(Worker())
+                        results[index] = TimeoutExpired()
+        finally:
+            # If we were interrupted, the workers still running can't
+            # be reused, since their results would confuse later calls.
+            for worker, index, deadline in running.values():
+                worker.kill()
+                workers.append(Worker())
+            self.release_workers(workers)
+        return results
+
+    def apply(self, func: Callable[..., ResultT], args: Sequence[Any],
+              timeout: float) -> ResultT:
+        [result] = self.map(func, [args], timeout)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+pools = {}  # type: Dict[str, ProcessPool]
+
+def get_process_pool(name: str, size: int) -> ProcessPool:
+    '''
+    Returns this process's pool with the given name, forking its
+    workers the first time.  A process forked after that (e.g. by
+    uwsgi) gets its own pool, since it can't share its parent's.
+    '''
+    pool = pools.get(name)
+    if pool is None or pool.pid != os.getpid():
+        pool = pools[name] = ProcessPool(size)
+    return pool
+
+def close_process_pool(name: str) -> None:
+    pool = pools.pop(name, None)
+    if pool is not None and pool.pid == os.getpid():
+        pool.close()
@@ -32,6 +32,7 @@ class SimpleQueueClient:
         self.channel = None  # type: Optional[BlockingChannel]
         self.consumers = defaultdict(set)  # type: Dict[str, Set[Consumer]]
         self.rabbitmq_heartbeat = rabbitmq_heartbeat
+        self.batch_consuming = False
         self._connect()
 
     def _connect(self) -> None:
@@ -155,11 +156,48 @@ class SimpleQueueClient:
         self.ensure_queue(queue_name, opened)
         return messages
 
+    def start_json_batch_consuming(self, queue_name: str,
+                                   callback: Callable[[List[Dict[str, Any]]], None],
+                                   batch_size: int, max_wait: float) -> None:
+        '''Calls callback with lists of up to batch_size messages from the
+           queue, waiting at most about max_wait seconds for a batch to
+           fill, until stop_consuming is called.  RabbitMQ sends us up to
+           a batch of messages ahead of time, and we acknowledge each
+           batch at once after the callback returns.'''
+        def consume() -> None:
+            self.channel.basic_qos(prefetch_count=batch_size)
+            self.batch_consuming = True
+            batch = []  # type: List[Dict[str, Any]]
+            batch_start = 0.0
+            last_delivery_tag = None
+            for (method, properties, body) in self.channel.consume(queue_name,
+                                                                   inactivity_timeout=max_wait):
+                if method is not None:
+                    if not batch:
+                        batch_start = time.time()
+                    batch.append(ujson.loads(body))
+                    last_delivery_tag = method.delivery_tag
+
+                if batch and (method is None or len(batch) >= batch_size or
+                              time.time() - batch_start >= max_wait):
+                    try:
+                        callback(batch)
+                        self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                    except Exception as e:
+                        self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True)
+                        raise e
+                    batch = []
+            self.batch_consuming = False
+
+        self.ensure_queue(queue_name, consume)
+
     def start_consuming(self) -> None:
         self.channel.start_consuming()
 
     def stop_consuming(self) -> None:
         self.channel.stop_consuming()
+        if self.batch_consuming:
+            self.channel.cancel()
 
 # Patch pika.adapters.TornadoConnection so that a socket error doesn't
 # throw an exception and disconnect the tornado process from the rabbitmq
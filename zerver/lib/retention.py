@@ -4,6 +4,7 @@ from datetime import timedelta
 from django.db import connection, transaction
 from django.forms.models import model_to_dict
 from django.utils.timezone import now as timezone_now
+from zerver.lib.cache import invalidate_unread_indexes
 from zerver.models import Realm, Message, UserMessage, ArchivedMessage, ArchivedUserMessage, \
     Attachment, ArchivedAttachment
 
@@ -61,6 +62,7 @@ def move_message_to_archive(message_id: int) -> None:
     for user_message in user_messages.values():
         archiving_messages.append(ArchivedUserMessage(**user_message))
     ArchivedUserMessage.objects.bulk_create(archiving_messages)
+    invalidate_unread_indexes(um.user_profile_id for um in archiving_messages)
 
     # Move attachments to archive
     attachments = Attachment.objects.filter(messages__id=message_id).exclude(
@@ -1,4 +1,5 @@
 
+from zerver.lib.cache import invalidate_unread_indexes
 from zerver.lib.logging_util import log_to_file
 from collections import defaultdict
 import logging
@@ -158,6 +159,9 @@ def add_missing_messages(user_profile: UserProfile) -> None:
     # Doing a bulk create for all the UserMessage objects stored for creation.
     if len(user_messages_to_insert) > 0:
         UserMessage.objects.bulk_create(user_messages_to_insert)
+        # These are older than messages the user's unread index
+        # may already cover.
+        invalidate_unread_indexes([user_profile.id])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     user_profile.last_active_message_id = UserMessage.objects.filter(
@@ -19,6 +19,7 @@ from django.http import HttpRequest
 
 from two_factor.models import PhoneDevice
 from zerver.lib.initial_password import initial_password
+from zerver.lib.mention_index import clear_realm_mention_indexes_for_testing
 from zerver.lib.utils import is_remote_server
 
 from zerver.lib.actions import (
@@ -67,6 +68,7 @@ API_KEYS = {}  # type: Dict[str, str]
 def flush_caches_for_testing() -> None:
     global API_KEYS
     API_KEYS = {}
+    clear_realm_mention_indexes_for_testing()
 
 class UploadSerializeMixin(SerializeMixin):
     """
@@ -1,4 +1,4 @@
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 from zerver.models import (
     get_stream_recipient,
@@ -103,7 +103,11 @@ def exclude_topic_mutes(conditions: List[Selectable],
     condition = not_(or_(*list(map(mute_cond, rows))))
     return conditions + [condition]
 
-def build_topic_mute_checker(user_profile: UserProfile) -> Callable[[int, str], bool]:
+def get_topic_mute_keys(user_profile: UserProfile) -> Set[Tuple[int, str]]:
+    '''
+    Returns (recipient_id, lowercased topic name) for each of the
+    user's muted topics.
+    '''
     rows = MutedTopic.objects.filter(
         user_profile=user_profile,
     ).values(
@@ -117,6 +121,10 @@ def build_topic_mute_checker(user_profile: UserProfile) -> Callable[[int, str],
         recipient_id = row['recipient_id']
         topic_name = row['topic_name']
         tups.add((recipient_id, topic_name.lower()))
+    return tups
+
+def build_topic_mute_checker(user_profile: UserProfile) -> Callable[[int, str], bool]:
+    tups = get_topic_mute_keys(user_profile)
 
     def is_muted(recipient_id: int, topic: str) -> bool:
         return (recipient_id, topic.lower()) in tups
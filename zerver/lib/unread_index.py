@@ -0,0 +1,337 @@
+# A per-user index of unread messages in the remote cache, so that
+# fetching the unread counts for /register doesn't scan (and join)
+# thousands of UserMessage rows every time.
+#
+# The index keeps a counter per conversation (stream topic, private
+# messages from one sender, or huddle): its exact number of unread
+# messages, plus the ids, senders and mention flags of up to
+# MAX_UNREAD_MESSAGES_PER_CONVERSATION of the newest ones.  So reading
+# it is O(conversations), and a busy conversation can't crowd the
+# others out of it.  When reading messages uncovers older unread
+# messages in a conversation that had more than we listed, we refill
+# that one conversation.  The user's unread mentions are kept apart,
+# in full.
+#
+# Rather than adding every new message to the indexes of everyone who
+# received it, we index messages up to a watermark, and each read
+# picks up the unread UserMessage rows past it with one cheap query.
+# The watermark trails by UNREAD_INDEX_RESCAN_SECONDS, so that we
+# don't skip messages whose transactions commit out of order, and the
+# index remembers which messages past the watermark it has counted.
+# If too many have arrived since the index was saved, we rebuild it.
+#
+# Marking messages as read removes them from the index in place, and
+# anything else that changes indexed data (deleting messages, editing
+# topics and mentions, resubscribing, etc.) calls
+# invalidate_unread_indexes.  Muting is applied when we read the index.
+#
+# Every change to an index goes through bump_unread_index_version,
+# and the index records the version it was written at.  A process
+# that bumps the version and doesn't find the previous one in the
+# index either rebuilds it or deletes it, so that concurrent changes
+# can never silently undo each other.  Reading an index only writes
+# it back if the read changed it.
+import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.db import connection
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.cache import cache_delete, cache_get, cache_get_many, cache_set, \
+    remote_cache_bump_counter, unread_index_cache_key, unread_index_version_cache_key
+from zerver.models import Recipient, UserMessage, UserProfile
+
+MAX_UNREAD_MESSAGES_PER_CONVERSATION = 1000
+
+UNREAD_INDEX_TIMEOUT = 7 * 24 * 3600
+UNREAD_INDEX_RESCAN_SECONDS = 60
+# How many new unread messages we'd rather rebuild the index than add.
+MAX_UNREAD_INDEX_CATCH_UP = 1000
+
+# (recipient_id, topic in lower case) for streams, (recipient_id,
+# sender_id) for private messages and (recipient_id,) for huddles.
+ConversationKey = Tuple[Any, ...]
+
+def get_conversation_key(recipient_id: int, recipient_type: int,
+                         topic: str, sender_id: int) -> ConversationKey:
+    if recipient_type == Recipient.STREAM:
+        return (recipient_id, topic.lower())
+    if recipient_type == Recipient.PERSONAL:
+        return (recipient_id, sender_id)
+    return (recipient_id,)
+
+# Keep this in sync with get_conversation_key.
+CONVERSATION_PARTITION_SQL = '''
+    "zerver_message"."recipient_id",
+    CASE
+        WHEN "zerver_recipient"."type" = %(stream)d THEN lower("zerver_message"."subject")
+        WHEN "zerver_recipient"."type" = %(personal)d THEN "zerver_message"."sender_id"::text
+        ELSE ''
+    END
+''' % dict(stream=Recipient.STREAM, personal=Recipient.PERSONAL)
+
+def query_unread_conversations(user_profile_id: int,
+                               excluded_recipient_ids: List[int],
+                               where: str,
+                               params: List[Any]) -> List[Tuple[Any, ...]]:
+    '''
+    Returns the newest MAX_UNREAD_MESSAGES_PER_CONVERSATION unread
+    messages matching where in each of the user's conversations, each
+    with its conversation's unread count, in one query.
+    '''
+    query = '''
+    SELECT
+        message_id, sender_id, subject, recipient_id, recipient_type,
+        recipient_type_id, flags, rank, unread_count
+    FROM (
+        SELECT
+            "zerver_usermessage"."message_id",
+            "zerver_message"."sender_id",
+            "zerver_message"."subject",
+            "zerver_message"."recipient_id",
+            "zerver_recipient"."type" AS recipient_type,
+            "zerver_recipient"."type_id" AS recipient_type_id,
+            "zerver_usermessage"."flags",
+            row_number() OVER (conversation ORDER BY "zerver_usermessage"."message_id" DESC) AS rank,
+            count(*) OVER conversation AS unread_count
+        FROM "zerver_usermessage"
+        INNER JOIN "zerver_message" ON (
+            "zerver_message"."id" = "zerver_usermessage"."message_id"
+        )
+        INNER JOIN "zerver_recipient" ON (
+            "zerver_recipient"."id" = "zerver_message"."recipient_id"
+        )
+        WHERE (
+            "zerver_usermessage"."user_profile_id" = %s AND
+            ("zerver_usermessage"."flags" & 1) = 0 AND
+            NOT ("zerver_message"."recipient_id" = ANY(%s)) AND
+            {where}
+        )
+        WINDOW conversation AS (PARTITION BY {partition})
+    ) AS unread
+    WHERE rank <= %s
+    '''.format(where=where, partition=CONVERSATION_PARTITION_SQL)
+    with connection.cursor() as cursor:
+        cursor.execute(query, [user_profile_id, excluded_recipient_ids] + params +
+                       [MAX_UNREAD_MESSAGES_PER_CONVERSATION])
+        return cursor.fetchall()
+
+def add_unread_message(index: Dict[str, Any], message_id: int, sender_id: int,
+                       topic: str, recipient_id: int, recipient_type: int,
+                       recipient_type_id: int, flags: int, count: int) -> None:
+    '''Adds the message to its conversation, and count to its unread count.'''
+    key = get_conversation_key(recipient_id, recipient_type, topic, sender_id)
+    conversation = index['conversations'].get(key)
+    if conversation is None:
+        conversation = dict(
+            recipient_type=recipient_type,
+            recipient_type_id=recipient_type_id,
+            topic=topic,
+            count=0,
+            messages={},
+        )
+        index['conversations'][key] = conversation
+    conversation['count'] += count
+    mentioned = (flags & UserMessage.flags.mentioned) != 0
+    conversation['messages'][message_id] = (sender_id, mentioned)
+    if mentioned:
+        index['mentions'][message_id] = key
+
+    messages = conversation['messages']
+    if len(messages) > MAX_UNREAD_MESSAGES_PER_CONVERSATION:
+        del messages[min(messages)]
+
+def get_watermark(user_profile_id: int) -> int:
+    cutoff = timezone_now() - datetime.timedelta(seconds=UNREAD_INDEX_RESCAN_SECONDS)
+    watermark = UserMessage.objects.filter(
+        user_profile_id=user_profile_id,
+        message__pub_date__lt=cutoff,
+    ).order_by('-message_id').values_list('message_id', flat=True).first()
+    return watermark or 0
+
+def build_unread_index(user_profile: UserProfile,
+                       excluded_recipient_ids: List[int]) -> Dict[str, Any]:
+    index = dict(
+        watermark=get_watermark(user_profile.id),
+        # Ids of the messages past the watermark that we have counted.
+        recent_message_ids=set(),
+        conversations={},
+        mentions={},
+    )  # type: Dict[str, Any]
+
+    for row in query_unread_conversations(user_profile.id, excluded_recipient_ids,
+                                          '"zerver_usermessage"."message_id" <= %s',
+                                          [index['watermark']]):
+        (message_id, sender_id, topic, recipient_id, recipient_type,
+         recipient_type_id, flags, rank, unread_count) = row
+        # Every conversation has exactly one row with rank 1.
+        add_unread_message(index, message_id, sender_id, topic, recipient_id,
+                           recipient_type, recipient_type_id, flags,
+                           unread_count if rank == 1 else 0)
+
+    # Mentions in messages that we didn't list; the partial index on
+    # mentioned messages makes this cheap.
+    mentioned_rows = UserMessage.objects.filter(
+        user_profile=user_profile,
+        message_id__lte=index['watermark'],
+    ).exclude(
+        message__recipient_id__in=excluded_recipient_ids
+    ).extra(
+        # Spelled like the index's WHERE clause, so Postgres uses it.
+        where=[UserMessage.where_unread(), '(flags & 8) != 0']
+    ).values_list('message_id', 'message__recipient_id', 'message__recipient__type',
+                  'message__subject', 'message__sender_id')
+    for (message_id, recipient_id, recipient_type, topic, sender_id) in mentioned_rows:
+        index['mentions'][message_id] = get_conversation_key(
+            recipient_id, recipient_type, topic, sender_id)
+
+    return index
+
+def extend_unread_index(user_profile: UserProfile, index: Dict[str, Any],
+                        excluded_recipient_ids: List[int],
+                        limit: Optional[int]=MAX_UNREAD_INDEX_CATCH_UP) -> bool:
+    '''
+    Adds the unread messages that arrived since the index was saved;
+    returns False if there are more than limit, in which case the
+    index should be rebuilt instead.
+    '''
+    query = UserMessage.objects.filter(
+        user_profile=user_profile,
+        message_id__gt=index['watermark'],
+    ).exclude(
+        message__recipient_id__in=excluded_recipient_ids
+    ).extra(
+        where=[UserMessage.where_unread()]
+    ).values_list(
+        'message_id', 'message__sender_id', 'message__subject',
+        'message__recipient_id', 'message__recipient__type',
+        'message__recipient__type_id', 'flags', 'message__pub_date',
+    ).order_by('message_id')
+    if limit is not None:
+        rows = list(query[:limit + 1])
+        if len(rows) > limit:
+            return False
+    else:
+        rows = list(query)
+
+    cutoff = timezone_now() - datetime.timedelta(seconds=UNREAD_INDEX_RESCAN_SECONDS)
+    recent_message_ids = index['recent_message_ids']
+    for row in rows:
+        message_id = row[0]
+        if message_id not in recent_message_ids:
+            add_unread_message(index, *row[:7], count=1)
+            recent_message_ids.add(message_id)
+        if row[7] < cutoff:
+            index['watermark'] = max(index['watermark'], message_id)
+
+    index['recent_message_ids'] = {message_id for message_id in recent_message_ids
+                                   if message_id > index['watermark']}
+    return True
+
+def refill_conversation(user_profile: UserProfile, index: Dict[str, Any],
+                        key: ConversationKey) -> None:
+    '''Lists the newest unread messages in a conversation again, after
+    reading the ones we had listed uncovered older ones.'''
+    conversation = index['conversations'].pop(key)
+    where = '"zerver_message"."recipient_id" = %s'
+    if conversation['recipient_type'] == Recipient.STREAM:
+        where += ' AND lower("zerver_message"."subject") = %s'
+    elif conversation['recipient_type'] == Recipient.PERSONAL:
+        where += ' AND "zerver_message"."sender_id" = %s'
+
+    for row in query_unread_conversations(user_profile.id, [], where, list(key)):
+        (message_id, sender_id, topic, recipient_id, recipient_type,
+         recipient_type_id, flags, rank, unread_count) = row
+        add_unread_message(index, message_id, sender_id, topic, recipient_id,
+                           recipient_type, recipient_type_id, flags,
+                           unread_count if rank == 1 else 0)
+        if message_id > index['watermark']:
+            index['recent_message_ids'].add(message_id)
+
+def bump_unread_index_version(user_profile_id: int) -> Tuple[int, Optional[Dict[str, Any]]]:
+    '''
+    Returns the new version of the user's unread index, and the index
+    if it was up to date with the previous one.
+    '''
+    version = remote_cache_bump_counter(unread_index_version_cache_key(user_profile_id))
+    result = cache_get(unread_index_cache_key(user_profile_id))
+    if result is None or result[0]['version'] != version - 1:
+        return version, None
+    return version, result[0]
+
+def save_unread_index(user_profile_id: int, version: int, index: Dict[str, Any]) -> None:
+    index['version'] = version
+    cache_set(unread_index_cache_key(user_profile_id), index, timeout=UNREAD_INDEX_TIMEOUT)
+
+def get_unread_index(user_profile: UserProfile,
+                     excluded_recipient_ids: List[int]) -> Dict[str, Any]:
+    '''
+    Returns the user's unread index, whose conversations and mentions
+    may include some in streams they have since unsubscribed from.
+    '''
+    index_key = unread_index_cache_key(user_profile.id)
+    version_key = unread_index_version_cache_key(user_profile.id)
+    cached = cache_get_many([index_key, version_key])
+    version = cached.get(version_key, 0)
+    index = None  # type: Optional[Dict[str, Any]]
+    if index_key in cached and cached[index_key][0]['version'] == version:
+        index = cached[index_key][0]
+
+    if index is not None:
+        watermark = index['watermark']
+        recent_message_ids = set(index['recent_message_ids'])
+    if index is None or not extend_unread_index(user_profile, index, excluded_recipient_ids):
+        index = build_unread_index(user_profile, excluded_recipient_ids)
+        extend_unread_index(user_profile, index, excluded_recipient_ids, limit=None)
+        changed = True
+    else:
+        changed = (index['watermark'] != watermark or
+                   index['recent_message_ids'] != recent_message_ids)
+
+    for (key, conversation) in list(index['conversations'].items()):
+        listed = len(conversation['messages'])
+        if listed < conversation['count'] and listed < MAX_UNREAD_MESSAGES_PER_CONVERSATION // 2:
+            refill_conversation(user_profile, index, key)
+            changed = True
+
+    if changed:
+        # Unless someone changed the index since we read its version,
+        # in which case our bump makes whatever they wrote stale.
+        new_version = remote_cache_bump_counter(version_key)
+        if new_version == version + 1:
+            save_unread_index(user_profile.id, new_version, index)
+    return index
+
+def remove_read_messages(user_profile_id: int, message_ids: Iterable[int]) -> None:
+    version, index = bump_unread_index_version(user_profile_id)
+    if index is not None:
+        conversation_keys = {}  # type: Dict[int, ConversationKey]
+        for (key, conversation) in index['conversations'].items():
+            for message_id in conversation['messages']:
+                conversation_keys[message_id] = key
+        truncated = any(len(conversation['messages']) < conversation['count']
+                        for conversation in index['conversations'].values())
+
+        for message_id in message_ids:
+            index['mentions'].pop(message_id, None)
+            key = conversation_keys.get(message_id)
+            if key is None:
+                if truncated and message_id <= index['watermark']:
+                    # It may have been one of the unread messages we
+                    # didn't list, and we can't tell which
+                    # conversation to take it off.
+                    index = None
+                    break
+                continue
+            conversation = index['conversations'][key]
+            del conversation['messages'][message_id]
+            conversation['count'] -= 1
+            if conversation['count'] == 0:
+                del index['conversations'][key]
+            index['recent_message_ids'].discard(message_id)
+
+    if index is None:
+        # Make sure that nobody reads an index from before our bump.
+        cache_delete(unread_index_cache_key(user_profile_id))
+        return
+    save_unread_index(user_profile_id, version, index)
@@ -1,6 +1,30 @@
+import sys
 from typing import Optional, Dict, Any
+
+import requests
 from pyoembed import oEmbed, PyOembedException
 
+# How long pyoembed may wait on each request it makes.
+OEMBED_TIMEOUT_SECONDS = 15
+
+class TimeoutRequests:
+    '''
+    Stands in for the requests module in pyoembed, which makes its
+    requests (for oEmbed data, and for pages to discover oEmbed
+    endpoints in) without a timeout, so that a host that never answers
+    can't hold up a fetch thread forever.
+    '''
+    def __getattr__(self, name: str) -> Any:
+        return getattr(requests, name)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault('timeout', OEMBED_TIMEOUT_SECONDS)
+        return requests.get(url, **kwargs)
+
+# Importing oEmbed above has loaded the modules that make requests.
+for module_name, module in list(sys.modules.items()):
+    if module_name.split('.')[0] == 'pyoembed' and getattr(module, 'requests', None) is requests:
+        setattr(module, 'requests', TimeoutRequests())
 
 def get_oembed_data(url: str,
                     maxwidth: Optional[int]=640,
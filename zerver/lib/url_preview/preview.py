@@ -1,10 +1,14 @@
+import os
 import re
 import logging
+import threading
 import traceback
-from typing import Any, Optional, Dict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FetchTimeoutError
+from typing import Any, Optional, Dict, Iterable, List, Tuple
 from typing.re import Match
 import requests
-from zerver.lib.cache import cache_with_key, get_cache_with_key
+from zerver.lib.cache import cache_get_many, cache_set, get_cache_with_key
+from zerver.lib.utils import statsd
 from zerver.lib.url_preview.oembed import get_oembed_data
 from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser
 from django.utils.encoding import smart_text
@@ -28,12 +32,46 @@ def cache_key_func(url: str) -> str:
     return url
 
 
-@cache_with_key(cache_key_func, cache_name=CACHE_NAME, with_statsd_key="urlpreview_data")
-def get_link_embed_data(url: str,
-                        maxwidth: Optional[int]=640,
-                        maxheight: Optional[int]=480) -> Optional[Dict[str, Any]]:
+# How long we remember that we couldn't fetch a URL, before trying
+# again.  Successful fetches are kept for the cache's default timeout.
+FAILED_FETCH_CACHE_TIMEOUT = 60 * 60
+
+# How many URLs we fetch at once, and how long we wait for each.
+MAX_CONCURRENT_FETCHES = 8
+FETCH_TIMEOUT_SECONDS = 15
+# A fetch makes up to three requests, each with its own timeout (see
+# also OEMBED_TIMEOUT_SECONDS), and a server can trickle a response
+# past them, so we also bound how long we wait for a fetch as a whole.
+# A fetch we give up on is cached as a failure, though its thread runs
+# until its current request times out.
+FETCH_WAIT_TIMEOUT_SECONDS = 3 * FETCH_TIMEOUT_SECONDS
+
+# Our fetches share a session, so that we reuse connections to hosts
+# we've already fetched from, and a pool of threads; see get_fetcher.
+session = None  # type: Optional[requests.Session]
+executor = None  # type: Optional[ThreadPoolExecutor]
+fetcher_pid = None  # type: Optional[int]
+
+# Fetches in progress in this process, by url and size, so that
+# concurrent requests for a popular link share a single fetch.
+in_flight = {}  # type: Dict[Tuple[str, Optional[int], Optional[int]], Future]
+in_flight_lock = threading.Lock()
+
+def get_fetcher() -> Tuple[requests.Session, ThreadPoolExecutor]:
+    global session, executor, fetcher_pid
+    with in_flight_lock:
+        if fetcher_pid != os.getpid():
+            session = requests.Session()
+            executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES)
+            fetcher_pid = os.getpid()
+        return session, executor
+
+def fetch_link_embed_data(url: str,
+                          maxwidth: Optional[int]=640,
+                          maxheight: Optional[int]=480) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    """Returns whether we reached the url, and the data for its preview."""
     if not is_link(url):
-        return None
+        return True, None
     # Fetch information from URL.
     # We are using three sources in next order:
     # 1. OEmbed
@@ -41,12 +79,13 @@ def get_link_embed_data(url: str,
     # 3. Meta tags
     try:
         data = get_oembed_data(url, maxwidth=maxwidth, maxheight=maxheight)
+        data = data or {}
+        session, executor = get_fetcher()
+        response = session.get(url, timeout=FETCH_TIMEOUT_SECONDS)
     except requests.exceptions.RequestException:
         msg = 'Unable to fetch information from url {0}, traceback: {1}'
         logging.error(msg.format(url, traceback.format_exc()))
-        return None
-    data = data or {}
-    response = requests.get(url)
+        return False, None
     if response.ok:
         og_data = OpenGraphParser(response.text).extract_data()
         if og_data:
@@ -55,7 +94,60 @@ def get_link_embed_data(url: str,
         for key in ['title', 'description', 'image']:
             if not data.get(key) and generic_data.get(key):
                 data[key] = generic_data[key]
-    return data
+    return True, data
+
+def start_fetch(url: str, maxwidth: Optional[int],
+                maxheight: Optional[int]) -> Future:
+    session, executor = get_fetcher()
+    fetch_key = (url, maxwidth, maxheight)
+    with in_flight_lock:
+        future = in_flight.get(fetch_key)
+        if future is None:
+            future = executor.submit(fetch_link_embed_data, url, maxwidth, maxheight)
+            in_flight[fetch_key] = future
+
+            def done(future: Future) -> None:
+                with in_flight_lock:
+                    in_flight.pop(fetch_key, None)
+            future.add_done_callback(done)
+    return future
+
+def get_link_embed_data_many(urls: Iterable[str],
+                             maxwidth: Optional[int]=640,
+                             maxheight: Optional[int]=480) -> Dict[str, Optional[Dict[str, Any]]]:
+    """
+    Returns the preview data for each url, from the cache where we
+    have it, and otherwise by fetching the urls concurrently.  Failed
+    fetches are cached for FAILED_FETCH_CACHE_TIMEOUT.
+    """
+    urls = list(set(urls))
+    cached = cache_get_many([cache_key_func(url) for url in urls], cache_name=CACHE_NAME)
+    results = {}  # type: Dict[str, Optional[Dict[str, Any]]]
+    futures = {}  # type: Dict[str, Future]
+    for url in urls:
+        key = cache_key_func(url)
+        if key in cached:
+            results[url] = cached[key][0]
+        else:
+            futures[url] = start_fetch(url, maxwidth, maxheight)
+    statsd.incr("cache.dbcache.urlpreview_data.hit", len(results))
+    statsd.incr("cache.dbcache.urlpreview_data.miss", len(futures))
+
+    for url, future in futures.items():
+        try:
+            succeeded, data = future.result(timeout=FETCH_WAIT_TIMEOUT_SECONDS)
+        except FetchTimeoutError:
+            logging.warning('Timed out fetching information from url {0}'.format(url))
+            succeeded, data = False, None
+        timeout = None if succeeded else FAILED_FETCH_CACHE_TIMEOUT
+        cache_set(cache_key_func(url), data, cache_name=CACHE_NAME, timeout=timeout)
+        results[url] = data
+    return results
+
+def get_link_embed_data(url: str,
+                        maxwidth: Optional[int]=640,
+                        maxheight: Optional[int]=480) -> Optional[Dict[str, Any]]:
+    return get_link_embed_data_many([url], maxwidth=maxwidth, maxheight=maxheight)[url]
 
 
 @get_cache_with_key(cache_key_func, cache_name=CACHE_NAME)
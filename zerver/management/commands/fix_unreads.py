@@ -7,6 +7,7 @@ from typing import Any, List, Optional
 from django.core.management.base import CommandError
 from django.db import connection
 
+from zerver.lib.cache import invalidate_unread_indexes
 from zerver.lib.fix_unreads import fix
 from zerver.lib.management import ZulipBaseCommand
 from zerver.models import Realm, UserProfile
@@ -37,6 +38,7 @@ class Command(ZulipBaseCommand):
         for user_profile in user_profiles:
             fix(user_profile)
             connection.commit()
+            invalidate_unread_indexes([user_profile.id])
 
     def fix_emails(self, realm: Optional[Realm], emails: List[str]) -> None:
 
@@ -49,6 +51,7 @@ class Command(ZulipBaseCommand):
 
             fix(user_profile)
             connection.commit()
+            invalidate_unread_indexes([user_profile.id])
 
     def handle(self, *args: Any, **options: Any) -> None:
         realm = self.get_realm(options)
@@ -6,6 +6,7 @@ from django.core.management import CommandError
 from django.core.management.base import BaseCommand
 
 from zerver.lib.queue import SimpleQueueClient
+from zerver.tornado.sharding import get_tornado_queue_names
 from zerver.worker.queue_processors import get_active_worker_queues
 
 class Command(BaseCommand):
@@ -31,8 +32,7 @@ class Command(BaseCommand):
             raise CommandError("Missing queue_name argument!")
         else:
             queue_name = options['queue_name']
-            if queue_name not in ['notify_tornado', 'tornado_return',
-                                  ] + get_active_worker_queues():
+            if queue_name not in get_tornado_queue_names() + get_active_worker_queues():
                 raise CommandError("Unknown queue %s" % (queue_name,))
 
             print("Purging queue %s" % (queue_name,))
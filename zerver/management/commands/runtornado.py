@@ -24,7 +24,9 @@ from zerver.tornado.application import create_tornado_application, \
     setup_tornado_rabbitmq
 from zerver.tornado.autoreload import start as zulip_autoreload_start
 from zerver.tornado.event_queue import add_client_gc_hook, \
-    missedmessage_hook, process_notification, setup_event_queue
+    missedmessage_hook, process_notification_data, setup_event_queue
+from zerver.tornado.sharding import get_shard_for_port, notify_tornado_queue_name, \
+    set_current_shard, sharding_enabled, tornado_return_queue_name
 from zerver.tornado.socket import respond_send_message
 
 if settings.USING_RABBITMQ:
@@ -68,6 +70,21 @@ class Command(BaseCommand):
         if not port.isdigit():
             raise CommandError("%r is not a valid port number." % (port,))
 
+        shard = 0
+        if sharding_enabled():
+            # nginx sends every sockjs connection to shard 0, which
+            # can't authenticate sockets against queues owned by the
+            # other shards.
+            if settings.USE_WEBSOCKETS:
+                raise CommandError("USE_WEBSOCKETS must be disabled when running "
+                                   "more than one Tornado process.")
+            port_shard = get_shard_for_port(int(port))
+            if port_shard is None:
+                raise CommandError("Port %s does not belong to any of the %d Tornado shards." %
+                                   (port, settings.TORNADO_PROCESSES))
+            shard = port_shard
+        set_current_shard(shard)
+
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
         quit_command = 'CTRL-C'
@@ -90,8 +107,10 @@ class Command(BaseCommand):
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(notify_tornado_queue_name(shard),
+                                                    process_notification_data)
+                queue_client.register_json_consumer(tornado_return_queue_name(shard),
+                                                    respond_send_message)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
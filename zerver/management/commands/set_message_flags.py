@@ -7,6 +7,7 @@ from django.core.management.base import CommandParser
 from django.db import models
 
 from zerver.lib import utils
+from zerver.lib.cache import invalidate_unread_indexes
 from zerver.lib.management import ZulipBaseCommand
 from zerver.models import UserMessage
 
@@ -80,4 +81,5 @@ class Command(ZulipBaseCommand):
             exit(1)
 
         utils.run_in_batches(mids, 400, do_update, sleep_time=3)
+        invalidate_unread_indexes([user_profile.id])
         exit(0)
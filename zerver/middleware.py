@@ -19,7 +19,8 @@ from django.utils.translation import ugettext as _
 from django.views.csrf import csrf_failure as html_csrf_failure
 
 from zerver.lib.bugdown import get_bugdown_requests, get_bugdown_time
-from zerver.lib.cache import get_remote_cache_requests, get_remote_cache_time
+from zerver.lib.cache import get_local_cache_hits, get_local_cache_misses, \
+    get_remote_cache_requests, get_remote_cache_time
 from zerver.lib.debug import maybe_tracemalloc_listen
 from zerver.lib.exceptions import ErrorCode, JsonableError, RateLimited
 from zerver.lib.queue import queue_json_publish
@@ -67,6 +68,8 @@ def record_request_start_data(log_data: MutableMapping[str, Any]) -> None:
     log_data['time_started'] = time.time()
     log_data['remote_cache_time_start'] = get_remote_cache_time()
     log_data['remote_cache_requests_start'] = get_remote_cache_requests()
+    log_data['local_cache_hits_start'] = get_local_cache_hits()
+    log_data['local_cache_misses_start'] = get_local_cache_misses()
     log_data['bugdown_time_start'] = get_bugdown_time()
     log_data['bugdown_requests_start'] = get_bugdown_requests()
 
@@ -144,6 +147,11 @@ def write_log_line(log_data: MutableMapping[str, Any], path: str, method: str, r
         if not suppress_statsd:
             statsd.timing("%s.remote_cache.time" % (statsd_path,), timedelta_ms(remote_cache_time_delta))
             statsd.incr("%s.remote_cache.querycount" % (statsd_path,), remote_cache_count_delta)
+            if 'local_cache_hits_start' in log_data:
+                statsd.incr("%s.local_cache.hits" % (statsd_path,),
+                            get_local_cache_hits() - log_data['local_cache_hits_start'])
+                statsd.incr("%s.local_cache.misses" % (statsd_path,),
+                            get_local_cache_misses() - log_data['local_cache_misses_start'])
 
     startup_output = ""
     if 'startup_time_delta' in log_data and log_data["startup_time_delta"] > 0.005:
@@ -16,19 +16,22 @@ from django.core.validators import URLValidator, MinLengthValidator, \
     RegexValidator
 from django.dispatch import receiver
 from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
-    user_profile_by_api_key_cache_key, active_non_guest_user_ids_cache_key, \
+    user_id_by_api_key_cache_key, active_non_guest_user_ids_cache_key, \
     user_profile_by_id_cache_key, user_profile_by_email_cache_key, \
     user_profile_cache_key, generic_bulk_cached_fetch, cache_set, flush_stream, \
     display_recipient_cache_key, cache_delete, active_user_ids_cache_key, \
     get_stream_cache_key, realm_user_dicts_cache_key, \
     bot_dicts_in_realm_cache_key, realm_user_dict_fields, \
-    bot_dict_fields, flush_message, flush_submessage, bot_profile_cache_key
+    bot_dict_fields, flush_message, flush_submessage, bot_profile_cache_key, \
+    expire_local_cache_validation, flush_realm_local_cache, get_realm_cache_key, \
+    local_cache_with_key, flush_user_group, flush_user_presence, flush_user_message, \
+    flush_subscription, flush_realm_state, bump_realm_state_version
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from django.db import transaction
 from django.utils.timezone import now as timezone_now
 from django.contrib.sessions.models import Session
 from zerver.lib.timestamp import datetime_to_timestamp
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.utils.translation import ugettext_lazy as _
 from zerver.lib import cache
 from zerver.lib.validator import check_int, check_float, \
@@ -104,6 +107,7 @@ def flush_per_request_caches() -> None:
     per_request_display_recipient_cache = {}
     global per_request_realm_filters_cache
     per_request_realm_filters_cache = {}
+    expire_local_cache_validation()
 
 DisplayRecipientCacheT = Union[str, List[Dict[str, Any]]]
 @cache_with_key(lambda *args: display_recipient_cache_key(args[0]),
@@ -362,7 +366,9 @@ class Realm(models.Model):
         )
 
 post_save.connect(flush_realm, sender=Realm)
+post_delete.connect(flush_realm_local_cache, sender=Realm)
 
+@local_cache_with_key(get_realm_cache_key)
 def get_realm(string_id: str) -> Realm:
     return Realm.objects.filter(string_id=string_id).first()
 
@@ -380,6 +386,9 @@ class RealmDomain(models.Model):
     class Meta:
         unique_together = ("realm", "domain")
 
+post_save.connect(flush_realm_state, sender=RealmDomain)
+post_delete.connect(flush_realm_state, sender=RealmDomain)
+
 # These functions should only be used on email addresses that have
 # been validated via django.core.validators.validate_email
 #
@@ -486,6 +495,7 @@ def flush_realm_emoji(sender: Any, **kwargs: Any) -> None:
     cache_set(get_active_realm_emoji_cache_key(realm),
               get_active_realm_emoji_uncached(realm),
               timeout=3600*24*7)
+    bump_realm_state_version(realm.id)
 
 post_save.connect(flush_realm_emoji, sender=RealmEmoji)
 post_delete.connect(flush_realm_emoji, sender=RealmEmoji)
@@ -559,6 +569,7 @@ def flush_realm_filter(sender: Any, **kwargs: Any) -> None:
         per_request_realm_filters_cache.pop(realm_id)
     except KeyError:
         pass
+    bump_realm_state_version(realm_id)
 
 post_save.connect(flush_realm_filter, sender=RealmFilter)
 post_delete.connect(flush_realm_filter, sender=RealmFilter)
@@ -842,6 +853,9 @@ class UserGroup(models.Model):
     class Meta:
         unique_together = (('realm', 'name'),)
 
+post_save.connect(flush_user_group, sender=UserGroup)
+post_delete.connect(flush_user_group, sender=UserGroup)
+
 class UserGroupMembership(models.Model):
     user_group = models.ForeignKey(UserGroup, on_delete=CASCADE)
     user_profile = models.ForeignKey(UserProfile, on_delete=CASCADE)
@@ -849,6 +863,12 @@ class UserGroupMembership(models.Model):
     class Meta:
         unique_together = (('user_group', 'user_profile'),)
 
+def flush_user_group_membership(sender: Any, **kwargs: Any) -> None:
+    bump_realm_state_version(kwargs['instance'].user_group.realm_id)
+
+post_save.connect(flush_user_group_membership, sender=UserGroupMembership)
+post_delete.connect(flush_user_group_membership, sender=UserGroupMembership)
+
 def receives_offline_push_notifications(user_profile: UserProfile) -> bool:
     return (user_profile.enable_offline_push_notifications and
             not user_profile.is_bot)
@@ -1416,6 +1436,9 @@ class ArchivedUserMessage(AbstractUserMessage):
 class UserMessage(AbstractUserMessage):
     message = models.ForeignKey(Message, on_delete=CASCADE)  # type: Message
 
+# There's deliberately no post_delete hook, since it would make
+# deleting a message fetch all of its UserMessage rows.
+post_save.connect(flush_user_message, sender=UserMessage)
 
 class AbstractAttachment(models.Model):
     file_name = models.TextField(db_index=True)  # type: str
@@ -1531,6 +1554,9 @@ class Subscription(models.Model):
     def __str__(self) -> str:
         return "<Subscription: %s -> %s>" % (self.user_profile, self.recipient)
 
+post_save.connect(flush_subscription, sender=Subscription)
+post_delete.connect(flush_subscription, sender=Subscription)
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -1539,9 +1565,15 @@ def get_user_profile_by_id(uid: int) -> UserProfile:
 def get_user_profile_by_email(email: str) -> UserProfile:
     return UserProfile.objects.select_related().get(email__iexact=email.strip())
 
-@cache_with_key(user_profile_by_api_key_cache_key, timeout=3600*24*7)
+@cache_with_key(user_id_by_api_key_cache_key, timeout=3600*24*7)
+def get_user_id_by_api_key(api_key: str) -> int:
+    return UserProfile.objects.values_list('id', flat=True).get(api_key=api_key)
+
 def get_user_profile_by_api_key(api_key: str) -> UserProfile:
-    return UserProfile.objects.select_related().get(api_key=api_key)
+    # Only the id is cached under the API key (and locally, see
+    # LOCAL_CACHE_TIMEOUTS), so that the profile itself is as fresh
+    # as get_user_profile_by_id's.
+    return get_user_profile_by_id(get_user_id_by_api_key(api_key))
 
 @cache_with_key(user_profile_cache_key, timeout=3600*24*7)
 def get_user(email: str, realm: Realm) -> UserProfile:
@@ -1718,6 +1750,11 @@ class UserPresence(models.Model):
 
     @staticmethod
     def get_status_dict_by_realm(realm_id: int) -> Dict[str, Dict[str, Any]]:
+        presence_rows, mobile_user_ids = UserPresence.get_presence_rows_by_realm(realm_id)
+        return UserPresence.get_status_dicts_for_rows(presence_rows, mobile_user_ids)
+
+    @staticmethod
+    def get_presence_rows_by_realm(realm_id: int) -> Tuple[List[Dict[str, Any]], Set[int]]:
         user_profile_ids = UserProfile.objects.filter(
             realm_id=realm_id,
             is_active=True,
@@ -1732,7 +1769,7 @@ class UserPresence(models.Model):
             # It's not clear this condition is actually possible,
             # though, because it shouldn't be possible to end up with
             # a realm with 0 active users.
-            return {}
+            return [], set()
 
         two_weeks_ago = timezone_now() - datetime.timedelta(weeks=2)
         query = UserPresence.objects.filter(
@@ -1767,7 +1804,7 @@ class UserPresence(models.Model):
         )
         mobile_user_ids = set(mobile_query)
 
-        return UserPresence.get_status_dicts_for_rows(presence_rows, mobile_user_ids)
+        return presence_rows, mobile_user_ids
 
     @staticmethod
     def get_status_dicts_for_rows(presence_rows: List[Dict[str, Any]],
@@ -1854,6 +1891,9 @@ class UserPresence(models.Model):
     class Meta:
         unique_together = ("user_profile", "client")
 
+post_save.connect(flush_user_presence, sender=UserPresence)
+post_delete.connect(flush_user_presence, sender=UserPresence)
+
 class DefaultStream(models.Model):
     realm = models.ForeignKey(Realm, on_delete=CASCADE)  # type: Realm
     stream = models.ForeignKey(Stream, on_delete=CASCADE)  # type: Stream
@@ -1861,6 +1901,9 @@ class DefaultStream(models.Model):
     class Meta:
         unique_together = ("realm", "stream")
 
+post_save.connect(flush_realm_state, sender=DefaultStream)
+post_delete.connect(flush_realm_state, sender=DefaultStream)
+
 class DefaultStreamGroup(models.Model):
     MAX_NAME_LENGTH = 60
     name = models.CharField(max_length=MAX_NAME_LENGTH, db_index=True)  # type: str
@@ -1877,6 +1920,11 @@ class DefaultStreamGroup(models.Model):
                     description=self.description,
                     streams=[stream.to_dict() for stream in self.streams.all()])
 
+post_save.connect(flush_realm_state, sender=DefaultStreamGroup)
+post_delete.connect(flush_realm_state, sender=DefaultStreamGroup)
+# The instance is the group, or the stream if it's changed from that end.
+m2m_changed.connect(flush_realm_state, sender=DefaultStreamGroup.streams.through)
+
 def get_default_stream_groups(realm: Realm) -> List[DefaultStreamGroup]:
     return DefaultStreamGroup.objects.filter(realm=realm)
 
@@ -2062,6 +2110,9 @@ class CustomProfileField(models.Model):
     def __str__(self) -> str:
         return "<CustomProfileField: %s %s %s %d>" % (self.realm, self.name, self.field_type, self.order)
 
+post_save.connect(flush_realm_state, sender=CustomProfileField)
+post_delete.connect(flush_realm_state, sender=CustomProfileField)
+
 def custom_profile_fields_for_realm(realm_id: int) -> List[CustomProfileField]:
     return CustomProfileField.objects.filter(realm=realm_id).order_by('order')
 
@@ -2076,6 +2127,12 @@ class CustomProfileFieldValue(models.Model):
     def __str__(self) -> str:
         return "<CustomProfileFieldValue: %s %s %s>" % (self.user_profile, self.field, self.value)
 
+def flush_custom_profile_field_value(sender: Any, **kwargs: Any) -> None:
+    bump_realm_state_version(kwargs['instance'].field.realm_id)
+
+post_save.connect(flush_custom_profile_field_value, sender=CustomProfileFieldValue)
+post_delete.connect(flush_custom_profile_field_value, sender=CustomProfileFieldValue)
+
 # Interfaces for services
 # They provide additional functionality like parsing message to obtain query url, data to be sent to url,
 # and parsing the response.
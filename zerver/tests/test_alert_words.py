@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from zerver.lib.alert_words import (
+    AlertWordMatcher,
     add_user_alert_words,
     alert_words_in_realm,
+    get_alert_word_matcher,
     remove_user_alert_words,
     user_alert_words,
 )
@@ -199,3 +201,53 @@ class AlertWordTests(ZulipTestCase):
         user_message = most_recent_usermessage(user_profile)
         self.assertEqual(user_message.message.content, 'sorry false alarm')
         self.assertNotIn('has_alert_word', user_message.flags_list())
+
+    def test_alert_word_matcher(self) -> None:
+        matcher = AlertWordMatcher({
+            1: ['ALERT', 'he', 'hers', ''],
+            2: ['alert', 'multi-word word', u'☃'],
+            3: ['she'],
+        })
+
+        # Words are matched case-insensitively, and reported as each
+        # user entered them.
+        self.assertEqual(matcher.match('an Alert!', {1, 2, 3}),
+                         ({'ALERT', 'alert'}, {1, 2}))
+        self.assertEqual(matcher.match('an Alert!', {2, 3}),
+                         ({'alert'}, {2}))
+
+        # Overlapping words, at the ends of the content.
+        self.assertEqual(matcher.match('she', {1, 2, 3}),
+                         ({'she'}, {3}))
+        self.assertEqual(matcher.match('(hers) he', {1, 2, 3}),
+                         ({'hers', 'he'}, {1}))
+        self.assertEqual(matcher.match(u'> ☃ multi-word word.', {1, 2, 3}),
+                         ({u'☃', 'multi-word word'}, {2}))
+
+        # Words must be delimited.
+        self.assertEqual(matcher.match('alerts ushers xalert', {1, 2, 3}),
+                         (set(), set()))
+        self.assertEqual(matcher.match('', {1, 2, 3}), (set(), set()))
+        self.assertEqual(AlertWordMatcher({}).match('alert', {1}), (set(), set()))
+
+        # restrict keeps just the words in the content, of the given users.
+        restricted = matcher.restrict('an Alert for her, or hers', {1, 2})
+        self.assertEqual(restricted.users_by_word, {'alert': {'ALERT': {1}, 'alert': {2}},
+                                                    'hers': {'hers': {1}}})
+        self.assertEqual(restricted.get_user_ids(), {1, 2})
+        self.assertEqual(restricted.match('hers', {1, 2}), ({'hers'}, {1}))
+        self.assertIsNone(matcher.restrict('an alert', {3}))
+
+    def test_alert_word_matcher_invalidation(self) -> None:
+        user = self.example_user('cordelia')
+        matcher = get_alert_word_matcher(user.realm)
+        self.assertIs(get_alert_word_matcher(user.realm), matcher)
+        self.assertEqual(matcher.match('milk', {user.id}), (set(), set()))
+
+        add_user_alert_words(user, ['milk'])
+        matcher = get_alert_word_matcher(user.realm)
+        self.assertEqual(matcher.match('milk', {user.id}), ({'milk'}, {user.id}))
+
+        remove_user_alert_words(user, ['milk'])
+        matcher = get_alert_word_matcher(user.realm)
+        self.assertEqual(matcher.match('milk', {user.id}), (set(), set()))
@@ -4,6 +4,7 @@ from django.test import TestCase, override_settings
 
 from zerver.lib import bugdown
 from zerver.lib.actions import (
+    do_change_full_name,
     do_set_user_display_setting,
     do_remove_realm_emoji,
     do_set_alert_words,
@@ -14,10 +15,13 @@ from zerver.lib.camo import get_camo_url
 from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.mention import possible_mentions, possible_user_group_mentions
-from zerver.lib.message import render_markdown
+from zerver.lib.message import render_markdown, render_markdown_many
 from zerver.lib.request import (
     JsonableError,
 )
+from zerver.lib.mention_index import get_realm_mention_index
+from zerver.lib.process_pool import close_process_pool
+from zerver.lib.test_helpers import queries_captured
 from zerver.lib.user_groups import create_user_group
 from zerver.lib.test_classes import (
     ZulipTestCase,
@@ -218,6 +222,39 @@ class BugdownMiscTest(ZulipTestCase):
         assert(user is not None)
         self.assertEqual(user['email'], hamlet.email)
 
+    def test_mention_index(self) -> None:
+        realm = get_realm('zulip')
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        content = '@**King Hamlet** @*support* #**Denmark** !avatar(othello@zulip.com)'
+
+        get_realm_mention_index(realm.id)
+        with queries_captured() as queries:
+            mention_data = bugdown.MentionData(realm.id, content)
+            stream_name_info = bugdown.get_stream_name_info(realm, {'Denmark', 'Not A Stream'})
+            email_info = bugdown.get_email_info(realm.id, {'OTHELLO@zulip.com'})
+        self.assert_length(queries, 0)
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+        self.assertEqual(set(stream_name_info.keys()), {'Denmark'})
+        self.assertEqual(email_info['othello@zulip.com']['id'], othello.id)
+
+        # Changes are picked up through the cache flush signals.
+        do_change_full_name(hamlet, 'Prince Hamlet', hamlet)
+        support = create_user_group('support', [othello], realm)
+        mention_data = bugdown.MentionData(realm.id, '@**Prince Hamlet** @*support*')
+        self.assertEqual(mention_data.get_user_ids(), {hamlet.id})
+        self.assertEqual(mention_data.get_group_members(support.id), [othello.id])
+        self.assertIsNone(bugdown.MentionData(realm.id, content).get_user('King Hamlet'))
+
+    def test_mention_index_version_read_once(self) -> None:
+        realm = get_realm('zulip')
+        content = '@**King Hamlet** @*support* #**Denmark** !avatar(othello@zulip.com)'
+        msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        with mock.patch('zerver.lib.mention_index.cache_get',
+                        return_value=None) as mock_cache_get:
+            render_markdown(msg, content)
+        mock_cache_get.assert_called_once_with('realm_mention_index_version:%s' % (realm.id,))
+
     def test_invalid_katex_path(self) -> None:
         with self.settings(STATIC_ROOT="/invalid/path"):
             with mock.patch('logging.error') as mock_logger:
@@ -715,6 +752,46 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(len(zulip_filters), 1)
         self.assertEqual(zulip_filters[0],
                          (u'#(?P<id>[0-9]{2,8})', u'https://trac.zulip.net/ticket/%(id)s', realm_filter.id))
+        # Loading the filters doesn't build any engines.
+        self.assertNotIn((realm.id, False), bugdown.md_engines)
+
+    def test_md_engine_updates_in_place(self) -> None:
+        realm = get_realm('zulip')
+        msg = Message(sender=self.example_user('hamlet'))
+        md_engine = bugdown.get_md_engine(realm.id, False, [])
+        self.assertEqual(bugdown.convert('#123', message_realm=realm, message=msg),
+                         '<p>#123</p>')
+
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        converted = bugdown.convert('#123', message_realm=realm, message=msg)
+        self.assertEqual(converted, '<p><a href="https://trac.zulip.net/ticket/123" target="_blank" title="https://trac.zulip.net/ticket/123">#123</a></p>')
+        # The new filter was swapped into the existing engine.
+        self.assertIs(bugdown.md_engines[(realm.id, False)], md_engine)
+
+        # Swapped-in filters run after autolink, as in a new engine.
+        content = 'https://github.com/zulip/zulip#123'
+        converted = bugdown.convert(content, message_realm=realm, message=msg)
+        self.assertNotIn('trac.zulip.net', converted)
+        del bugdown.md_engines[(realm.id, False)]
+        self.assertEqual(bugdown.convert(content, message_realm=realm, message=msg), converted)
+        md_engine = bugdown.md_engines[(realm.id, False)]
+
+        RealmFilter.objects.filter(realm=realm).delete()
+        self.assertEqual(bugdown.convert('#123', message_realm=realm, message=msg),
+                         '<p>#123</p>')
+        self.assertIs(bugdown.md_engines[(realm.id, False)], md_engine)
+
+    def test_md_engine_lru(self) -> None:
+        with mock.patch('zerver.lib.bugdown.MAX_MD_ENGINES', 2):
+            bugdown.md_engines.clear()
+            first = bugdown.get_md_engine(1000, False, [])
+            bugdown.get_md_engine(1001, False, [])
+            # Using the first engine makes the second the least recently used.
+            self.assertIs(bugdown.get_md_engine(1000, False, []), first)
+            bugdown.get_md_engine(1002, False, [])
+            self.assertEqual(list(bugdown.md_engines.keys()),
+                             [(1000, False), (1002, False)])
 
     def test_flush_realm_filter(self) -> None:
         realm = get_realm('zulip')
@@ -897,6 +974,62 @@ class BugdownTest(ZulipTestCase):
                          '@King Hamlet</span></p>' % (user_id))
         self.assertEqual(msg.mentions_user_ids, set([user_profile.id]))
 
+    @override_settings(BUGDOWN_RENDER_PROCESSES=2)
+    def test_render_pool(self) -> None:
+        self.addCleanup(close_process_pool, 'bugdown')
+        sender_user_profile = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        contents = ["@**King Hamlet**", "@**Cordelia Lear**", "**bold**"]
+        msgs = [Message(sender=sender_user_profile, sending_client=get_client("test"))
+                for content in contents]
+
+        rendered = render_markdown_many([
+            dict(message=msg, content=content)
+            for msg, content in zip(msgs, contents)
+        ])
+        self.assertEqual(rendered, [
+            '<p><span class="user-mention" data-user-id="%s">@King Hamlet</span></p>' % (hamlet.id,),
+            '<p><span class="user-mention" data-user-id="%s">@Cordelia Lear</span></p>' % (cordelia.id,),
+            '<p><strong>bold</strong></p>',
+        ])
+        self.assertEqual(msgs[0].mentions_user_ids, {hamlet.id})
+        self.assertEqual(msgs[1].mentions_user_ids, {cordelia.id})
+        self.assertEqual(msgs[2].mentions_user_ids, set())
+
+    @override_settings(BUGDOWN_RENDER_CACHE=True)
+    def test_render_cache(self) -> None:
+        sender_user_profile = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+
+        def render(content: str, **kwargs: Any) -> Tuple[str, Message, List[Any]]:
+            msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+            with mock.patch('zerver.lib.bugdown.run_render_jobs',
+                            wraps=bugdown.run_render_jobs) as mock_run:
+                rendered_content = render_markdown(msg, content, **kwargs)
+            [(render_jobs,), call_kwargs] = mock_run.call_args
+            return rendered_content, msg, render_jobs
+
+        content = 'Build **#1234** passed: https://ci.example.com/builds/1234'
+        rendered_content, msg, render_jobs = render(content)
+        self.assertEqual(len(render_jobs), 1)
+        self.assertEqual(render(content)[0], rendered_content)
+        self.assertEqual(render(content)[2], [])
+
+        # Content that renders differently for different users isn't cached.
+        content = '@**King Hamlet** build #1234 passed'
+        for i in range(2):
+            rendered_content, msg, render_jobs = render(content)
+            self.assertEqual(len(render_jobs), 1)
+            self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+
+        content = 'Build #1234 passed'
+        for i in range(2):
+            rendered_content, msg, render_jobs = render(
+                content, realm_alert_words={hamlet.id: ['passed']}, user_ids={hamlet.id})
+            self.assertEqual(len(render_jobs), 1)
+            self.assertEqual(msg.user_ids_with_alert_words, {hamlet.id})
+
     def test_possible_mentions(self) -> None:
         def assert_mentions(content: str, names: Set[str]) -> None:
             self.assertEqual(possible_mentions(content), names)
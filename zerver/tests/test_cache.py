@@ -1,7 +1,13 @@
 from mock import Mock, patch
 
 from zerver.apps import flush_cache
+from zerver.lib import cache
+from zerver.lib.actions import do_regenerate_api_key
+from zerver.lib.cache import bump_local_cache_generations, expire_local_cache_validation
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import UserProfile, get_realm, get_user_id_by_api_key, \
+    get_user_profile_by_api_key
 
 class AppsTest(ZulipTestCase):
     def test_cache_gets_flushed(self) -> None:
@@ -11,3 +17,70 @@ class AppsTest(ZulipTestCase):
                 flush_cache(Mock())
                 mock.assert_called_once()
             mock_logging.assert_called_once()
+
+class LocalCacheTest(ZulipTestCase):
+    def test_get_realm(self) -> None:
+        get_realm('zulip')
+        with queries_captured() as queries:
+            realm = get_realm('zulip')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(realm.string_id, 'zulip')
+        # Each call gets its own copy.
+        self.assertIsNot(get_realm('zulip'), realm)
+
+        realm.name = 'New name'
+        realm.save(update_fields=['name'])
+        with queries_captured() as queries:
+            self.assertEqual(get_realm('zulip').name, 'New name')
+        self.assertEqual(len(queries), 1)
+
+        # Nonexistent realms are cached too, until one is created.
+        self.assertIsNone(get_realm('nonexistent'))
+        realm.string_id = 'nonexistent'
+        realm.save()
+        self.assertEqual(get_realm('nonexistent').id, realm.id)
+        self.assertIsNone(get_realm('zulip'))
+
+    def test_invalidation_from_other_processes(self) -> None:
+        hamlet = self.example_user('hamlet')
+        get_user_id_by_api_key(hamlet.api_key)
+        with patch('zerver.lib.cache.cache_get') as mock_cache_get:
+            self.assertEqual(get_user_id_by_api_key(hamlet.api_key), hamlet.id)
+        mock_cache_get.assert_not_called()
+        hits = cache.get_local_cache_hits()
+
+        # Simulate another process invalidating the family: we don't
+        # notice until the next request.
+        cache.local_cache_generations['user_id_by_api_key'] = -1
+        get_user_id_by_api_key(hamlet.api_key)
+        self.assertEqual(cache.get_local_cache_hits(), hits + 1)
+
+        expire_local_cache_validation()
+        misses = cache.get_local_cache_misses()
+        get_user_id_by_api_key(hamlet.api_key)
+        self.assertEqual(cache.get_local_cache_misses(), misses + 1)
+
+        bump_local_cache_generations(['user_id_by_api_key'])
+        self.assertNotIn(cache.KEY_PREFIX + cache.user_id_by_api_key_cache_key(hamlet.api_key),
+                         cache.local_cache)
+
+    def test_api_key_family_only_bumped_when_key_changes(self) -> None:
+        hamlet = self.example_user('hamlet')
+        generation_key = cache.local_cache_generation_key('user_id_by_api_key')
+        generation = cache.cache_get(generation_key)
+
+        get_user_profile_by_api_key(hamlet.api_key)
+        hamlet.is_realm_admin = True
+        hamlet.save(update_fields=['is_realm_admin'])
+        self.assertEqual(cache.cache_get(generation_key), generation)
+        # The profile itself is never served stale.
+        self.assertTrue(get_user_profile_by_api_key(hamlet.api_key).is_realm_admin)
+
+        old_api_key = hamlet.api_key
+        do_regenerate_api_key(hamlet, hamlet)
+        self.assertNotEqual(cache.cache_get(generation_key), generation)
+        self.assertEqual(get_user_profile_by_api_key(hamlet.api_key).id, hamlet.id)
+        self.assertNotIn(cache.KEY_PREFIX + cache.user_id_by_api_key_cache_key(old_api_key),
+                         cache.local_cache)
+        with self.assertRaises(UserProfile.DoesNotExist):
+            get_user_profile_by_api_key(old_api_key)
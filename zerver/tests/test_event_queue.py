@@ -1,18 +1,48 @@
 import mock
+import os
+import shutil
+import tempfile
+import threading
 import time
 import ujson
 
 from django.http import HttpRequest, HttpResponse
-from typing import Any, Callable, Dict, Tuple
+from django.test import override_settings
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
+from zerver.decorator import RespondAsynchronously
 from zerver.lib.actions import do_mute_topic
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
 from zerver.models import Recipient, Subscription, UserProfile, get_stream
-from zerver.tornado.event_queue import maybe_enqueue_notifications, \
+from zerver.tornado import event_queue, persistence
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.handlers import clear_shared_payloads, encode_events_response, \
+    share_payload
+from zerver.tornado.event_queue import maybe_enqueue_notifications, ClientDescriptor, \
     allocate_client_descriptor, process_message_event, clear_client_event_queues_for_testing, \
-    get_client_descriptor, missedmessage_hook
-from zerver.tornado.views import get_events_backend
+    get_client_descriptor, missedmessage_hook, send_event
+from zerver.tornado.sharding import get_queue_id_shard, get_shard_for_port, \
+    get_tornado_uri, make_queue_id, notify_tornado_queue_name, partition_users_by_shard
+from zerver.tornado.views import cleanup_event_queue, get_events_backend
+
+def allocate_client(user_profile: UserProfile,
+                    event_types: Optional[List[str]]=None,
+                    narrow: List[List[str]]=[]) -> ClientDescriptor:
+    return allocate_client_descriptor(dict(
+        user_profile_id=user_profile.id,
+        user_profile_email=user_profile.email,
+        realm_id=user_profile.realm_id,
+        event_types=event_types,
+        client_type_name='website',
+        apply_markdown=True,
+        client_gravatar=False,
+        all_public_streams=False,
+        queue_timeout=600,
+        last_connection_time=time.time(),
+        narrow=narrow,
+    ))
 
 class MissedMessageNotificationsTest(ZulipTestCase):
     """Tests the logic for when missed-message notifications
@@ -285,3 +315,333 @@ class MissedMessageNotificationsTest(ZulipTestCase):
         sub.push_notifications = True
         sub.in_home_view = True
         sub.save()
+
+class TornadoShardingTest(ZulipTestCase):
+    @override_settings(TORNADO_PROCESSES=3, TORNADO_SERVER='http://127.0.0.1:9993')
+    def test_routing(self) -> None:
+        self.assertEqual(get_tornado_uri(0), 'http://127.0.0.1:9993')
+        self.assertEqual(get_tornado_uri(2), 'http://127.0.0.1:9995')
+        self.assertEqual(get_shard_for_port(9994), 1)
+        self.assertEqual(get_shard_for_port(9996), None)
+        self.assertEqual(notify_tornado_queue_name(1), 'notify_tornado_shard1')
+
+        with mock.patch('zerver.tornado.sharding.current_shard', 2):
+            queue_id = make_queue_id(7)
+        self.assertEqual(get_queue_id_shard(queue_id), 2)
+        self.assertEqual(get_queue_id_shard('1234:7'), 0)
+
+        users = [dict(id=3, flags=[]), dict(id=4, flags=['mentioned'])]
+        event = dict(type='message', stream_name='Denmark', realm_id=1)
+        self.assertEqual(partition_users_by_shard(event, users),
+                         {0: [users[0]], 1: [users[1]], 2: []})
+
+        event['invite_only'] = True
+        self.assertEqual(partition_users_by_shard(event, users),
+                         {0: [users[0]], 1: [users[1]]})
+        self.assertEqual(partition_users_by_shard(dict(type='pointer'), [5, 6, 8]),
+                         {2: [5, 8], 0: [6]})
+
+    @override_settings(TORNADO_PROCESSES=3)
+    def test_send_event(self) -> None:
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            send_event(dict(type='pointer', pointer=5), [3, 4, 7])
+
+        published = {
+            call[0][0]: call[0][1]['users']
+            for call in mock_publish.call_args_list
+        }
+        self.assertEqual(published, {
+            'notify_tornado_shard0': [3],
+            'notify_tornado_shard1': [4, 7],
+        })
+
+    @override_settings(TORNADO_PROCESSES=3)
+    def test_cleanup_forwarded_to_owning_shard(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user('hamlet')
+        with mock.patch('zerver.tornado.sharding.current_shard', 1):
+            client = allocate_client(hamlet)
+        queue_id = client.event_queue.id
+
+        # The DELETE reached shard 0, which passes it on to shard 1.
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish',
+                        side_effect=queue_json_publish) as mock_publish:
+            cordelia = self.example_user('cordelia')
+            result = cleanup_event_queue(POSTRequestMock(dict(queue_id=queue_id), cordelia),
+                                         cordelia)
+            self.assert_json_success(result)
+            self.assertEqual(mock_publish.call_args[0][0], 'notify_tornado_shard1')
+            # Only the queue's owner may delete it.
+            self.assertEqual(get_client_descriptor(queue_id), client)
+
+            result = cleanup_event_queue(POSTRequestMock(dict(queue_id=queue_id), hamlet), hamlet)
+            self.assert_json_success(result)
+        self.assertIsNone(get_client_descriptor(queue_id))
+
+        with self.assertRaises(BadEventQueueIdError):
+            cleanup_event_queue(POSTRequestMock(dict(queue_id='7:1234:1'), hamlet), hamlet)
+        clear_client_event_queues_for_testing()
+
+    @override_settings(TORNADO_PROCESSES=3)
+    def test_new_queue_forwarded_to_user_shard(self) -> None:
+        hamlet = self.example_user('hamlet')
+        request = POSTRequestMock(dict(dont_block=ujson.dumps(True)), hamlet)
+        # nginx sends requests without a queue_id to shard 0.
+        with mock.patch('zerver.tornado.sharding.current_shard', (hamlet.id + 1) % 3), \
+                mock.patch('zerver.tornado.views.forward_events_request') as mock_forward:
+            result = get_events_backend(request, hamlet)
+        self.assertEqual(result, RespondAsynchronously)
+        mock_forward.assert_called_once_with(request, hamlet.id,
+                                             request._tornado_handler.handler_id)
+
+class EventQueuePersistenceTest(ZulipTestCase):
+    def tearDown(self) -> None:
+        if event_queue.checkpoint_log is not None:
+            event_queue.checkpoint_log.close()
+        event_queue.checkpoint_log = None
+        event_queue.snapshot_id = None
+        event_queue.dirty_queue_ids.clear()
+        event_queue.deleted_queue_ids.clear()
+        clear_client_event_queues_for_testing()
+        super().tearDown()
+
+    def test_checkpoint_and_load(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        filename = os.path.join(tmp_dir, 'event_queues.marshal')
+
+        with override_settings(PERSISTENT_QUEUE_FILENAME=filename):
+            first_client = allocate_client(hamlet)
+            event_queue.write_event_queue_snapshot()
+
+            # Changes after the snapshot go to the checkpoint log.
+            first_client.add_event(dict(type='pointer', pointer=5))
+            second_client = allocate_client(cordelia)
+            second_client.add_event(dict(type='update_display_settings', setting='x'))
+            event_queue.checkpoint_event_queues()
+            self.assertEqual(event_queue.dirty_queue_ids, set())
+
+            event_queue.do_gc_event_queues({second_client.event_queue.id},
+                                           {cordelia.id}, {cordelia.realm_id})
+            event_queue.checkpoint_event_queues()
+
+            # Simulate a crash in the middle of writing a checkpoint.
+            with open(filename + '.log', 'ab') as f:
+                f.write(b'\x00\x00\x10\x00partial')
+
+            clear_client_event_queues_for_testing()
+            event_queue.load_event_queues()
+
+            self.assertEqual(list(event_queue.clients.keys()), [first_client.event_queue.id])
+            client = get_client_descriptor(first_client.event_queue.id)
+            self.assertEqual(client.event_queue.contents(),
+                             [dict(type='pointer', pointer=5, id=0)])
+            self.assertEqual(event_queue.get_client_descriptors_for_user(hamlet.id), [client])
+
+    def test_stale_log_ignored(self) -> None:
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        snapshot_filename = os.path.join(tmp_dir, 'event_queues.marshal')
+        log_filename = snapshot_filename + '.log'
+
+        persistence.write_snapshot(snapshot_filename, 1.0, [('1:1', dict(a=1))])
+        log = persistence.open_log(log_filename, 1.0)
+        persistence.append_to_log(log, [('1:2', dict(b=2))], ['1:1'])
+        log.close()
+        self.assertEqual(persistence.load_client_dicts(snapshot_filename, log_filename),
+                         (1.0, {'1:2': dict(b=2)}))
+
+        # A log started for an older snapshot is never replayed.
+        persistence.write_snapshot(snapshot_filename, 2.0, [('1:1', dict(a=1))])
+        self.assertEqual(persistence.load_client_dicts(snapshot_filename, log_filename),
+                         (2.0, {'1:1': dict(a=1)}))
+
+class SharedMessagePayloadTest(ZulipTestCase):
+    def test_payload_shared_across_clients(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet_client = allocate_client(self.example_user('hamlet'), event_types=['message'])
+        cordelia_client = allocate_client(self.example_user('cordelia'), event_types=['message'])
+        self.send_stream_message(self.example_email('iago'), 'Verona',
+                                 content='@**King Hamlet** hi')
+
+        hamlet_event = hamlet_client.event_queue.contents()[0]
+        cordelia_event = cordelia_client.event_queue.contents()[0]
+        self.assertIs(hamlet_event['message'], cordelia_event['message'])
+        self.assertIn('mentioned', hamlet_event['flags'])
+        self.assertNotIn('mentioned', cordelia_event['flags'])
+        clear_client_event_queues_for_testing()
+
+    def test_encode_events_response(self) -> None:
+        payload = dict(id=1, content='<p>hi</p>', display_recipient=[dict(id=2)])
+        response = dict(result='success', msg='', queue_id='1:2',
+                        events=[dict(type='message', message=payload, flags=['read'], id=0),
+                                dict(type='pointer', pointer=5, id=1)])
+
+        # Nothing is being fanned out, so json_response does the work.
+        self.assertIsNone(encode_events_response(response))
+
+        share_payload(payload)
+        try:
+            content = encode_events_response(response)
+            self.assertEqual(ujson.loads(content), response)
+            self.assertTrue(content.endswith('\n'))
+            # The second time around, we reuse the payload's JSON.
+            with mock.patch('ujson.dumps', side_effect=ujson.dumps) as mock_dumps:
+                self.assertEqual(encode_events_response(response), content)
+            self.assertNotIn(mock.call(payload), mock_dumps.call_args_list)
+        finally:
+            clear_shared_payloads()
+        self.assertIsNone(encode_events_response(response))
+
+class NarrowedClientIndexTest(ZulipTestCase):
+    def test_narrowed_clients_indexed(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user('hamlet')
+        self.unsubscribe(hamlet, 'Denmark')
+        denmark_client = allocate_client(hamlet, event_types=['message'],
+                                         narrow=[['stream', 'denmark']])
+        topic_client = allocate_client(hamlet, event_types=['message'],
+                                       narrow=[['stream', 'Denmark'], ['topic', 'Bar']])
+        verona_client = allocate_client(hamlet, event_types=['message'],
+                                        narrow=[['stream', 'Verona']])
+        self.assertEqual(event_queue.realm_clients_all_streams, {})
+
+        message = dict(type='stream', display_recipient='Denmark', subject='foo',
+                       sender_email=self.example_email('iago'))
+        self.assertEqual(event_queue.get_narrowed_client_descriptors_for_message(hamlet.realm_id,
+                                                                                 message),
+                         [denmark_client])
+
+        self.send_stream_message(self.example_email('iago'), 'Denmark', topic_name='bar')
+        self.assertEqual(len(denmark_client.event_queue.contents()), 1)
+        self.assertEqual(len(topic_client.event_queue.contents()), 1)
+        self.assertEqual(len(verona_client.event_queue.contents()), 0)
+
+        event_queue.do_gc_event_queues({denmark_client.event_queue.id, topic_client.event_queue.id},
+                                       {hamlet.id}, {hamlet.realm_id})
+        self.assertEqual(list(event_queue.realm_narrowed_clients[hamlet.realm_id].values()),
+                         [[verona_client]])
+        event_queue.do_gc_event_queues({verona_client.event_queue.id}, {hamlet.id}, {hamlet.realm_id})
+        self.assertEqual(event_queue.realm_narrowed_clients, {})
+        clear_client_event_queues_for_testing()
+
+class EventQueueTimersTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        idle_client = allocate_client(hamlet)
+        connected_client = allocate_client(cordelia)
+        connected_client.connect_handler(0, 'website')
+
+        with mock.patch('time.time', return_value=time.time() + 601):
+            now = time.time()
+            event_queue.gc_event_queues()
+        self.assertEqual(list(event_queue.clients.keys()), [connected_client.event_queue.id])
+        self.assertEqual(event_queue.get_client_descriptors_for_user(hamlet.id), [])
+
+        # The connected client was rescheduled, rather than rechecked
+        # on every GC.
+        self.assertEqual(event_queue.gc_heap, [(now + 600, connected_client.event_queue.id)])
+        clear_client_event_queues_for_testing()
+
+    def test_send_heartbeats(self) -> None:
+        clear_client_event_queues_for_testing()
+        client = allocate_client(self.example_user('hamlet'))
+        client.connect_handler(0, 'website')
+        self.assertEqual(sum(len(clients) for clients in event_queue.heartbeat_slots.values()), 1)
+
+        with mock.patch('zerver.tornado.event_queue.finish_handler') as mock_finish:
+            event_queue.send_heartbeats()
+            mock_finish.assert_not_called()
+
+            with mock.patch('time.time', return_value=time.time() + 56):
+                event_queue.send_heartbeats()
+            mock_finish.assert_called_once()
+        self.assertEqual(client.event_queue.contents(), [dict(type='heartbeat', id=0)])
+        self.assertEqual(event_queue.heartbeat_slots, {})
+        self.assertIsNone(client.current_handler_id)
+
+        # Disconnecting cancels the heartbeat.
+        client.connect_handler(0, 'website')
+        client.disconnect_handler()
+        self.assertEqual(sum(len(clients) for clients in event_queue.heartbeat_slots.values()), 0)
+        clear_client_event_queues_for_testing()
+
+class BatchedNotificationsTest(ZulipTestCase):
+    def test_batch_events(self) -> None:
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            with event_queue.batch_events():
+                event_queue.send_event(dict(type='pointer', pointer=5), [1])
+                with event_queue.batch_events():
+                    event_queue.send_event(dict(type='pointer', pointer=6), [2])
+                mock_publish.assert_not_called()
+        mock_publish.assert_called_once()
+        self.assertEqual(mock_publish.call_args[0][:2],
+                         ('notify_tornado',
+                          dict(notices=[dict(event=dict(type='pointer', pointer=5), users=[1]),
+                                        dict(event=dict(type='pointer', pointer=6), users=[2])])))
+
+        # A batch of one is sent as a plain notice.
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            with event_queue.batch_events():
+                event_queue.send_event(dict(type='pointer', pointer=5), [1])
+        self.assertEqual(mock_publish.call_args[0][1],
+                         dict(event=dict(type='pointer', pointer=5), users=[1]))
+
+    def test_batch_events_is_per_thread(self) -> None:
+        def send_from_other_thread() -> None:
+            event_queue.send_event(dict(type='pointer', pointer=6), [2])
+
+        with mock.patch('zerver.tornado.event_queue.queue_json_publish') as mock_publish:
+            with event_queue.batch_events():
+                thread = threading.Thread(target=send_from_other_thread)
+                thread.start()
+                thread.join()
+                # The other thread's event wasn't pulled into our batch.
+                mock_publish.assert_called_once()
+                self.assertEqual(mock_publish.call_args[0][1],
+                                 dict(event=dict(type='pointer', pointer=6), users=[2]))
+                event_queue.send_event(dict(type='pointer', pointer=5), [1])
+        self.assertEqual(mock_publish.call_count, 2)
+        self.assertEqual(mock_publish.call_args[0][1],
+                         dict(event=dict(type='pointer', pointer=5), users=[1]))
+
+    def test_process_notifications(self) -> None:
+        clear_client_event_queues_for_testing()
+        hamlet = self.example_user('hamlet')
+        client = allocate_client(hamlet)
+        client.connect_handler(0, 'website')
+
+        notices = [dict(event=dict(type='alert_words', alert_words=[word]), users=[hamlet.id])
+                   for word in ['foo', 'bar']]
+        with mock.patch('zerver.tornado.event_queue.finish_handler') as mock_finish:
+            event_queue.process_notification_data(dict(notices=notices))
+        # The handler was only finished once, with both events.
+        mock_finish.assert_called_once()
+        self.assertEqual([event['alert_words'] for event in mock_finish.call_args[0][2]],
+                         [['foo'], ['bar']])
+        self.assertIsNone(event_queue.deferred_finish_clients)
+
+        # A notice that fails doesn't stop the rest of the batch.
+        notices = [dict(event=dict(type='alert_words', alert_words=['foo']), users=[hamlet.id]),
+                   dict(event=dict(type='alert_words', alert_words=['bar']), users=[hamlet.id])]
+        real_process_notification = event_queue.process_notification
+
+        def process_notification(notice: Mapping[str, Any]) -> None:
+            if notice['event']['alert_words'] == ['foo']:
+                raise Exception('bad notice')
+            real_process_notification(notice)
+
+        with mock.patch('zerver.tornado.event_queue.process_notification',
+                        side_effect=process_notification), \
+                mock.patch('zerver.tornado.event_queue.finish_handler') as mock_finish, \
+                mock.patch('logging.exception') as mock_log:
+            event_queue.process_notification_data(dict(notices=notices))
+        mock_log.assert_called_once()
+        mock_finish.assert_called_once()
+        self.assertEqual([event['alert_words'] for event in mock_finish.call_args[0][2]],
+                         [['bar']])
+        clear_client_event_queues_for_testing()
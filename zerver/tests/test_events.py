@@ -92,6 +92,7 @@ from zerver.lib.actions import (
     remove_members_from_user_group,
     check_delete_user_group,
 )
+from zerver.lib.cache import get_cache_backend, local_cache
 from zerver.lib.events import (
     apply_events,
     fetch_initial_state_data,
@@ -116,6 +117,7 @@ from zerver.lib.validator import (
     equals, check_none_or, Validator, check_url
 )
 from zerver.lib.upload import upload_backend, attachment_url_to_path_id
+from zerver.lib.user_groups import create_user_group
 
 from zerver.views.events_register import _default_all_public_streams, _default_narrow
 
@@ -2267,6 +2269,48 @@ class FetchInitialStateDataTest(ZulipTestCase):
         result = fetch_initial_state_data(user_profile, None, "", client_gravatar=False)
         self.assertEqual(result['max_message_id'], -1)
 
+    def test_realm_state_cache(self) -> None:
+        user_profile = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        event_types = ['realm_domains', 'realm_user']
+
+        result = fetch_initial_state_data(user_profile, event_types, "", client_gravatar=False)
+        realm_domains = result['realm_domains']
+
+        # Nothing changed, so we serve the cached sections.
+        with queries_captured() as queries:
+            result = fetch_initial_state_data(user_profile, ['realm_domains'], "",
+                                              client_gravatar=False)
+        self.assert_length(queries, 0)
+        self.assertEqual(result['realm_domains'], realm_domains)
+
+        # We notice changes even when nobody sends an event for them.
+        RealmDomain.objects.create(realm=user_profile.realm, domain='zulip.org',
+                                   allow_subdomains=False)
+        result = fetch_initial_state_data(user_profile, ['realm_domains'], "",
+                                          client_gravatar=False)
+        self.assertIn(dict(domain='zulip.org', allow_subdomains=False), result['realm_domains'])
+
+        cordelia.full_name = 'Cordelia Lear'
+        cordelia.save(update_fields=['full_name'])
+        result = fetch_initial_state_data(user_profile, event_types, "", client_gravatar=False)
+        self.assertEqual(result['raw_users'][cordelia.id]['full_name'], 'Cordelia Lear')
+
+        # Bulk operations that skip the signals bump the version themselves.
+        create_user_group('hamlets', [user_profile], user_profile.realm)
+        cordelia_group = create_user_group('cordelias', [], user_profile.realm)
+        fetch_initial_state_data(user_profile, ['realm_user_groups'], "", client_gravatar=False)
+        bulk_add_members_to_user_group(cordelia_group, [cordelia])
+        result = fetch_initial_state_data(user_profile, ['realm_user_groups'], "",
+                                          client_gravatar=False)
+        members = {group['name']: group['members'] for group in result['realm_user_groups']}
+        self.assertEqual(members['hamlets'], [user_profile.id])
+        self.assertEqual(members['cordelias'], [cordelia.id])
+
+        # Each client_gravatar setting gets its own copy of realm_users.
+        result = fetch_initial_state_data(user_profile, event_types, "", client_gravatar=True)
+        self.assertIsNone(result['raw_users'][cordelia.id]['avatar_url'])
+
 class GetUnreadMsgsTest(ZulipTestCase):
     def mute_stream(self, user_profile: UserProfile, stream: Stream) -> None:
         recipient = Recipient.objects.get(type_id=stream.id, type=Recipient.STREAM)
@@ -2947,8 +2991,56 @@ class FetchQueriesTest(ZulipTestCase):
                     client_gravatar=False,
                 )
 
-        self.assert_length(queries, 29)
+        self.assert_length(queries, 32)
 
+        # The full fetch above also cached the realm-wide sections
+        # (see fetch_realm_state), the realm's stream traffic and
+        # the subscriber lists, which makes those cheaper.
+        expected_counts = dict(
+            alert_words=0,
+            custom_profile_fields=0,
+            default_streams=0,
+            default_stream_groups=0,
+            hotspots=0,
+            message=1,
+            muted_topics=1,
+            pointer=0,
+            # Served from the realm's presence snapshot, which the
+            # full fetch above built.
+            presence=0,
+            realm=0,
+            realm_bot=1,
+            realm_domains=0,
+            realm_embedded_bots=0,
+            realm_emoji=0,
+            realm_filters=0,
+            realm_user=2,
+            realm_user_groups=0,
+            stream=2,
+            subscription=4,
+            update_display_settings=0,
+            update_global_notifications=0,
+            # The full fetch above built the unread index; now we
+            # just check it for new messages.
+            update_message_flags=5,
+            zulip_version=0,
+        )
+
+        wanted_event_types = {
+            item[0][0] for item
+            in want_mock.call_args_list
+        }
+
+        self.assertEqual(wanted_event_types, set(expected_counts))
+        self.check_section_queries(user, expected_counts, cold_cache=False)
+
+    def test_queries_cold_cache(self) -> None:
+        user = self.example_user("hamlet")
+
+        self.login(user.email)
+
+        # What each section costs when nothing is cached (e.g. right
+        # after a deploy), which the caches must not make worse.
         expected_counts = dict(
             alert_words=0,
             custom_profile_fields=1,
@@ -2971,20 +3063,20 @@ class FetchQueriesTest(ZulipTestCase):
             subscription=6,
             update_display_settings=0,
             update_global_notifications=0,
-            update_message_flags=5,
+            # Building the unread index; see zerver.lib.unread_index.
+            update_message_flags=8,
             zulip_version=0,
         )
+        self.check_section_queries(user, expected_counts, cold_cache=True)
 
-        wanted_event_types = {
-            item[0][0] for item
-            in want_mock.call_args_list
-        }
-
-        self.assertEqual(wanted_event_types, set(expected_counts))
-
-        for event_type in sorted(wanted_event_types):
+    def check_section_queries(self, user: UserProfile, expected_counts: Dict[str, int],
+                              cold_cache: bool) -> None:
+        for event_type in sorted(expected_counts):
             count = expected_counts[event_type]
             flush_per_request_caches()
+            if cold_cache:
+                get_cache_backend(None).clear()
+                local_cache.clear()
             with queries_captured() as queries:
                 if event_type == 'update_message_flags':
                     event_types = ['update_message_flags', 'message']
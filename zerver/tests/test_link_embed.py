@@ -1,19 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import mock
+import threading
 import ujson
 from typing import Any
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 from django.test import override_settings
 
-from zerver.models import Recipient, Message
+from zerver.models import Recipient, Message, get_realm
 from zerver.lib.actions import queue_json_publish
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import MockPythonResponse
 from zerver.worker.queue_processors import FetchLinksEmbedData
 from zerver.lib.url_preview.preview import (
     get_link_embed_data, link_embed_data_from_cache)
-from zerver.lib.url_preview.oembed import get_oembed_data
+from zerver.lib.url_preview.oembed import OEMBED_TIMEOUT_SECONDS, get_oembed_data
 from zerver.lib.url_preview.parsers import (
     OpenGraphParser, GenericParser)
 from zerver.lib.cache import cache_set, NotFoundInCache
@@ -63,6 +64,13 @@ class OembedTestCase(ZulipTestCase):
         data = get_oembed_data(url)
         self.assertIsNone(data)
 
+    @mock.patch('requests.get', side_effect=Timeout())
+    def test_request_timeout(self, get: Any) -> None:
+        url = 'http://instagram.com/p/BLtI2WdAymy'
+        with self.assertRaises(Timeout):
+            get_oembed_data(url)
+        self.assertEqual(get.call_args[1]['timeout'], OEMBED_TIMEOUT_SECONDS)
+
 
 class OpenGraphParserTestCase(ZulipTestCase):
     def test_page_with_og(self) -> None:
@@ -176,7 +184,7 @@ class PreviewTestCase(ZulipTestCase):
         url = 'http://test.org/'
         response = MockPythonResponse(self.open_graph_html, 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         with mock.patch('zerver.views.messages.queue_json_publish') as patched:
             result = self.client_patch("/json/messages/" + str(msg_id), {
@@ -189,7 +197,8 @@ class PreviewTestCase(ZulipTestCase):
             event = patched.call_args[0][1]
 
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
 
         embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
@@ -228,11 +237,12 @@ class PreviewTestCase(ZulipTestCase):
         if relative_url is True:
             response = MockPythonResponse(self.open_graph_html.replace('http://ia.media-imdb.com', ''), 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         # Run the queue processor to potentially rerender things
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
         msg = Message.objects.select_related("sender").get(id=msg_id)
         return msg
@@ -255,11 +265,12 @@ class PreviewTestCase(ZulipTestCase):
             # Mock the network request result so the test can be fast without Internet
             response = MockPythonResponse(self.open_graph_html, 200)
             mocked_response_original = mock.Mock(
-                side_effect=lambda k: {original_url: response}.get(k, MockPythonResponse('', 404)))
+                side_effect=lambda k, **kwargs: {original_url: response}.get(k, MockPythonResponse('', 404)))
             mocked_response_edited = mock.Mock(
-                side_effect=lambda k: {edited_url: response}.get(k, MockPythonResponse('', 404)))
+                side_effect=lambda k, **kwargs: {edited_url: response}.get(k, MockPythonResponse('', 404)))
             with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-                with mock.patch('requests.get', mocked_response_original):
+                with mock.patch('requests.get', mocked_response_original), \
+                        mock.patch('requests.Session.get', mocked_response_original):
                     # Run the queue processor. This will simulate the event for original_url being
                     # processed after the message has been edited.
                     FetchLinksEmbedData().consume(event)
@@ -271,7 +282,8 @@ class PreviewTestCase(ZulipTestCase):
             mocked_response_edited.assert_not_called()
 
             with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-                with mock.patch('requests.get', mocked_response_edited):
+                with mock.patch('requests.get', mocked_response_edited), \
+                        mock.patch('requests.Session.get', mocked_response_edited):
                     # Now proceed with the original queue_json_publish and call the
                     # up-to-date event for edited_url.
                     queue_json_publish(*args, **kwargs)
@@ -347,7 +359,8 @@ class PreviewTestCase(ZulipTestCase):
             'message_realm_id': msg.sender.realm_id,
             'message_content': url}
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())):
+            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())), \
+                    mock.patch('requests.Session.get', mock.Mock(side_effect=ConnectionError())):
                 with mock.patch('logging.error') as error_mock:
                     FetchLinksEmbedData().consume(event)
         self.assertEqual(error_mock.call_count, 1)
@@ -356,6 +369,62 @@ class PreviewTestCase(ZulipTestCase):
             '<p><a href="http://test.org/" target="_blank" title="http://test.org/">http://test.org/</a></p>',
             msg.rendered_content)
 
+    def test_link_fetched_once_per_batch(self) -> None:
+        url = 'http://test.org/'
+        events = []
+        for i in range(2):
+            msg_id = self.send_personal_message(
+                self.example_email('hamlet'),
+                self.example_email('cordelia'),
+                content=url,
+            )
+            events.append({
+                'message_id': msg_id,
+                'urls': [url],
+                'message_realm_id': get_realm('zulip').id,
+                'message_content': url})
+
+        response = MockPythonResponse(self.open_graph_html, 200)
+        mocked_response = mock.Mock(
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
+        with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
+            with mock.patch('requests.get', mocked_response), \
+                    mock.patch('requests.Session.get', wraps=mocked_response) as session_get:
+                FetchLinksEmbedData().consume_batch(events)
+        self.assertEqual(session_get.call_count, 1)
+
+        embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
+        for event in events:
+            msg = Message.objects.get(id=event['message_id'])
+            self.assertIn(embedded_link, msg.rendered_content)
+
+    def test_failed_fetch_is_cached(self) -> None:
+        url = 'http://test.org/'
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())), \
+                    mock.patch('logging.error') as error_mock:
+                self.assertIsNone(get_link_embed_data(url))
+                self.assertIsNone(get_link_embed_data(url))
+            self.assertIsNone(link_embed_data_from_cache(url))
+        self.assertEqual(error_mock.call_count, 1)
+
+    def test_hung_fetch_is_cached_as_failure(self) -> None:
+        url = 'http://test.org/'
+        release = threading.Event()
+
+        def hung_oembed(url: str, **kwargs: Any) -> None:
+            release.wait(5)
+
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            with mock.patch('zerver.lib.url_preview.preview.get_oembed_data',
+                            side_effect=hung_oembed), \
+                    mock.patch('zerver.lib.url_preview.preview.FETCH_WAIT_TIMEOUT_SECONDS', 0.1), \
+                    mock.patch('logging.warning') as warning_mock:
+                self.assertIsNone(get_link_embed_data(url))
+            release.set()
+            self.assertIsNone(link_embed_data_from_cache(url))
+        warning_mock.assert_called_once()
+
     def test_invalid_link(self) -> None:
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
             self.assertIsNone(get_link_embed_data('com.notvalidlink'))
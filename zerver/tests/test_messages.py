@@ -83,7 +83,7 @@ import DNS
 import mock
 import time
 import ujson
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from collections import namedtuple
 
@@ -594,6 +594,28 @@ class StreamMessagesTest(ZulipTestCase):
         num_active_users = num_extra_users / 2
         self.assertTrue(ums_created > (num_active_users * num_messages))
 
+    def test_copy_insert_ums(self) -> None:
+        """
+        Large batches of UserMessage rows are inserted with COPY; make
+        sure that path produces the same rows as the INSERT path.
+        """
+        sender = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        for user_profile in [sender, cordelia]:
+            self.subscribe(user_profile, 'Denmark')
+
+        with mock.patch('zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD', 1), \
+                mock.patch('zerver.lib.actions.BULK_INSERT_UMS_COPY_CHUNK_SIZE', 1):
+            message_id = self.send_stream_message(sender.email, 'Denmark',
+                                                  content='@**Cordelia Lear** hello')
+
+        ums = UserMessage.objects.filter(message_id=message_id)
+        subscribers = self.users_subscribed_to_stream('Denmark', sender.realm)
+        self.assertEqual({um.user_profile_id for um in ums},
+                         {user.id for user in subscribers})
+        self.assertEqual(ums.get(user_profile=cordelia).flags_list(), ['mentioned'])
+        self.assertEqual(ums.get(user_profile=sender).flags_list(), [])
+
     def test_not_too_many_queries(self) -> None:
         recipient_list  = [self.example_user("hamlet"), self.example_user("iago"),
                            self.example_user("cordelia"), self.example_user("othello")]
@@ -2187,6 +2209,32 @@ class EditMessageTest(ZulipTestCase):
         self.check_message(id5, subject="edited")
         self.check_message(id6, subject="topic3")
 
+    def test_propagate_topic_query_count(self) -> None:
+        self.login(self.example_email("hamlet"))
+
+        def rename_topic(topic_name: str, num_messages: int) -> Tuple[int, List[int]]:
+            message_ids = [
+                self.send_stream_message(self.example_email("hamlet"), "Scotland",
+                                         topic_name=topic_name)
+                for i in range(num_messages)
+            ]
+            with queries_captured() as queries:
+                result = self.client_patch("/json/messages/" + str(message_ids[0]), {
+                    'message_id': message_ids[0],
+                    'subject': topic_name + ' (edited)',
+                    'propagate_mode': 'change_later'
+                })
+            self.assert_json_success(result)
+            return len(queries), message_ids
+
+        # Renaming a topic costs the same however many messages it
+        # has.  (The first rename fills some caches.)
+        rename_topic('warmup', 1)
+        num_queries, message_ids = rename_topic('small', 2)
+        self.assertEqual(rename_topic('big', 10)[0], num_queries)
+        for message_id in message_ids:
+            self.check_message(message_id, subject='small (edited)')
+
 class MirroredMessageUsersTest(ZulipTestCase):
     def test_invalid_sender(self) -> None:
         user = self.example_user('hamlet')
@@ -20,6 +20,8 @@ from zerver.lib.message import (
 from zerver.lib.narrow import (
     build_narrow_filter,
     is_web_public_compatible,
+    message_index_keys,
+    narrow_index_key,
 )
 from zerver.lib.request import JsonableError
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
@@ -361,6 +363,28 @@ class NarrowLibraryTest(TestCase):
             for e in reject_events:
                 self.assertFalse(narrow_filter(e))
 
+    def test_narrow_index_key(self) -> None:
+        fixtures_path = os.path.join(os.path.dirname(__file__),
+                                     'fixtures/narrow.json')
+        scenarios = ujson.loads(open(fixtures_path, 'r').read())
+        for scenario in scenarios:
+            key = narrow_index_key(scenario['narrow'])
+            for e in scenario['accept_events']:
+                if e['message'] is not None:
+                    self.assertIn(key, message_index_keys(e['message']))
+
+        self.assertEqual(narrow_index_key([['stream', 'Devel'], ['is', 'starred'], ['topic', 'Bark']]),
+                         ('devel', 'bark', None))
+        message = dict(type='stream', display_recipient='Devel', subject='Bark',
+                       sender_email='Hamlet@zulip.com')
+        keys = message_index_keys(message)
+        self.assertEqual(len(keys), 8)
+        self.assertIn(('devel', 'bark', 'hamlet@zulip.com'), keys)
+        self.assertIn((None, None, None), keys)
+        self.assertNotIn(('social', None, None), keys)
+        self.assertEqual(message_index_keys(dict(type='private', sender_email='Hamlet@zulip.com')),
+                         [(None, None, 'hamlet@zulip.com'), (None, None, None)])
+
     def test_build_narrow_filter_invalid(self) -> None:
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
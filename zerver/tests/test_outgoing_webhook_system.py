@@ -4,15 +4,19 @@ import ujson
 import logging
 import mock
 import requests
+import threading
+import time
 
 from builtins import object
 from django.test import override_settings
 from requests import Response
-from typing import Any, Dict, Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional
 
-from zerver.lib.outgoing_webhook import do_rest_call, OutgoingWebhookServiceInterface
+from zerver.lib.outgoing_webhook import do_rest_call, OutgoingWebhookServiceInterface, \
+    OutgoingWebhookDispatcher
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.models import get_realm, get_user, UserProfile, get_display_recipient
+from zerver.worker.queue_processors import OutgoingWebhookWorker
 
 class ResponseMock:
     def __init__(self, status_code: int, content: Optional[Any]=None) -> None:
@@ -60,7 +64,7 @@ class DoRestCallTests(ZulipTestCase):
     @mock.patch('zerver.lib.outgoing_webhook.succeed_with_message')
     def test_successful_request(self, mock_succeed_with_message: mock.Mock) -> None:
         response = ResponseMock(200)
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call(self.rest_operation, None, self.mock_event, service_handler, None)
             self.assertTrue(mock_succeed_with_message.called)
 
@@ -68,7 +72,7 @@ class DoRestCallTests(ZulipTestCase):
         response = ResponseMock(500)
 
         self.mock_event['failed_tries'] = 3
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call(self.rest_operation, None, self.mock_event, service_handler, None)
             bot_owner_notification = self.get_last_message()
             self.assertEqual(bot_owner_notification.content,
@@ -80,7 +84,7 @@ The webhook got a response with status code *500*.''')
     @mock.patch('zerver.lib.outgoing_webhook.fail_with_message')
     def test_fail_request(self, mock_fail_with_message: mock.Mock) -> None:
         response = ResponseMock(400)
-        with mock.patch('requests.request', return_value=response):
+        with mock.patch('requests.Session.request', return_value=response):
             do_rest_call(self.rest_operation, None, self.mock_event, service_handler, None)
             bot_owner_notification = self.get_last_message()
             self.assertTrue(mock_fail_with_message.called)
@@ -90,7 +94,7 @@ The webhook got a response with status code *400*.''')
             self.assertEqual(bot_owner_notification.recipient_id, self.bot_user.bot_owner.id)
 
     @mock.patch('logging.info')
-    @mock.patch('requests.request', side_effect=timeout_error)
+    @mock.patch('requests.Session.request', side_effect=timeout_error)
     def test_timeout_request(self, mock_requests_request: mock.Mock, mock_logger: mock.Mock) -> None:
         do_rest_call(self.rest_operation, None, self.mock_event, service_handler, None)
         bot_owner_notification = self.get_last_message()
@@ -103,7 +107,7 @@ Time is up!
         self.assertEqual(bot_owner_notification.recipient_id, self.bot_user.bot_owner.id)
 
     @mock.patch('logging.exception')
-    @mock.patch('requests.request', side_effect=request_exception_error)
+    @mock.patch('requests.Session.request', side_effect=request_exception_error)
     @mock.patch('zerver.lib.outgoing_webhook.fail_with_message')
     def test_request_exception(self, mock_fail_with_message: mock.Mock,
                                mock_requests_request: mock.Mock, mock_logger: mock.Mock) -> None:
@@ -118,6 +122,51 @@ I'm a generic exception :(
 ```''')
         self.assertEqual(bot_owner_notification.recipient_id, self.bot_user.bot_owner.id)
 
+class OutgoingWebhookDispatcherTests(ZulipTestCase):
+    def test_requests_per_service(self) -> None:
+        dispatcher = OutgoingWebhookDispatcher(threads=4, requests_per_service=1,
+                                               max_outstanding=10)
+        release = threading.Event()
+        started = []  # type: List[str]
+
+        def slow_call(name: str) -> None:
+            started.append(name)
+            release.wait(5)
+
+        def fast_call(name: str) -> None:
+            started.append(name)
+
+        dispatcher.submit(1, slow_call, 'slow1')
+        dispatcher.submit(1, slow_call, 'slow2')
+        dispatcher.submit(2, fast_call, 'fast')
+        deadline = time.time() + 5
+        while 'fast' not in started and time.time() < deadline:
+            time.sleep(0.01)
+
+        # The slow service's second request waits for its first, but
+        # the other service's request doesn't.
+        self.assertIn('fast', started)
+        self.assertIn('slow1', started)
+        self.assertNotIn('slow2', started)
+
+        release.set()
+        self.assertTrue(dispatcher.wait_until_idle(5))
+        self.assertEqual(sorted(started), ['fast', 'slow1', 'slow2'])
+        self.assertEqual(dispatcher.outstanding, 0)
+        self.assertEqual(dict(dispatcher.running), {})
+
+    def test_exceptions_are_logged(self) -> None:
+        dispatcher = OutgoingWebhookDispatcher(threads=1, requests_per_service=1,
+                                               max_outstanding=1)
+
+        def failing_call() -> None:
+            raise Exception("Fail")
+
+        with mock.patch('logging.exception') as mock_logging:
+            dispatcher.submit(1, failing_call)
+            self.assertTrue(dispatcher.wait_until_idle(5))
+        self.assertTrue(mock_logging.called)
+
 class TestOutgoingWebhookMessaging(ZulipTestCase):
     def setUp(self) -> None:
         self.user_profile = self.example_user("othello")
@@ -126,7 +175,7 @@ class TestOutgoingWebhookMessaging(ZulipTestCase):
                                                 bot_type=UserProfile.OUTGOING_WEBHOOK_BOT,
                                                 service_name='foo-service')
 
-    @mock.patch('requests.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
+    @mock.patch('requests.Session.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
     def test_pm_to_outgoing_webhook_bot(self, mock_requests_request: mock.Mock) -> None:
         self.send_personal_message(self.user_profile.email, self.bot_profile.email,
                                    content="foo")
@@ -140,7 +189,7 @@ class TestOutgoingWebhookMessaging(ZulipTestCase):
         self.assert_length(display_recipient, 1)  # type: ignore
         self.assertEqual(display_recipient[0]['email'], self.user_profile.email)   # type: ignore
 
-    @mock.patch('requests.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
+    @mock.patch('requests.Session.request', return_value=ResponseMock(200, {"response_string": "Hidley ho, I'm a webhook responding!"}))
     def test_stream_message_to_outgoing_webhook_bot(self, mock_requests_request: mock.Mock) -> None:
         self.send_stream_message(self.user_profile.email, "Denmark",
                                  content="@**{}** foo".format(self.bot_profile.full_name),
@@ -151,3 +200,56 @@ class TestOutgoingWebhookMessaging(ZulipTestCase):
         self.assertEqual(last_message.subject, "bar")
         display_recipient = get_display_recipient(last_message.recipient)
         self.assertEqual(display_recipient, "Denmark")
+
+    def test_worker_waits_for_batch(self) -> None:
+        worker = OutgoingWebhookWorker()
+        worker.dispatcher = OutgoingWebhookDispatcher(threads=2, requests_per_service=1,
+                                                      max_outstanding=10)
+        finished = []  # type: List[str]
+
+        def slow_rest_call(rest_operation: Dict[str, Any], request_data: Any,
+                           event: Dict[str, Any], service_handler: Any) -> None:
+            time.sleep(0.1)
+            finished.append(event['command'])
+
+        events = [dict(user_profile_id=self.bot_profile.id, trigger='private_message',
+                       message=dict(content=content, sender_email=self.user_profile.email))
+                  for content in ['first', 'second']]
+        with mock.patch('zerver.worker.queue_processors.do_rest_call',
+                        side_effect=slow_rest_call):
+            worker.consume_batch(events)
+        # consume_batch only returned, acknowledging the batch, once
+        # both requests had finished.
+        self.assertEqual(finished, ['first', 'second'])
+
+    @override_settings(OUTGOING_WEBHOOK_BATCH_TIMEOUT_SECONDS=0.1)
+    def test_worker_retries_requests_left_waiting(self) -> None:
+        worker = OutgoingWebhookWorker()
+        worker.dispatcher = OutgoingWebhookDispatcher(threads=2, requests_per_service=1,
+                                                      max_outstanding=10)
+        release = threading.Event()
+        started = []  # type: List[str]
+
+        def hanging_rest_call(rest_operation: Dict[str, Any], request_data: Any,
+                              event: Dict[str, Any], service_handler: Any) -> None:
+            started.append(event['command'])
+            release.wait(5)
+
+        events = [dict(user_profile_id=self.bot_profile.id, trigger='private_message',
+                       message=dict(content=content, sender_email=self.user_profile.email))
+                  for content in ['first', 'second']]
+        with mock.patch('zerver.worker.queue_processors.do_rest_call',
+                        side_effect=hanging_rest_call), \
+                mock.patch('zerver.worker.queue_processors.request_retry') as mock_retry, \
+                mock.patch('logging.info'):
+            worker.consume_batch(events)
+            # The second request, stuck behind the first, went back to
+            # the queue rather than holding up the batch.
+            self.assertEqual(started, ['first'])
+            mock_retry.assert_called_once()
+            self.assertEqual(mock_retry.call_args[0][0]['command'], 'second')
+
+            release.set()
+            self.assertTrue(worker.dispatcher.wait_until_idle(5))
+        self.assertEqual(started, ['first'])
+        self.assertEqual(dict(worker.dispatcher.running), {})
@@ -7,7 +7,8 @@ from django.utils.timezone import now as timezone_now
 from mock import mock
 
 from typing import Any, Dict
-from zerver.lib.actions import do_deactivate_user
+from zerver.lib.actions import do_deactivate_user, do_update_user_presence, \
+    get_status_dict
 from zerver.lib.statistics import seconds_usage_between
 from zerver.lib.test_helpers import (
     make_client,
@@ -26,6 +27,7 @@ from zerver.models import (
     UserProfile,
     UserPresence,
     flush_per_request_caches,
+    get_client,
     get_realm,
 )
 
@@ -144,6 +146,35 @@ class UserPresenceModelTests(ZulipTestCase):
         )
         self.assertTrue(pushable())
 
+    def test_snapshot(self) -> None:
+        UserPresence.objects.all().delete()
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        website = get_client('website')
+        do_update_user_presence(hamlet, website, timezone_now(), UserPresence.ACTIVE)
+
+        def check_status_dict(num_presence_queries: int) -> Dict[str, Dict[str, Any]]:
+            with queries_captured() as queries:
+                presence_dct = get_status_dict(hamlet)
+            self.assert_length([query for query in queries
+                                if 'zerver_userpresence' in query['sql']],
+                               num_presence_queries)
+            self.assertEqual(presence_dct,
+                             UserPresence.get_status_dict_by_realm(hamlet.realm_id))
+            return presence_dct
+
+        self.assertEqual(list(check_status_dict(1)), [hamlet.email])
+        self.assertEqual(list(check_status_dict(0)), [hamlet.email])
+
+        # Presence updates are patched into the snapshot.
+        do_update_user_presence(othello, website, timezone_now(), UserPresence.IDLE)
+        presence_dct = check_status_dict(0)
+        self.assertEqual(presence_dct[othello.email]['website']['status'], 'idle')
+
+        # Deactivating a user drops the snapshot.
+        do_deactivate_user(othello)
+        self.assertEqual(list(check_status_dict(1)), [hamlet.email])
+
 class UserPresenceTests(ZulipTestCase):
     def test_invalid_presence(self) -> None:
         email = self.example_email("hamlet")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from zerver.lib.process_pool import ProcessPool, RemoteError
+from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.timeout import TimeoutExpired
+
+def work(arg: str) -> int:
+    if arg == 'fail':
+        raise ValueError('failed')
+    if arg == 'hang':
+        while True:
+            pass
+    return os.getpid()
+
+class ProcessPoolTest(ZulipTestCase):
+    def test_apply(self) -> None:
+        pool = ProcessPool(1)
+        self.addCleanup(pool.close)
+        worker_pid = pool.apply(work, ['ok'], timeout=5)
+        self.assertNotEqual(worker_pid, os.getpid())
+        self.assertEqual(pool.apply(work, ['ok'], timeout=5), worker_pid)
+
+        with self.assertRaisesRegex(RemoteError, 'ValueError: failed'):
+            pool.apply(work, ['fail'], timeout=5)
+        # Exceptions don't cost us the worker.
+        self.assertEqual(pool.apply(work, ['ok'], timeout=5), worker_pid)
+
+    def test_timeout(self) -> None:
+        pool = ProcessPool(1)
+        self.addCleanup(pool.close)
+        worker_pid = pool.apply(work, ['ok'], timeout=5)
+
+        start = time.time()
+        with self.assertRaises(TimeoutExpired):
+            pool.apply(work, ['hang'], timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+
+        # The hung worker was killed and replaced.
+        with self.assertRaises(ProcessLookupError):
+            os.kill(worker_pid, 0)
+        self.assertEqual(len(pool.idle_workers), 1)
+        self.assertNotEqual(pool.apply(work, ['ok'], timeout=5), worker_pid)
+
+    def test_map(self) -> None:
+        pool = ProcessPool(2)
+        self.addCleanup(pool.close)
+        results = pool.map(work, [['ok'], ['hang'], ['fail'], ['ok'], ['ok']], timeout=0.5)
+        self.assertIsInstance(results[1], TimeoutExpired)
+        self.assertIsInstance(results[2], RemoteError)
+        for index in [0, 3, 4]:
+            self.assertIsInstance(results[index], int)
+        self.assertEqual(len(pool.idle_workers), 2)
+
+        self.assertEqual(pool.map(work, [], timeout=0.5), [])
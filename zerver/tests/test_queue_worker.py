@@ -11,9 +11,12 @@ from mock import patch, MagicMock
 from typing import Any, Callable, Dict, List, Mapping, Tuple
 
 from zerver.lib.send_email import FromAddress
-from zerver.lib.test_helpers import simulated_queue_client
+from zerver.lib.test_helpers import queries_captured, simulated_queue_client, \
+    tornado_redirected_to_list
+from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.models import get_client, UserActivity, PreregistrationUser
+from zerver.models import get_client, UserActivity, UserActivityInterval, \
+    PreregistrationUser, UserPresence
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
     get_active_worker_queues,
@@ -47,6 +50,14 @@ class WorkerTest(ZulipTestCase):
                 callback = self.consumers[queue_name]
                 callback(data)
 
+        def start_json_batch_consuming(self, queue_name: str,
+                                       callback: Callable[[List[Dict[str, Any]]], None],
+                                       batch_size: int, max_wait: float) -> None:
+            while self.queue:
+                batch = self.queue[:batch_size]
+                self.queue = self.queue[batch_size:]
+                callback([data for (queue_name, data) in batch])
+
         def drain_queue(self, queue_name: str, json: bool) -> List[Event]:
             assert json
             events = [
@@ -329,6 +340,122 @@ class WorkerTest(ZulipTestCase):
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
 
+    def test_UserActivityWorker_batch(self) -> None:
+        fake_client = self.FakeClient()
+
+        user = self.example_user('hamlet')
+        UserActivity.objects.filter(user_profile=user).delete()
+        UserActivity.objects.create(user_profile=user, client=get_client('ios'),
+                                    query='send_message', count=5,
+                                    last_visit=timestamp_to_datetime(1000))
+
+        for (client, query, timestamp) in [('ios', 'send_message', 2000),
+                                           ('ios', 'send_message', 1500),
+                                           ('website', 'send_message', 3000),
+                                           ('ios', 'get_events', 4000)]:
+            fake_client.queue.append(('user_activity', dict(
+                user_profile_id=user.id,
+                client=client,
+                time=timestamp,
+                query=query,
+            )))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            with queries_captured() as queries:
+                worker.start()
+        # Reading the existing rows, creating new ones, and updating the
+        # existing ones takes a query each, however many events there are.
+        self.assert_length([query for query in queries
+                            if 'zerver_useractivity' in query['sql']], 3)
+
+        activities = {
+            (activity.client.name, activity.query): (activity.count, activity.last_visit)
+            for activity in UserActivity.objects.filter(user_profile=user)
+        }
+        self.assertEqual(activities, {
+            ('ios', 'send_message'): (7, timestamp_to_datetime(2000)),
+            ('website', 'send_message'): (1, timestamp_to_datetime(3000)),
+            ('ios', 'get_events'): (1, timestamp_to_datetime(4000)),
+        })
+
+    def test_UserPresenceWorker_batch(self) -> None:
+        fake_client = self.FakeClient()
+
+        hamlet = self.example_user('hamlet')
+        othello = self.example_user('othello')
+        UserPresence.objects.all().delete()
+        UserPresence.objects.create(user_profile=hamlet, client=get_client('website'),
+                                    status=UserPresence.ACTIVE,
+                                    timestamp=timestamp_to_datetime(1000))
+
+        for (user, client, status, timestamp) in [
+                # Going idle on one client isn't enough to look idle...
+                (hamlet, 'website', UserPresence.IDLE, 1030),
+                (hamlet, 'website', UserPresence.ACTIVE, 1040),
+                (hamlet, 'ZulipMobile', UserPresence.ACTIVE, 1050),
+                (othello, 'website', UserPresence.IDLE, 1060),
+                (othello, 'website', UserPresence.IDLE, 1070)]:
+            fake_client.queue.append(('user_presence', dict(
+                user_profile_id=user.id,
+                client=client,
+                status=status,
+                time=timestamp,
+            )))
+
+        events = []  # type: List[Mapping[str, Any]]
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserPresenceWorker()
+            worker.setup()
+            with queries_captured() as queries, tornado_redirected_to_list(events):
+                worker.start()
+        self.assert_length([query for query in queries
+                            if 'zerver_userpresence' in query['sql']], 3)
+
+        presences = {
+            (presence.user_profile_id, presence.client.name): (presence.status, presence.timestamp)
+            for presence in UserPresence.objects.all()
+        }
+        self.assertEqual(presences, {
+            (hamlet.id, 'website'): (UserPresence.ACTIVE, timestamp_to_datetime(1040)),
+            (hamlet.id, 'ZulipMobile'): (UserPresence.ACTIVE, timestamp_to_datetime(1050)),
+            (othello.id, 'website'): (UserPresence.IDLE, timestamp_to_datetime(1070)),
+        })
+
+        # Only the new rows are worth telling everyone about.
+        self.assertEqual(sorted((event['event']['email'], list(event['event']['presence']))
+                                for event in events),
+                         [(hamlet.email, ['ZulipMobile']), (othello.email, ['website'])])
+
+    def test_UserActivityIntervalWorker_batch(self) -> None:
+        fake_client = self.FakeClient()
+
+        user = self.example_user('hamlet')
+        UserActivityInterval.objects.filter(user_profile=user).delete()
+        # Two events five minutes apart make one interval, and one an
+        # hour later starts another.
+        for timestamp in [1000000, 1000300, 1003600]:
+            fake_client.queue.append(('user_activity_interval', dict(
+                user_profile_id=user.id,
+                time=timestamp,
+            )))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            worker.start()
+
+        intervals = [
+            (interval.start, interval.end)
+            for interval in UserActivityInterval.objects.filter(user_profile=user).order_by('start')
+        ]
+        length = UserActivityInterval.MIN_INTERVAL_LENGTH
+        self.assertEqual(intervals, [
+            (timestamp_to_datetime(1000000), timestamp_to_datetime(1000300) + length),
+            (timestamp_to_datetime(1003600), timestamp_to_datetime(1003600) + length),
+        ])
+
     def test_error_handling(self) -> None:
         processed = []
 
@@ -362,6 +489,67 @@ class WorkerTest(ZulipTestCase):
         event = ujson.loads(line.split('\t')[1])
         self.assertEqual(event["type"], 'unexpected behaviour')
 
+    def test_batch_consuming(self) -> None:
+        batches = []
+
+        @queue_processors.assign_queue('batch_worker')
+        class BatchWorker(queue_processors.QueueProcessingWorker):
+            batch_size = 2
+
+            def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+                if any(event['type'] == 'unexpected behaviour' for event in events):
+                    raise Exception('Worker task not performing as expected!')
+                batches.append([event['type'] for event in events])
+
+        fake_client = self.FakeClient()
+        for msg in ['good', 'fine', 'unexpected behaviour', 'really bad', 'back to normal']:
+            fake_client.queue.append(('batch_worker', {'type': msg}))
+
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, 'batch_worker.errors')
+        try:
+            os.remove(fn)
+        except OSError:  # nocoverage # error handling for the directory not existing
+            pass
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = BatchWorker()
+            worker.setup()
+            with patch('logging.exception') as logging_exception_mock:
+                worker.start()
+                logging_exception_mock.assert_called_once_with(
+                    "Problem handling data on queue batch_worker")
+
+        self.assertEqual(batches, [['good', 'fine'], ['back to normal']])
+        # Every event in the failed batch is logged.
+        events = [ujson.loads(line.split('\t')[1]) for line in open(fn).readlines()]
+        self.assertEqual([event['type'] for event in events],
+                         ['unexpected behaviour', 'really bad'])
+
+    def test_batch_consuming_default(self) -> None:
+        processed = []
+
+        @queue_processors.assign_queue('unreliable_batch_worker')
+        class UnreliableBatchWorker(queue_processors.QueueProcessingWorker):
+            batch_size = 10
+
+            def consume(self, data: Mapping[str, Any]) -> None:
+                if data["type"] == 'unexpected behaviour':
+                    raise Exception('Worker task not performing as expected!')
+                processed.append(data["type"])
+
+        fake_client = self.FakeClient()
+        for msg in ['good', 'fine', 'unexpected behaviour', 'back to normal']:
+            fake_client.queue.append(('unreliable_batch_worker', {'type': msg}))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = UnreliableBatchWorker()
+            worker.setup()
+            with patch('logging.exception'):
+                worker.start()
+
+        # Without a consume_batch, one bad event doesn't affect the rest.
+        self.assertEqual(processed, ['good', 'fine', 'back to normal'])
+
     def test_worker_noname(self) -> None:
         class TestWorker(queue_processors.QueueProcessingWorker):
             def __init__(self) -> None:
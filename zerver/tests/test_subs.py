@@ -2,12 +2,16 @@
 
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Set
 
+import datetime
+
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
+from analytics.models import StreamCount
+
 from zerver.lib import cache
 
 from zerver.lib.test_helpers import (
@@ -45,6 +49,7 @@ from zerver.models import (
     get_display_recipient, Message, Realm, Recipient, Stream, Subscription,
     DefaultStream, UserProfile, get_user_profile_by_id, active_non_guest_user_ids,
     get_default_stream_groups, flush_per_request_caches, DefaultStreamGroup,
+    get_stream_recipient,
 )
 
 from zerver.lib.actions import (
@@ -57,6 +62,7 @@ from zerver.lib.actions import (
     ensure_stream,
     do_deactivate_stream,
     do_deactivate_user,
+    do_reactivate_user,
     stream_welcome_message,
     do_create_default_stream_group,
     do_add_streams_to_default_stream_group, do_remove_streams_from_default_stream_group,
@@ -65,8 +71,12 @@ from zerver.lib.actions import (
     do_change_default_stream_group_name,
     lookup_default_stream_groups,
     can_access_stream_user_ids,
-    validate_user_access_to_subscribers_helper
+    validate_user_access_to_subscribers_helper,
+    update_realm_streams_traffic_caches,
+    pack_user_ids,
 )
+from zerver.lib.cache import cache_get_many, remote_cache_set_many, \
+    stream_subscribers_cache_key, stream_subscribers_version_cache_key
 
 from zerver.views.streams import (
     compose_views
@@ -2999,11 +3009,11 @@ class GetSubscribersTest(ZulipTestCase):
 
         create_private_streams()
 
-        def get_never_subscribed() -> List[Dict[str, Any]]:
+        def get_never_subscribed(query_count: int) -> List[Dict[str, Any]]:
             with queries_captured() as queries:
                 sub_data = gather_subscriptions_helper(self.user_profile)
             never_subscribed = sub_data[2]
-            self.assert_length(queries, 6)
+            self.assert_length(queries, query_count)
 
             # Ignore old streams.
             never_subscribed = [
@@ -3012,7 +3022,7 @@ class GetSubscribersTest(ZulipTestCase):
             ]
             return never_subscribed
 
-        never_subscribed = get_never_subscribed()
+        never_subscribed = get_never_subscribed(6)
 
         # Invite only stream should not be there in never_subscribed streams
         self.assertEqual(len(never_subscribed), len(public_streams))
@@ -3025,7 +3035,8 @@ class GetSubscribersTest(ZulipTestCase):
         def test_admin_case() -> None:
             self.user_profile.is_realm_admin = True
             # Test realm admins can get never subscribed private stream's subscribers.
-            never_subscribed = get_never_subscribed()
+            # The stream traffic is cached by now.
+            never_subscribed = get_never_subscribed(5)
 
             self.assertEqual(
                 len(never_subscribed),
@@ -3217,6 +3228,89 @@ class GetSubscribersTest(ZulipTestCase):
         self.login(self.example_email("iago"))
         self.make_successful_subscriber_request(stream_name)
 
+    def test_stream_weekly_traffic(self) -> None:
+        stream = get_stream('Denmark', self.user_profile.realm)
+        stream.date_created = timezone_now() - datetime.timedelta(days=100)
+        stream.save(update_fields=['date_created'])
+
+        def get_weekly_traffic() -> int:
+            subscribed = gather_subscriptions_helper(self.user_profile)[0]
+            [sub] = [sub for sub in subscribed if sub['stream_id'] == stream.id]
+            return sub['stream_weekly_traffic']
+
+        self.assertEqual(get_weekly_traffic(), 0)
+        StreamCount.objects.create(stream=stream, realm=stream.realm,
+                                   property='messages_in_stream:is_bot:day',
+                                   subgroup='false', end_time=timezone_now(), value=150)
+
+        # The traffic is cached until the analytics run refreshes it.
+        self.assertEqual(get_weekly_traffic(), 0)
+        update_realm_streams_traffic_caches()
+        self.assertEqual(get_weekly_traffic(), 37)
+
+    def test_subscriber_list_cache(self) -> None:
+        stream = self.subscribe(self.user_profile, 'Scotland')
+        othello = self.example_user('othello')
+
+        def get_subscribers() -> Set[int]:
+            subscribed = gather_subscriptions_helper(self.user_profile)[0]
+            [sub] = [sub for sub in subscribed if sub['stream_id'] == stream.id]
+            return set(sub['subscribers'])
+
+        subscribers = get_subscribers()
+        self.assertNotIn(othello.id, subscribers)
+
+        self.subscribe(othello, 'Scotland')
+        self.assertEqual(get_subscribers(), subscribers | {othello.id})
+
+        do_deactivate_user(othello)
+        self.assertEqual(get_subscribers(), subscribers)
+
+        do_reactivate_user(othello)
+        self.assertEqual(get_subscribers(), subscribers | {othello.id})
+
+        self.unsubscribe(othello, 'Scotland')
+        with queries_captured() as queries:
+            self.assertEqual(get_subscribers(), subscribers)
+
+        # Nothing changed, so this time all the subscriber lists come
+        # from the cache.
+        with queries_captured() as cached_queries:
+            self.assertEqual(get_subscribers(), subscribers)
+        self.assert_length(cached_queries, len(queries) - 1)
+
+    def test_subscriber_list_cache_versions(self) -> None:
+        stream = self.subscribe(self.user_profile, 'Scotland')
+        othello = self.example_user('othello')
+        self.subscribe(othello, 'Scotland')
+        recipient_id = get_stream_recipient(stream.id).id
+        version_key = stream_subscribers_version_cache_key(recipient_id)
+
+        def get_subscribers() -> Set[int]:
+            subscribed = gather_subscriptions_helper(self.user_profile)[0]
+            [sub] = [sub for sub in subscribed if sub['stream_id'] == stream.id]
+            return set(sub['subscribers'])
+
+        subscribers = get_subscribers()
+        self.assertIn(othello.id, subscribers)
+
+        # A fill that read the version and the subscribers before
+        # othello left, but only got to write them afterwards...
+        old_version = cache_get_many([version_key]).get(version_key)
+        self.unsubscribe(othello, 'Scotland')
+        remote_cache_set_many({
+            stream_subscribers_cache_key(recipient_id): (
+                old_version, pack_user_ids(sorted(subscribers))),
+        })
+
+        # ... doesn't bring othello back.
+        self.assertEqual(get_subscribers(), subscribers - {othello.id})
+
+        # Deactivating a stream unsubscribes everyone in bulk.
+        old_version = cache_get_many([version_key]).get(version_key)
+        do_deactivate_stream(stream)
+        self.assertNotEqual(cache_get_many([version_key]).get(version_key), old_version)
+
 class AccessStreamTest(ZulipTestCase):
     def test_access_stream(self) -> None:
         """
@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-AA
 
-from typing import Any, Dict, List, Mapping
+from typing import Any, Dict, List, Mapping, Set
 
 from django.db import connection
 
+from zerver.lib.actions import do_mark_all_as_read, do_update_message, \
+    do_update_message_flags
+from zerver.lib.cache import remote_cache_bump_counter, unread_index_version_cache_key
+from zerver.lib.message import UnreadMessagesResult, aggregate_unread_data, \
+    get_raw_unread_data
+from zerver.lib.unread_index import get_unread_index
 from zerver.models import (
     get_realm,
     get_stream,
     get_stream_recipient,
     get_user,
+    Message,
     Recipient,
     Stream,
     Subscription,
@@ -22,6 +29,7 @@ from zerver.lib.fix_unreads import (
 )
 from zerver.lib.test_helpers import (
     get_subscription,
+    queries_captured,
     tornado_redirected_to_list,
 )
 from zerver.lib.test_classes import (
@@ -356,6 +364,121 @@ class UnreadCountTests(ZulipTestCase):
         })
         self.assert_json_error(result, 'No such topic \'abc\'')
 
+    def test_unread_index(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        do_mark_all_as_read(hamlet)
+        message_ids = [
+            self.send_stream_message(cordelia.email, "Denmark", topic_name="index")
+            for i in range(3)
+        ]
+
+        def get_unread_stream_message_ids(num_user_message_queries: int) -> Set[int]:
+            with queries_captured() as queries:
+                raw_unread_data = get_raw_unread_data(hamlet)
+            self.assert_length([query for query in queries
+                                if 'zerver_usermessage' in query['sql']],
+                               num_user_message_queries)
+            return set(raw_unread_data['stream_dict'])
+
+        # Building the index reads the watermark, the unread messages
+        # per conversation up to it, the mentions and the messages since.
+        self.assertEqual(get_unread_stream_message_ids(4), set(message_ids))
+
+        # After that, we only read what was sent since.
+        new_message_id = self.send_stream_message(cordelia.email, "Denmark", topic_name="index")
+        self.assertEqual(get_unread_stream_message_ids(1),
+                         set(message_ids) | {new_message_id})
+
+        do_update_message_flags(hamlet, 'add', 'read', message_ids[:2])
+        self.assertEqual(get_unread_stream_message_ids(1),
+                         {message_ids[2], new_message_id})
+
+        # Editing the topic invalidates the index.
+        message = Message.objects.get(id=new_message_id)
+        do_update_message(cordelia, message, "new topic", "change_one",
+                          None, None, set(), set())
+        raw_unread_data = get_raw_unread_data(hamlet)
+        self.assertEqual(raw_unread_data['stream_dict'][new_message_id]['topic'], 'new topic')
+
+        # So does missing a change to the index.
+        remote_cache_bump_counter(unread_index_version_cache_key(hamlet.id))
+        self.assertEqual(get_unread_stream_message_ids(4),
+                         {message_ids[2], new_message_id})
+
+    def test_unread_index_conversations(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        do_mark_all_as_read(hamlet)
+        busy_message_ids = [
+            self.send_stream_message(cordelia.email, "Denmark", topic_name="busy")
+            for i in range(6)
+        ]
+        quiet_message_id = self.send_stream_message(cordelia.email, "Denmark",
+                                                    topic_name="quiet")
+        pm_message_id = self.send_personal_message(cordelia.email, hamlet.email)
+
+        with mock.patch('zerver.lib.unread_index.MAX_UNREAD_MESSAGES_PER_CONVERSATION', 4):
+            # The busy topic lists only its newest messages, and
+            # doesn't crowd out the other conversations.
+            raw_unread_data = get_raw_unread_data(hamlet)
+            self.assertEqual(set(raw_unread_data['stream_dict']),
+                             set(busy_message_ids[2:]) | {quiet_message_id})
+            self.assertEqual(set(raw_unread_data['pm_dict']), {pm_message_id})
+
+            index = get_unread_index(hamlet, [])
+            counts = {conversation['topic']: conversation['count']
+                      for conversation in index['conversations'].values()
+                      if conversation['recipient_type'] == Recipient.STREAM}
+            self.assertEqual(counts, dict(busy=6, quiet=1))
+
+            # Reading the newest ones uncovers the older ones.
+            do_update_message_flags(hamlet, 'add', 'read', busy_message_ids[3:])
+            raw_unread_data = get_raw_unread_data(hamlet)
+            self.assertEqual(set(raw_unread_data['stream_dict']),
+                             set(busy_message_ids[:3]) | {quiet_message_id})
+
+    def test_unread_counts_past_listed_messages(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        do_mark_all_as_read(hamlet)
+        busy_message_ids = [
+            self.send_stream_message(cordelia.email, "Denmark", topic_name="busy")
+            for i in range(6)
+        ]
+        quiet_message_id = self.send_stream_message(cordelia.email, "Denmark",
+                                                    topic_name="quiet")
+        pm_message_id = self.send_personal_message(cordelia.email, hamlet.email)
+
+        def get_unread_data(max_listed: int) -> UnreadMessagesResult:
+            with mock.patch('zerver.lib.unread_index.MAX_UNREAD_MESSAGES_PER_CONVERSATION', 4), \
+                    mock.patch('zerver.lib.message.MAX_UNREAD_MESSAGES', max_listed):
+                return aggregate_unread_data(get_raw_unread_data(hamlet))
+
+        # We list the newest messages overall, but count all of them.
+        result = get_unread_data(3)
+        self.assertEqual(result['count'], 8)
+        self.assertEqual([(stream['topic'], stream['unread_message_ids'], stream['unread_count'])
+                          for stream in result['streams']],
+                         [('busy', [busy_message_ids[-1]], 6),
+                          ('quiet', [quiet_message_id], 1)])
+        self.assertEqual([(pm['unread_message_ids'], pm['unread_count'])
+                          for pm in result['pms']],
+                         [([pm_message_id], 1)])
+
+        # A conversation with none of its messages listed still has
+        # its count.
+        result = get_unread_data(1)
+        self.assertEqual(result['count'], 8)
+        self.assertEqual([(stream['topic'], stream['unread_message_ids'], stream['unread_count'])
+                          for stream in result['streams']],
+                         [('busy', [], 6), ('quiet', [], 1)])
+
+        # Reading the index again doesn't write it back unchanged.
+        with mock.patch('zerver.lib.unread_index.save_unread_index') as mock_save:
+            get_unread_index(hamlet, [])
+        mock_save.assert_not_called()
+
 class FixUnreadTests(ZulipTestCase):
     def test_fix_unreads(self) -> None:
         user = self.example_user('hamlet')
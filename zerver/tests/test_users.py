@@ -20,6 +20,7 @@ from zerver.lib.test_runner import slow
 from zerver.models import UserProfile, Recipient, \
     Realm, RealmDomain, UserActivity, UserHotspot, \
     get_user, get_realm, get_client, get_stream, get_stream_recipient, \
+    get_personal_recipient, \
     get_membership_realms, get_source_profile, \
     Message, get_context_for_message, ScheduledEmail, check_valid_user_ids
 
@@ -28,6 +29,7 @@ from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.send_email import send_future_email
 from zerver.lib.actions import (
+    bulk_get_recipient_info,
     get_emails_from_user_ids,
     get_recipient_info,
     do_deactivate_user,
@@ -668,6 +670,46 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info['default_bot_user_ids'], {normal_bot.id})
 
+    def test_bulk_recipient_info(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        realm = hamlet.realm
+
+        stream_name = 'Test Stream'
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream_name)
+        stream = get_stream(stream_name, realm)
+        stream_recipient = get_stream_recipient(stream.id)
+        personal_recipient = get_personal_recipient(othello.id)
+
+        sub = get_subscription(stream_name, cordelia)
+        sub.push_notifications = True
+        sub.save()
+        add_topic_mute(
+            user_profile=cordelia,
+            stream_id=stream.id,
+            recipient_id=stream_recipient.id,
+            topic_name='Muted Topic',
+        )
+
+        targets = [
+            (stream_recipient, hamlet.id, StreamTopicTarget(stream.id, 'muted topic'), None),
+            (stream_recipient, hamlet.id, StreamTopicTarget(stream.id, 'other topic'), None),
+            (personal_recipient, hamlet.id, None, None),
+        ]
+        with queries_captured() as queries:
+            infos = bulk_get_recipient_info(targets)
+        self.assert_length(queries, 3)
+
+        self.assertEqual(infos[0]['active_user_ids'], {hamlet.id, cordelia.id})
+        self.assertEqual(infos[0]['stream_push_user_ids'], set())
+        self.assertEqual(infos[1]['stream_push_user_ids'], {cordelia.id})
+        self.assertEqual(infos[2]['active_user_ids'], {hamlet.id, othello.id})
+
+        for (recipient, sender_id, stream_topic, _), info in zip(targets, infos):
+            self.assertEqual(info, get_recipient_info(recipient, sender_id, stream_topic))
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user('hamlet')
         realm = hamlet.realm
@@ -1,12 +1,16 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
-from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+from typing import cast, AbstractSet, Any, BinaryIO, Callable, Dict, Iterator, List, \
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from mypy_extensions import TypedDict
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
+from django.http import HttpRequest
 from collections import deque
+from contextlib import contextmanager
+import functools
+import heapq
 import os
 import time
 import logging
@@ -15,21 +19,28 @@ import requests
 import atexit
 import sys
 import signal
+import threading
 import tornado.autoreload
+import tornado.httpclient
 import tornado.ioloop
 import random
 from zerver.models import UserProfile, Client
 from zerver.decorator import cachify
-from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
-    finish_handler, handler_stats_string
+from zerver.tornado.handlers import clear_handler_by_id, clear_shared_payloads, \
+    get_handler_by_id, finish_handler, handler_stats_string, share_payload
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_restart
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import build_narrow_filter, message_index_keys, narrow_index_key, \
+    NarrowIndexKey
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.sharding import get_queue_id_shard, get_tornado_uri, \
+    get_user_shard, get_user_tornado_uri, make_queue_id, \
+    notify_tornado_queue_name, partition_users_by_shard, sharding_enabled
+from zerver.tornado import persistence, sharding
 import copy
 
 requests_client = requests.Session()
@@ -45,6 +56,12 @@ for host in ['127.0.0.1', 'localhost']:
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# How often we write the event queues that changed to the checkpoint
+# log, and how large that log can get before we compact it (at least
+# as large as the snapshot itself).
+EVENT_QUEUE_CHECKPOINT_FREQ_MSECS = 1000 * 10
+EVENT_QUEUE_MIN_COMPACTION_BYTES = 64 * 1024 * 1024
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -55,6 +72,7 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # maximum timeout value is 55 seconds, to deal with crappy home
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
+HEARTBEAT_CHECK_FREQ_MSECS = 1000
 
 class ClientDescriptor:
     def __init__(self,
@@ -85,9 +103,12 @@ class ClientDescriptor:
         self.client_gravatar = client_gravatar
         self.all_public_streams = all_public_streams
         self.client_type_name = client_type_name
-        self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.call_later
+        # The second (from time.time()) at which the connected handler
+        # is due a heartbeat; see heartbeat_slots.
+        self._heartbeat_due = None  # type: Optional[int]
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_index_key = narrow_index_key(narrow)
 
         # Clamp queue_timeout to between minimum and maximum timeouts
         self.queue_timeout = max(IDLE_EVENT_QUEUE_TIMEOUT_SECS,
@@ -144,7 +165,7 @@ class ClientDescriptor:
 
     def prepare_for_pickling(self) -> None:
         self.current_handler_id = None
-        self._timeout_handle = None
+        self._heartbeat_due = None
 
     def add_event(self, event: Dict[str, Any]) -> None:
         if self.current_handler_id is not None:
@@ -152,7 +173,11 @@ class ClientDescriptor:
             async_request_restart(handler._request)
 
         self.event_queue.push(event)
-        self.finish_current_handler()
+        mark_queue_dirty(self.event_queue.id)
+        if deferred_finish_clients is not None:
+            deferred_finish_clients[self.event_queue.id] = self
+        else:
+            self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
         if self.current_handler_id is not None:
@@ -190,15 +215,13 @@ class ClientDescriptor:
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        mark_queue_dirty(self.event_queue.id)
 
-        def timeout_callback() -> None:
-            self._timeout_handle = None
-            # All clients get heartbeat events
-            self.add_event(dict(type='heartbeat'))
-        ioloop = tornado.ioloop.IOLoop.instance()
+        self.cancel_heartbeat()
         interval = HEARTBEAT_MIN_FREQ_SECS + random.randint(0, 10)
         if self.client_type_name != 'API: heartbeat test':
-            self._timeout_handle = ioloop.call_later(interval, timeout_callback)
+            self._heartbeat_due = int(self.last_connection_time) + interval
+            heartbeat_slots.setdefault(self._heartbeat_due, set()).add(self)
 
     def disconnect_handler(self, client_closed: bool=False) -> None:
         if self.current_handler_id:
@@ -210,10 +233,12 @@ class ClientDescriptor:
                               self.current_client_name))
         self.current_handler_id = None
         self.current_client_name = None
-        if self._timeout_handle is not None:
-            ioloop = tornado.ioloop.IOLoop.instance()
-            ioloop.remove_timeout(self._timeout_handle)
-            self._timeout_handle = None
+        self.cancel_heartbeat()
+
+    def cancel_heartbeat(self) -> None:
+        if self._heartbeat_due is not None:
+            heartbeat_slots.get(self._heartbeat_due, set()).discard(self)
+            self._heartbeat_due = None
 
     def cleanup(self) -> None:
         # Before we can GC the event queue, we need to disconnect the
@@ -324,6 +349,10 @@ clients = {}  # type: Dict[str, ClientDescriptor]
 user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps realm id to the other client descriptors with a narrow, indexed
+# by their narrow_index_key, since they too may want messages sent to
+# public streams their user isn't subscribed to
+realm_narrowed_clients = {}  # type: Dict[int, Dict[NarrowIndexKey, List[ClientDescriptor]]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -334,12 +363,40 @@ gc_hooks = []  # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
 next_queue_id = 0
 
+# While process_notifications handles a batch, the clients that got
+# events, which it finishes once it has processed the whole batch.
+deferred_finish_clients = None  # type: Optional[Dict[str, ClientDescriptor]]
+
+# Rather than scanning every queue for idle ones on each GC, we keep a
+# heap of (time at which the queue might next be idle, queue id), with
+# one entry per queue; see gc_event_queues.
+gc_heap = []  # type: List[Tuple[float, str]]
+
+# Rather than scheduling a timeout per connected handler, we bucket the
+# handlers by the second they're due a heartbeat, and send_heartbeats
+# sends the due ones every HEARTBEAT_CHECK_FREQ_MSECS.  Since the
+# heartbeat interval is bounded, there are never more than about 10
+# buckets.
+heartbeat_slots = {}  # type: Dict[int, Set[ClientDescriptor]]
+
+# State for incrementally persisting the event queues; see
+# zerver/tornado/persistence.py.  checkpoint_log is None until
+# setup_event_queue starts checkpointing (so always in tests).
+snapshot_id = None  # type: Optional[float]
+checkpoint_log = None  # type: Optional[BinaryIO]
+# queue ids changed or garbage-collected since the last checkpoint
+dirty_queue_ids = set()  # type: Set[str]
+deleted_queue_ids = set()  # type: Set[str]
+
 def clear_client_event_queues_for_testing() -> None:
     assert(settings.TEST_SUITE)
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_narrowed_clients.clear()
     gc_hooks.clear()
+    gc_heap.clear()
+    heartbeat_slots.clear()
     global next_queue_id
     next_queue_id = 0
 
@@ -355,24 +412,44 @@ def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescript
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_narrowed_client_descriptors_for_message(realm_id: int,
+                                                message: Mapping[str, Any]) -> List[ClientDescriptor]:
+    '''
+    The narrowed clients in the realm whose narrows the message might
+    match; callers still need to check accepts_event.
+    '''
+    narrowed_clients = realm_narrowed_clients.get(realm_id)
+    if not narrowed_clients:
+        return []
+    result = []  # type: List[ClientDescriptor]
+    for key in message_index_keys(message):
+        result += narrowed_clients.get(key, [])
+    return result
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
+    heapq.heappush(gc_heap, (client.last_connection_time + client.queue_timeout,
+                             client.event_queue.id))
     user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
+    if client.all_public_streams:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    elif client.narrow != []:
+        realm_narrowed_clients.setdefault(client.realm_id, {}).setdefault(
+            client.narrow_index_key, []).append(client)
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = make_queue_id(next_queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    mark_queue_dirty(queue_id)
     return client
 
 def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
                        affected_realms: AbstractSet[int]) -> None:
-    def filter_client_dict(client_dict: MutableMapping[int, List[ClientDescriptor]], key: int) -> None:
+    def filter_client_dict(client_dict: MutableMapping[Any, List[ClientDescriptor]], key: Any) -> None:
         if key not in client_dict:
             return
 
@@ -388,21 +465,42 @@ def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
 
+    for (realm_id, key) in {(clients[id].realm_id, clients[id].narrow_index_key) for id in to_remove}:
+        if realm_id in realm_narrowed_clients:
+            filter_client_dict(realm_narrowed_clients[realm_id], key)
+            if len(realm_narrowed_clients[realm_id]) == 0:
+                del realm_narrowed_clients[realm_id]
+
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
+        if checkpoint_log is not None:
+            dirty_queue_ids.discard(id)
+            deleted_queue_ids.add(id)
 
 def gc_event_queues() -> None:
     start = time.time()
     to_remove = set()  # type: Set[str]
     affected_users = set()  # type: Set[int]
     affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
+    while gc_heap and gc_heap[0][0] <= start:
+        (_, id) = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already garbage-collected via ClientDescriptor.cleanup.
+            continue
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        elif client.current_handler_id is not None:
+            # Heartbeats mean the current connection started less
+            # than a minute ago, so this is at most that late.
+            heapq.heappush(gc_heap, (start + client.queue_timeout, id))
+        else:
+            # The client reconnected since we scheduled this.
+            heapq.heappush(gc_heap, (client.last_connection_time + client.queue_timeout, id))
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
@@ -417,33 +515,115 @@ def gc_event_queues() -> None:
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
+def send_heartbeats() -> None:
+    now = int(time.time())
+    for due in [due for due in heartbeat_slots if due <= now]:
+        for client in heartbeat_slots.pop(due):
+            client._heartbeat_due = None
+            # All clients get heartbeat events
+            client.add_event(dict(type='heartbeat'))
+
+def get_sharded_filename(filename: str) -> str:
+    if sharding_enabled():
+        return "%s.%d" % (filename, sharding.current_shard)
+    return filename
+
+def get_persistent_queue_filename() -> str:
+    return get_sharded_filename(settings.PERSISTENT_QUEUE_FILENAME)
+
+def get_checkpoint_log_filename() -> str:
+    return get_persistent_queue_filename() + ".log"
+
+def get_legacy_json_queue_filename() -> str:
+    return get_sharded_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME)
+
+def mark_queue_dirty(queue_id: str) -> None:
+    if checkpoint_log is not None:
+        dirty_queue_ids.add(queue_id)
+
+def write_event_queue_snapshot() -> None:
+    """Writes every queue to a new snapshot, and starts a new, empty
+    checkpoint log for it."""
+    global checkpoint_log, snapshot_id
+    snapshot_id = time.time()
+    persistence.write_snapshot(get_persistent_queue_filename(), snapshot_id,
+                               ((qid, client.to_dict()) for (qid, client) in clients.items()))
+    if checkpoint_log is not None:
+        checkpoint_log.close()
+    checkpoint_log = persistence.open_log(get_checkpoint_log_filename(), snapshot_id)
+    dirty_queue_ids.clear()
+    deleted_queue_ids.clear()
+
+def checkpoint_event_queues() -> None:
+    """Appends the queues changed since the last checkpoint to the
+    checkpoint log, so that a crash loses at most
+    EVENT_QUEUE_CHECKPOINT_FREQ_MSECS of queue state.  Once the log
+    outgrows the snapshot, we compact the two into a new snapshot."""
+    if checkpoint_log is None:
+        return
+    start = time.time()
+    num_changed = len(dirty_queue_ids) + len(deleted_queue_ids)
+
+    persistence.append_to_log(
+        checkpoint_log,
+        ((qid, clients[qid].to_dict()) for qid in dirty_queue_ids if qid in clients),
+        deleted_queue_ids)
+    dirty_queue_ids.clear()
+    deleted_queue_ids.clear()
+
+    snapshot_size = os.path.getsize(get_persistent_queue_filename())
+    if checkpoint_log.tell() > max(snapshot_size, EVENT_QUEUE_MIN_COMPACTION_BYTES):
+        write_event_queue_snapshot()
+        logging.info('Tornado compacted %d event queues in %.3fs'
+                     % (len(clients), time.time() - start))
+    elif num_changed:
+        logging.debug('Tornado checkpointed %d event queues in %.3fs'
+                      % (num_changed, time.time() - start))
+
 def dump_event_queues() -> None:
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    write_event_queue_snapshot()
 
     logging.info('Tornado dumped %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
 
-def load_event_queues() -> None:
-    global clients
-    start = time.time()
-
+def load_legacy_json_event_queues() -> Dict[str, Dict[str, Any]]:
+    # Temporary migration from the JSON format we used to store queues in.
+    #
     # ujson chokes on bad input pretty easily.  We separate out the actual
     # file reading from the loading so that we don't silently fail if we get
     # bad input.
+    filename = get_legacy_json_queue_filename()
     try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
+        with open(filename, "r") as stored_queues:
             json_data = stored_queues.read()
-        try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
-        except Exception:
-            logging.exception("Could not deserialize event queues")
     except (IOError, EOFError):
+        return {}
+
+    try:
+        os.rename(filename, "/var/tmp/%s.last" % (os.path.basename(filename),))
+    except OSError:
         pass
+    return dict(ujson.loads(json_data))
+
+def load_event_queues() -> None:
+    global clients, snapshot_id
+    start = time.time()
+
+    client_dicts = {}  # type: Dict[str, Dict[str, Any]]
+    try:
+        try:
+            snapshot_id, client_dicts = persistence.load_client_dicts(
+                get_persistent_queue_filename(), get_checkpoint_log_filename())
+        except IOError:
+            client_dicts = load_legacy_json_event_queues()
+        clients = dict((qid, ClientDescriptor.from_dict(client))
+                       for (qid, client) in client_dicts.items())
+    except Exception:
+        logging.exception("Could not deserialize event queues")
+        # Start over with a fresh snapshot of whatever we have.
+        snapshot_id = None
 
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
@@ -462,6 +642,8 @@ def send_restart_events(immediate: bool=False) -> None:
             client.add_event(event.copy())
 
 def setup_event_queue() -> None:
+    global checkpoint_log
+    ioloop = tornado.ioloop.IOLoop.instance()
     if not settings.TEST_SUITE:
         load_event_queues()
         atexit.register(dump_event_queues)
@@ -469,17 +651,25 @@ def setup_event_queue() -> None:
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         tornado.autoreload.add_reload_hook(dump_event_queues)
 
-    try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
-    except OSError:
-        pass
+        # Start checkpointing; we keep appending to the log of the
+        # snapshot we just loaded, if there was one.
+        if snapshot_id is None:
+            write_event_queue_snapshot()
+        else:
+            checkpoint_log = persistence.open_log(get_checkpoint_log_filename(), snapshot_id)
+        checkpoint_pc = tornado.ioloop.PeriodicCallback(checkpoint_event_queues,
+                                                        EVENT_QUEUE_CHECKPOINT_FREQ_MSECS, ioloop)
+        checkpoint_pc.start()
 
     # Set up event queue garbage collection
-    ioloop = tornado.ioloop.IOLoop.instance()
     pc = tornado.ioloop.PeriodicCallback(gc_event_queues,
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    heartbeat_pc = tornado.ioloop.PeriodicCallback(send_heartbeats,
+                                                   HEARTBEAT_CHECK_FREQ_MSECS, ioloop)
+    heartbeat_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
@@ -497,6 +687,10 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
         orig_queue_id = queue_id
         extra_log_data = ""
         if queue_id is None:
+            if sharding_enabled() and get_user_shard(user_profile_id) != sharding.current_shard:
+                # get_events_backend forwards these to the user's
+                # shard; see forward_events_request.
+                raise JsonableError(_("Event queues for this user are served by another server process"))
             if dont_block:
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
@@ -505,12 +699,15 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
         else:
             if last_event_id is None:
                 raise JsonableError(_("Missing 'last_event_id' argument"))
+            if get_queue_id_shard(queue_id) != sharding.current_shard:
+                raise BadEventQueueIdError(queue_id)
             client = get_client_descriptor(queue_id)
             if client is None:
                 raise BadEventQueueIdError(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            mark_queue_dirty(queue_id)
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
@@ -567,7 +764,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
             req['event_types'] = ujson.dumps(event_types)
 
         try:
-            resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+            resp = requests_client.get(get_user_tornado_uri(user_profile.id) + '/api/v1/events',
                                        auth=requests.auth.HTTPBasicAuth(
                                            user_profile.email, user_profile.api_key),
                                        params=req)
@@ -577,7 +774,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
                           (settings.ERROR_FILE_LOG_PATH, "tornado.log"))
             raise requests.adapters.ConnectionError(
                 "Django cannot connect to Tornado server (%s); try restarting" %
-                (settings.TORNADO_SERVER))
+                (get_user_tornado_uri(user_profile.id),))
 
         resp.raise_for_status()
 
@@ -587,7 +784,7 @@ def request_event_queue(user_profile: UserProfile, user_client: Client, apply_ma
 
 def get_user_events(user_profile: UserProfile, queue_id: str, last_event_id: int) -> List[Dict[Any, Any]]:
     if settings.TORNADO_SERVER:
-        resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests_client.get(get_user_tornado_uri(user_profile.id) + '/api/v1/events',
                                    auth=requests.auth.HTTPBasicAuth(
                                        user_profile.email, user_profile.api_key),
                                    params={'queue_id': queue_id,
@@ -743,6 +940,14 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
                 flags=[],
                 is_sender=is_sender_client(client)
             )
+        # Likewise for clients whose narrows might match the message.
+        for client in get_narrowed_client_descriptors_for_message(realm_id,
+                                                                   event_template['message_dict']):
+            send_to_clients[client.event_queue.id] = dict(
+                client=client,
+                flags=[],
+                is_sender=is_sender_client(client)
+            )
 
     for user_data in users:
         user_profile_id = user_data['id']  # type: int
@@ -771,8 +976,12 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
 
     @cachify
     def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
-        dct = copy.deepcopy(wide_dict)
+        # finalize_payload only replaces top-level keys, so a shallow
+        # copy is enough; the payload is then shared, unmodified, by
+        # every client's event, and finish_handler only encodes it once.
+        dct = dict(wide_dict)
         MessageDict.finalize_payload(dct, apply_markdown, client_gravatar)
+        share_payload(dct)
         return dct
 
     # Extra user-specific data to include
@@ -800,42 +1009,45 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
             result['stream_push_notify'] = stream_push_notify
             extra_user_data[user_profile_id] = result
 
-    for client_data in send_to_clients.values():
-        client = client_data['client']
-        flags = client_data['flags']
-        is_sender = client_data.get('is_sender', False)  # type: bool
-        extra_data = extra_user_data.get(client.user_profile_id, None)  # type: Optional[Mapping[str, bool]]
-
-        if not client.accepts_messages():
-            # The actual check is the accepts_event() check below;
-            # this line is just an optimization to avoid copying
-            # message data unnecessarily
-            continue
-
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
-
-        # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
-        user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
-        if extra_data is not None:
-            user_event.update(extra_data)
-
-        if is_sender:
-            local_message_id = event_template.get('local_id', None)
-            if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
-
-        if not client.accepts_event(user_event):
-            continue
-
-        # The below prevents (Zephyr) mirroring loops.
-        if ('mirror' in sending_client and
-                sending_client.lower() == client.client_type_name.lower()):
-            continue
-        client.add_event(user_event)
+    try:
+        for client_data in send_to_clients.values():
+            client = client_data['client']
+            flags = client_data['flags']
+            is_sender = client_data.get('is_sender', False)  # type: bool
+            extra_data = extra_user_data.get(client.user_profile_id, None)  # type: Optional[Mapping[str, bool]]
+
+            if not client.accepts_messages():
+                # The actual check is the accepts_event() check below;
+                # this line is just an optimization to avoid copying
+                # message data unnecessarily
+                continue
+
+            message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+
+            # Make sure Zephyr mirroring bots know whether stream is invite-only
+            if "mirror" in client.client_type_name and event_template.get("invite_only"):
+                message_dict = message_dict.copy()
+                message_dict["invite_only_stream"] = True
+
+            user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
+            if extra_data is not None:
+                user_event.update(extra_data)
+
+            if is_sender:
+                local_message_id = event_template.get('local_id', None)
+                if local_message_id is not None:
+                    user_event["local_message_id"] = local_message_id
+
+            if not client.accepts_event(user_event):
+                continue
+
+            # The below prevents (Zephyr) mirroring loops.
+            if ('mirror' in sending_client and
+                    sending_client.lower() == client.client_type_name.lower()):
+                continue
+            client.add_event(user_event)
+    finally:
+        clear_shared_payloads()
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
@@ -954,27 +1166,164 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     logging.debug("Tornado: Event %s for %s users took %sms" % (
         event['type'], len(users), int(1000 * (time.time() - start_time))))
 
+def process_notifications(notices: Iterable[Mapping[str, Any]]) -> None:
+    '''
+    Processes a batch of notices sent by batch_events, finishing each
+    affected handler once at the end rather than once per event.
+    '''
+    global deferred_finish_clients
+    deferred_finish_clients = {}
+    try:
+        for notice in notices:
+            # One bad notice shouldn't cost the others in the batch.
+            try:
+                process_notification(notice)
+            except Exception:
+                logging.exception("Error processing batched notice")
+    finally:
+        clients_to_finish = deferred_finish_clients
+        deferred_finish_clients = None
+        for client in clients_to_finish.values():
+            client.finish_current_handler()
+
+def process_queue_cleanup(data: Mapping[str, Any]) -> None:
+    client = get_client_descriptor(data['queue_id'])
+    # The shard that forwarded this couldn't check who owns the queue.
+    if client is None or client.user_profile_id != data['user_profile_id']:
+        return
+    client.cleanup()
+
+def process_notification_data(data: Mapping[str, Any]) -> None:
+    if 'notices' in data:
+        process_notifications(data['notices'])
+    elif 'cleanup_queue' in data:
+        process_queue_cleanup(data['cleanup_queue'])
+    else:
+        process_notification(data)
+
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data: Mapping[str, Any]) -> None:
+def send_notification_http(data: Mapping[str, Any], shard: int=0) -> None:
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests_client.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+        requests_client.post(get_tornado_uri(shard) + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
-        process_notification(data)
+        process_notification_data(data)
+
+def publish_notification(data: Mapping[str, Any], shard: int) -> None:
+    queue_json_publish(notify_tornado_queue_name(shard), data,
+                       functools.partial(send_notification_http, shard=shard))
+
+def forward_queue_cleanup(queue_id: str, user_profile_id: int) -> None:
+    '''
+    DELETE /json/events sends queue_id in the request body, which nginx
+    can't route on, so the request may reach a shard that doesn't own
+    the queue.  We pass the cleanup on to the shard that does.
+    '''
+    shard = get_queue_id_shard(queue_id)
+    if shard >= settings.TORNADO_PROCESSES:
+        raise BadEventQueueIdError(queue_id)
+    publish_notification(dict(cleanup_queue=dict(queue_id=queue_id,
+                                                 user_profile_id=user_profile_id)),
+                         shard)
+
+# Connection-level headers that we don't pass on when forwarding.
+HOP_BY_HOP_HEADERS = {'Connection', 'Keep-Alive', 'Transfer-Encoding', 'Upgrade'}
+
+def forward_events_request(request: HttpRequest, user_profile_id: int,
+                           handler_id: int) -> None:
+    '''
+    A GET /events without a queue_id (an API client creating a queue)
+    gives nginx nothing to route on, so it reaches shard 0 whoever the
+    user is.  We pass it on to the user's shard, without blocking the
+    IOLoop, and relay the response.
+    '''
+    headers = {}  # type: Dict[str, str]
+    for key, value in request.META.items():
+        if key.startswith('HTTP_'):
+            header = key[len('HTTP_'):].replace('_', '-').title()
+            if header not in HOP_BY_HOP_HEADERS:
+                headers[header] = value
+
+    def on_response(response: tornado.httpclient.HTTPResponse) -> None:
+        try:
+            handler = get_handler_by_id(handler_id)
+            request = handler._request
+            async_request_restart(request)
+            if response.code == 599:
+                # We never got a response; see tornado.httpclient.
+                logging.error("Forwarding events request to %s failed: %s" % (
+                    response.effective_url, response.error))
+                handler.zulip_finish(dict(result='error', msg=_('Internal server error')),
+                                     request, apply_markdown=False)
+                return
+            content = response.body.decode('utf-8')
+            handler.set_status(response.code)
+            handler.zulip_finish(ujson.loads(content), request, apply_markdown=False,
+                                 content=content)
+        except Exception:
+            logging.exception("Got error relaying forwarded events request")
+
+    tornado.httpclient.AsyncHTTPClient().fetch(
+        tornado.httpclient.HTTPRequest(
+            get_user_tornado_uri(user_profile_id) + request.get_full_path(),
+            method='GET', headers=headers, follow_redirects=False,
+            request_timeout=60),
+        callback=on_response, raise_error=False)
+
+# While batch_events is active in a thread, the notices send_event
+# would have published from it, by Tornado shard, in `notices`.
+batch_state = threading.local()
+
+def get_batched_notices() -> Optional[Dict[int, List[Dict[str, Any]]]]:
+    return getattr(batch_state, 'notices', None)
+
+@contextmanager
+def batch_events() -> Iterator[None]:
+    '''
+    Coalesces the events sent inside the block into one notification
+    per Tornado shard, sent when the block exits, for operations that
+    would otherwise send a storm of small ones.  Nested uses just join
+    the outermost batch.
+    '''
+    if get_batched_notices() is not None:
+        yield
+        return
+
+    batch_state.notices = {}
+    try:
+        yield
+    finally:
+        notices_by_shard = batch_state.notices
+        batch_state.notices = None
+        for shard, notices in sorted(notices_by_shard.items()):
+            if len(notices) == 1:
+                publish_notification(notices[0], shard)
+            else:
+                publish_notification(dict(notices=notices), shard)
 
 def send_notification(data: Dict[str, Any]) -> None:
-    queue_json_publish("notify_tornado", data, send_notification_http)
+    send_event(data['event'], data['users'])
 
 def send_event(event: Mapping[str, Any],
                users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None:
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    if not sharding_enabled():
+        users_by_shard = {0: users}  # type: Mapping[int, Any]
+    else:
+        # Each Tornado shard only needs to hear about its own users.
+        users_by_shard = partition_users_by_shard(event, users)
+
+    batched_notices = get_batched_notices()
+    for shard, shard_users in users_by_shard.items():
+        notice = dict(event=event, users=shard_users)
+        if batched_notices is not None:
+            batched_notices.setdefault(shard, []).append(notice)
+        else:
+            publish_notification(notice, shard)
@@ -6,6 +6,7 @@ from threading import Lock
 from typing import Any, Callable, Dict, List, Optional
 
 import tornado.web
+import ujson
 from django import http
 from django.conf import settings
 from django.core import exceptions, signals
@@ -44,6 +45,46 @@ def clear_handler_by_id(handler_id: int) -> None:
 def handler_stats_string() -> str:
     return "%s handlers, latest ID %s" % (len(handlers), current_handler_id)
 
+# Message payloads that process_message_event is currently fanning out
+# to many clients, keyed by id(), mapped to their serialized JSON once
+# some client's response has needed it.  Every recipient's event
+# references the same payload dict, so this lets us encode it once and
+# splice it into each response.  Entries are only valid while
+# process_message_event holds a reference to the payload, which is why
+# it clears them when it's done.
+shared_payload_json = {}  # type: Dict[int, Optional[str]]
+
+def share_payload(payload: Dict[str, Any]) -> None:
+    shared_payload_json[id(payload)] = None
+
+def clear_shared_payloads() -> None:
+    shared_payload_json.clear()
+
+def encode_event(event: Dict[str, Any]) -> str:
+    if event['type'] != 'message' or id(event['message']) not in shared_payload_json:
+        return ujson.dumps(event)
+
+    payload_id = id(event['message'])
+    payload_json = shared_payload_json[payload_id]
+    if payload_json is None:
+        payload_json = ujson.dumps(event['message'])
+        shared_payload_json[payload_id] = payload_json
+    # Every event has a 'type', so the rest of the object is nonempty.
+    rest = ujson.dumps({key: value for key, value in event.items() if key != 'message'})
+    return '{"message":%s,%s' % (payload_json, rest[1:])
+
+def encode_events_response(response: Dict[str, Any]) -> Optional[str]:
+    '''
+    Returns the JSON for a get_events response, splicing in any shared
+    message payloads, or None if it has none and json_response should
+    encode it as usual.
+    '''
+    if not shared_payload_json:
+        return None
+    rest = {key: value for key, value in response.items() if key != 'events'}
+    events_json = ','.join(encode_event(event) for event in response['events'])
+    return '{"events":[%s],%s\n' % (events_json, ujson.dumps(rest)[1:])
+
 def finish_handler(handler_id: int, event_queue_id: str,
                    contents: List[Dict[str, Any]], apply_markdown: bool) -> None:
     err_msg = "Got error finishing handler for queue %s" % (event_queue_id,)
@@ -59,10 +100,11 @@ def finish_handler(handler_id: int, event_queue_id: str,
         else:
             request._log_data['extra'] = "[%s/1/%s]" % (event_queue_id, contents[0]["type"])
 
-        handler.zulip_finish(dict(result='success', msg='',
-                                  events=contents,
-                                  queue_id=event_queue_id),
-                             request, apply_markdown=apply_markdown)
+        response = dict(result='success', msg='',
+                        events=contents,
+                        queue_id=event_queue_id)
+        handler.zulip_finish(response, request, apply_markdown=apply_markdown,
+                             content=encode_events_response(response))
     except IOError as e:
         if str(e) != 'Stream is closed':
             logging.exception(err_msg)
@@ -326,7 +368,7 @@ class AsyncDjangoHandlerBase(tornado.web.RequestHandler, base.BaseHandler):  # n
 
 class AsyncDjangoHandler(AsyncDjangoHandlerBase):
     def zulip_finish(self, response: Dict[str, Any], request: HttpRequest,
-                     apply_markdown: bool) -> None:
+                     apply_markdown: bool, content: Optional[str]=None) -> None:
         # Make sure that Markdown rendering really happened, if requested.
         # This is a security issue because it's where we escape HTML.
         # c.f. ticket #64
@@ -345,8 +387,13 @@ class AsyncDjangoHandler(AsyncDjangoHandlerBase):
         # the headers from that since sending those to Tornado seems
         # tricky; instead just send the (already json-rendered)
         # content on to Tornado
-        django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
+        if content is not None:
+            # Already serialized for us by encode_events_response.
+            django_response = HttpResponse(content=content, content_type='application/json',
+                                           status=self.get_status())
+        else:
+            django_response = json_response(res_type=response['result'],
+                                            data=response, status=self.get_status())
         django_response = self.apply_response_middleware(request, django_response,
                                                          request._resolver)
         # Pass through the content-type from Django, as json content should be
@@ -0,0 +1,147 @@
+# On-disk format for persisting Tornado's event queues across restarts.
+#
+# A file is a sequence of records, each a 4-byte big-endian length
+# followed by that many bytes of marshal data.  Event queue contents
+# are just dicts, lists, strings and numbers, which marshal handles
+# much faster than JSON, and the length prefixes let us stream
+# records in one at a time rather than parsing one giant document.
+#
+# We keep two files: a snapshot of every queue, written at shutdown
+# and whenever we compact, and a checkpoint log that we periodically
+# append the queues changed since the last checkpoint to.  Both start
+# with a (SNAPSHOT, snapshot_id) record; the log is only replayed on
+# top of the snapshot it was started for, so a crash in the middle of
+# compaction can never apply a stale log to a newer snapshot.
+import marshal
+import os
+import struct
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+SNAPSHOT = 'snapshot'
+PUT = 'put'
+DELETE = 'delete'
+
+# marshal's format is stable within a version number; pin it so
+# that a Python upgrade doesn't silently change what we write.
+MARSHAL_VERSION = 4
+
+HEADER = struct.Struct('>I')
+
+Record = Tuple[Any, ...]
+
+class TruncatedRecordError(Exception):
+    pass
+
+def write_record(f: BinaryIO, record: Record) -> None:
+    data = marshal.dumps(record, MARSHAL_VERSION)
+    f.write(HEADER.pack(len(data)))
+    f.write(data)
+
+def read_records(f: BinaryIO) -> Iterator[Record]:
+    '''
+    Yields the records in f in order.  A partially written record at
+    the end of the file (e.g. because we crashed while appending to
+    the checkpoint log) raises TruncatedRecordError.
+    '''
+    while True:
+        header = f.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise TruncatedRecordError()
+        (length,) = HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            raise TruncatedRecordError()
+        yield marshal.loads(data)
+
+def write_snapshot(filename: str, snapshot_id: float,
+                   client_dicts: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+    '''Atomically replaces filename with a snapshot of client_dicts.'''
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        write_record(f, (SNAPSHOT, snapshot_id))
+        for queue_id, client_dict in client_dicts:
+            write_record(f, (PUT, queue_id, client_dict))
+    os.rename(tmp_filename, filename)
+
+def open_log(filename: str, snapshot_id: float) -> BinaryIO:
+    '''
+    Opens the checkpoint log for appending, discarding its contents
+    unless it was started for the given snapshot.
+    '''
+    if read_snapshot_id(filename) == snapshot_id:
+        # Drop any partially written record at the end, so that what
+        # we append next can be read back.
+        f = open(filename, 'r+b')
+        valid_length = 0
+        try:
+            for record in read_records(f):
+                valid_length = f.tell()
+        except TruncatedRecordError:
+            pass
+        f.seek(valid_length)
+        f.truncate()
+        return f
+    f = open(filename, 'wb')
+    write_record(f, (SNAPSHOT, snapshot_id))
+    f.flush()
+    return f
+
+def append_to_log(f: BinaryIO, changed: Iterable[Tuple[str, Dict[str, Any]]],
+                  deleted: Iterable[str]) -> None:
+    for queue_id in deleted:
+        write_record(f, (DELETE, queue_id))
+    for queue_id, client_dict in changed:
+        write_record(f, (PUT, queue_id, client_dict))
+    f.flush()
+
+def read_snapshot_id(filename: str) -> Optional[float]:
+    try:
+        with open(filename, 'rb') as f:
+            for record in read_records(f):
+                if record[0] == SNAPSHOT:
+                    return record[1]
+                break
+    except (IOError, TruncatedRecordError):
+        pass
+    return None
+
+def apply_records(records: Iterator[Record],
+                  client_dicts: Dict[str, Dict[str, Any]]) -> None:
+    for record in records:
+        if record[0] == PUT:
+            client_dicts[record[1]] = record[2]
+        elif record[0] == DELETE:
+            client_dicts.pop(record[1], None)
+        else:
+            raise ValueError("Unexpected event queue record type: %s" % (record[0],))
+
+def load_client_dicts(snapshot_filename: str,
+                      log_filename: str) -> Tuple[float, Dict[str, Dict[str, Any]]]:
+    '''
+    Returns the id of the snapshot at snapshot_filename and the
+    client dicts it contains, with the checkpoint log replayed on top.
+    Raises IOError if there is no snapshot.
+    '''
+    client_dicts = {}  # type: Dict[str, Dict[str, Any]]
+    with open(snapshot_filename, 'rb') as f:
+        records = read_records(f)
+        header = next(records)
+        assert header[0] == SNAPSHOT
+        snapshot_id = header[1]
+        apply_records(records, client_dicts)
+
+    try:
+        with open(log_filename, 'rb') as f:
+            records = read_records(f)
+            if next(records, None) == (SNAPSHOT, snapshot_id):
+                apply_records(records, client_dicts)
+    except IOError:
+        pass
+    except TruncatedRecordError:
+        # We crashed while appending the last checkpoint; everything
+        # before it is still good.
+        pass
+
+    return snapshot_id, client_dicts
@@ -0,0 +1,107 @@
+# Support for running several Tornado processes ("shards"), each of
+# which owns the event queues for a hash partition of the users.
+#
+# With settings.TORNADO_PROCESSES = N, shard i listens on the port of
+# settings.TORNADO_SERVER plus i, consumes the notify_tornado queue
+# returned by notify_tornado_queue_name(i), and allocates event queue
+# ids prefixed with "i:" so that nginx can route /json/events requests
+# for an existing queue to the right process.  With the default of a
+# single process, queue names, queue ids and URLs are unchanged.
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Union
+from urllib.parse import urlsplit, urlunsplit
+
+from django.conf import settings
+
+# The shard served by this process; set by runtornado.  Remains 0
+# outside of Tornado and when sharding is disabled.
+current_shard = 0
+
+def sharding_enabled() -> bool:
+    return settings.TORNADO_PROCESSES > 1
+
+def get_user_shard(user_profile_id: int) -> int:
+    return user_profile_id % settings.TORNADO_PROCESSES
+
+def set_current_shard(shard: int) -> None:
+    global current_shard
+    assert(0 <= shard < settings.TORNADO_PROCESSES)
+    current_shard = shard
+
+def get_shard_for_port(port: int) -> Optional[int]:
+    base_port = urlsplit(settings.TORNADO_SERVER).port
+    shard = port - base_port
+    if 0 <= shard < settings.TORNADO_PROCESSES:
+        return shard
+    return None
+
+def get_tornado_uri(shard: int) -> str:
+    if shard == 0:
+        return settings.TORNADO_SERVER
+    parsed = urlsplit(settings.TORNADO_SERVER)
+    netloc = '%s:%d' % (parsed.hostname, parsed.port + shard)
+    return urlunsplit((parsed.scheme, netloc, parsed.path, parsed.query, parsed.fragment))
+
+def get_user_tornado_uri(user_profile_id: int) -> str:
+    return get_tornado_uri(get_user_shard(user_profile_id))
+
+def notify_tornado_queue_name(shard: int) -> str:
+    if not sharding_enabled():
+        return 'notify_tornado'
+    return 'notify_tornado_shard%d' % (shard,)
+
+def tornado_return_queue_name(shard: int) -> str:
+    if not sharding_enabled():
+        return 'tornado_return'
+    return 'tornado_return_shard%d' % (shard,)
+
+def get_tornado_queue_names() -> List[str]:
+    queue_names = []  # type: List[str]
+    for shard in range(settings.TORNADO_PROCESSES):
+        queue_names += [notify_tornado_queue_name(shard), tornado_return_queue_name(shard)]
+    return queue_names
+
+def make_queue_id(queue_number: int) -> str:
+    queue_id = '%s:%s' % (settings.SERVER_GENERATION, queue_number)
+    if sharding_enabled():
+        queue_id = '%d:%s' % (current_shard, queue_id)
+    return queue_id
+
+def get_queue_id_shard(queue_id: str) -> int:
+    '''Queue ids from before sharding was enabled belong to shard 0.'''
+    parts = queue_id.split(':')
+    if len(parts) == 3 and parts[0].isdigit():
+        return int(parts[0])
+    return 0
+
+def event_needs_all_shards(event: Mapping[str, Any]) -> bool:
+    '''
+    Messages to public streams are also delivered to clients with
+    all_public_streams or narrows, which may live on any shard.
+    '''
+    return (event['type'] == 'message' and
+            'stream_name' in event and
+            not event.get('invite_only'))
+
+def partition_users_by_shard(
+        event: Mapping[str, Any],
+        users: Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> Dict[int, List[Any]]:
+    '''
+    Splits the recipients of an event into the users each shard needs
+    to process.  Shards with no recipients are omitted, unless the
+    event might interest clients on every shard.
+    '''
+    if event_needs_all_shards(event):
+        users_by_shard = {
+            shard: []
+            for shard in range(settings.TORNADO_PROCESSES)
+        }  # type: Dict[int, List[Any]]
+    else:
+        users_by_shard = {}
+
+    for user in users:
+        if isinstance(user, int):
+            user_profile_id = user
+        else:
+            user_profile_id = user['id']
+        users_by_shard.setdefault(get_user_shard(user_profile_id), []).append(user)
+    return users_by_shard
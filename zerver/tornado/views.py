@@ -13,19 +13,27 @@ from zerver.decorator import REQ, RespondAsynchronously, \
 from zerver.lib.response import json_error, json_success
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.models import Client, UserProfile, get_client
-from zerver.tornado.event_queue import fetch_events, \
-    get_client_descriptor, process_notification
+from zerver.tornado.event_queue import fetch_events, forward_events_request, \
+    forward_queue_cleanup, get_client_descriptor, process_notification_data
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado import sharding
+from zerver.tornado.sharding import get_queue_id_shard, get_user_shard, sharding_enabled
 
 @internal_notify_view(True)
 def notify(request: HttpRequest) -> HttpResponse:
-    process_notification(ujson.loads(request.POST['data']))
+    process_notification_data(ujson.loads(request.POST['data']))
     return json_success()
 
 @has_request_variables
 def cleanup_event_queue(request: HttpRequest, user_profile: UserProfile,
                         queue_id: str=REQ()) -> HttpResponse:
-    client = get_client_descriptor(str(queue_id))
+    queue_id = str(queue_id)
+    if sharding_enabled() and get_queue_id_shard(queue_id) != sharding.current_shard:
+        forward_queue_cleanup(queue_id, user_profile.id)
+        request._log_data['extra'] = "[%s]" % (queue_id,)
+        return json_success()
+
+    client = get_client_descriptor(queue_id)
     if client is None:
         raise BadEventQueueIdError(queue_id)
     if user_profile.id != client.user_profile_id:
@@ -48,6 +56,12 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile, handler:
                        narrow: Iterable[Sequence[str]]=REQ(default=[], validator=check_list(None)),
                        lifespan_secs: int=REQ(default=0, converter=int)
                        ) -> Union[HttpResponse, _RespondAsynchronously]:
+    if queue_id is None and sharding_enabled() and \
+            get_user_shard(user_profile.id) != sharding.current_shard:
+        handler._request = request
+        forward_events_request(request, user_profile.id, handler.handler_id)
+        return RespondAsynchronously
+
     if user_client is None:
         valid_user_client = request.client
     else:
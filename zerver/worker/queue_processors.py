@@ -1,5 +1,5 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/queuing.html
-from typing import Any, Callable, Dict, List, Mapping, Optional, cast, TypeVar, Type
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, cast, TypeVar, Type
 
 import copy
 import signal
@@ -15,6 +15,7 @@ from django.core.handlers.base import BaseHandler
 from zerver.models import \
     get_client, get_system_bot, ScheduledEmail, PreregistrationUser, \
     get_user_profile_by_id, Message, Realm, Service, UserMessage, UserProfile
+from zerver.lib.cache import expire_local_cache_validation
 from zerver.lib.context_managers import lockfile
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.feedback import handle_feedback
@@ -23,7 +24,7 @@ from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.notifications import handle_missedmessage_emails
 from zerver.lib.push_notifications import handle_push_notification
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activity_many, do_update_user_activity_intervals, do_update_user_presence_many, \
     internal_send_message, check_send_message, extract_recipients, \
     render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
 from zerver.lib.url_preview import preview as url_preview
@@ -39,7 +40,8 @@ from zerver.lib.db import reset_queries
 from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.str_utils import force_str
 from zerver.context_processors import common_context
-from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
+from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler, \
+    request_retry, OutgoingWebhookDispatcher
 from zerver.models import get_bot_services
 from zulip import Client
 from zulip_bots.lib import extract_query_without_mention
@@ -118,6 +120,13 @@ def retry_send_email_failures(
 
 class QueueProcessingWorker:
     queue_name = None  # type: str
+    # Workers with a batch_size above 1 are handed up to that many
+    # events at a time by consume_batch, which saves a round trip to
+    # RabbitMQ (and, for workers that override consume_batch, the
+    # database) per event.  We wait at most batch_max_wait seconds for
+    # a batch to fill.
+    batch_size = 1
+    batch_max_wait = 1.0
 
     def __init__(self) -> None:
         self.q = None  # type: SimpleQueueClient
@@ -127,23 +136,41 @@ class QueueProcessingWorker:
     def consume(self, data: Dict[str, Any]) -> None:
         raise WorkerDeclarationException("No consumer defined!")
 
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        for event in events:
+            self.consume_wrapper(event)
+
     def consume_wrapper(self, data: Dict[str, Any]) -> None:
         try:
             self.consume(data)
         except Exception:
-            self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)  # nocoverage
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = '%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
-            check_and_send_restart_signal()
+            self._handle_consume_exception([data])
+        finally:
+            reset_queries()
+            expire_local_cache_validation()
+
+    def consume_batch_wrapper(self, events: List[Dict[str, Any]]) -> None:
+        try:
+            self.consume_batch(events)
+        except Exception:
+            self._handle_consume_exception(events)
         finally:
             reset_queries()
+            expire_local_cache_validation()
+
+    def _handle_consume_exception(self, events: List[Dict[str, Any]]) -> None:
+        self._log_problem()
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)  # nocoverage
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                for event in events:
+                    line = '%s\t%s\n' % (time.asctime(), ujson.dumps(event))
+                    f.write(line.encode('utf-8'))
+        check_and_send_restart_signal()
 
     def _log_problem(self) -> None:
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
@@ -152,6 +179,10 @@ class QueueProcessingWorker:
         self.q = SimpleQueueClient()
 
     def start(self) -> None:
+        if self.batch_size > 1:
+            self.q.start_json_batch_consuming(self.queue_name, self.consume_batch_wrapper,
+                                              self.batch_size, self.batch_max_wait)
+            return
         self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
         self.q.start_consuming()
 
@@ -238,29 +269,62 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
 
 @assign_queue('user_activity')
 class UserActivityWorker(QueueProcessingWorker):
+    # Activity only needs to be roughly up to date, so we wait a while
+    # for large batches, whose visits we add up before writing them.
+    batch_size = 500
+    batch_max_wait = 5.0
+
     def consume(self, event: Mapping[str, Any]) -> None:
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
+        self.consume_batch([event])
+
+    def consume_batch(self, events: List[Mapping[str, Any]]) -> None:
+        activities = {}  # type: Dict[Tuple[int, int, str], Tuple[int, datetime.datetime]]
+        for event in events:
+            client = get_client(event["client"])
+            log_time = timestamp_to_datetime(event["time"])
+            key = (event["user_profile_id"], client.id, event["query"])
+            if key in activities:
+                count, last_visit = activities[key]
+                activities[key] = (count + 1, max(last_visit, log_time))
+            else:
+                activities[key] = (1, log_time)
+        do_update_user_activity_many(activities)
 
 @assign_queue('user_activity_interval')
 class UserActivityIntervalWorker(QueueProcessingWorker):
+    batch_size = 500
+    batch_max_wait = 5.0
+
     def consume(self, event: Mapping[str, Any]) -> None:
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+        self.consume_batch([event])
+
+    def consume_batch(self, events: List[Mapping[str, Any]]) -> None:
+        log_times = defaultdict(list)  # type: Dict[int, List[datetime.datetime]]
+        for event in events:
+            log_times[event["user_profile_id"]].append(timestamp_to_datetime(event["time"]))
+        do_update_user_activity_intervals(log_times)
 
 @assign_queue('user_presence')
 class UserPresenceWorker(QueueProcessingWorker):
+    # Every open client pings us about once a minute; we write each
+    # batch of pings with a couple of queries, and people only see
+    # them on their next ping anyway, unless someone comes online.
+    batch_size = 500
+    batch_max_wait = 2.0
+
     def consume(self, event: Mapping[str, Any]) -> None:
-        logging.debug("Received presence event: %s" % (event),)
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        status = event["status"]
-        do_update_user_presence(user_profile, client, log_time, status)
+        self.consume_batch([event])
+
+    def consume_batch(self, events: List[Mapping[str, Any]]) -> None:
+        for event in events:
+            logging.debug("Received presence event: %s" % (event),)
+        do_update_user_presence_many([
+            (get_user_profile_by_id(event["user_profile_id"]),
+             get_client(event["client"]),
+             timestamp_to_datetime(event["time"]),
+             event["status"])
+            for event in events
+        ])
 
 @assign_queue('missedmessage_emails', queue_type="loop")
 class MissedMessageWorker(LoopQueueProcessingWorker):
@@ -280,6 +344,8 @@ class MissedMessageWorker(LoopQueueProcessingWorker):
 
 @assign_queue('email_senders')
 class EmailSendingWorker(QueueProcessingWorker):
+    batch_size = 20
+
     @retry_send_email_failures
     def consume(self, event: Dict[str, Any]) -> None:
         # Copy the event, so that we don't pass the `failed_tries'
@@ -440,46 +506,115 @@ class TestWorker(QueueProcessingWorker):
 
 @assign_queue('embed_links')
 class FetchLinksEmbedData(QueueProcessingWorker):
+    batch_size = 20
+
     def consume(self, event: Mapping[str, Any]) -> None:
-        for url in event['urls']:
-            url_preview.get_link_embed_data(url)
+        self.consume_batch([event])
 
-        message = Message.objects.get(id=event['message_id'])
+    def consume_batch(self, events: List[Mapping[str, Any]]) -> None:
+        messages = Message.objects.in_bulk([event['message_id'] for event in events])
         # If the message changed, we will run this task after updating the message
         # in zerver.views.messages.update_message_backend
-        if message.content != event['message_content']:
-            return
-        if message.content is not None:
-            query = UserMessage.objects.filter(
-                message=message.id
-            )
-            message_user_ids = set(query.values_list('user_profile_id', flat=True))
-
-            # Fetch the realm whose settings we're using for rendering
-            realm = Realm.objects.get(id=event['message_realm_id'])
-
-            # If rendering fails, the called code will raise a JsonableError.
-            rendered_content = render_incoming_message(
-                message,
-                message.content,
-                message_user_ids,
-                realm)
-            do_update_embedded_data(
-                message.sender, message, message.content, rendered_content)
+        events = [event for event in events
+                  if event['message_id'] in messages and
+                  messages[event['message_id']].content == event['message_content']]
+
+        # Fetch the previews for all of the messages at once, so that
+        # a link posted in several of them is only fetched once.
+        url_preview.get_link_embed_data_many(
+            url for event in events for url in event['urls'])
+
+        for event in events:
+            message = messages[event['message_id']]
+            if message.content is None:
+                continue
+            try:
+                self.rerender_message(message, event['message_realm_id'])
+            except Exception:
+                logging.exception("Error re-rendering message %s with link previews" % (
+                    message.id,))
+
+    def rerender_message(self, message: Message, message_realm_id: int) -> None:
+        query = UserMessage.objects.filter(
+            message=message.id
+        )
+        message_user_ids = set(query.values_list('user_profile_id', flat=True))
+
+        # Fetch the realm whose settings we're using for rendering
+        realm = Realm.objects.get(id=message_realm_id)
+
+        # If rendering fails, the called code will raise a JsonableError.
+        rendered_content = render_incoming_message(
+            message,
+            message.content,
+            message_user_ids,
+            realm)
+        do_update_embedded_data(
+            message.sender, message, message.content, rendered_content)
 
 @assign_queue('outgoing_webhooks')
 class OutgoingWebhookWorker(QueueProcessingWorker):
+    # We only acknowledge a batch once all of its requests have
+    # finished or been retried; see consume_batch.
+    batch_size = 50
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.dispatcher = None  # type: Optional[OutgoingWebhookDispatcher]
+
+    def setup(self) -> None:
+        super().setup()
+        if settings.OUTGOING_WEBHOOK_THREADS > 0:
+            self.dispatcher = OutgoingWebhookDispatcher(
+                threads=settings.OUTGOING_WEBHOOK_THREADS,
+                requests_per_service=settings.OUTGOING_WEBHOOK_REQUESTS_PER_SERVICE,
+                max_outstanding=settings.OUTGOING_WEBHOOK_THREADS * 8)
+
     def consume(self, event: Mapping[str, Any]) -> None:
         message = event['message']
-        dup_event = cast(Dict[str, Any], event)
-        dup_event['command'] = message['content']
 
         services = get_bot_services(event['user_profile_id'])
         for service in services:
+            # Each service gets its own copy of the event, since requests
+            # may still be running (or be retried) after we return.
+            dup_event = dict(event)
+            dup_event['command'] = message['content']
             dup_event['service_name'] = str(service.name)
             service_handler = get_outgoing_webhook_service_handler(service)
             rest_operation, request_data = service_handler.process_event(dup_event)
-            do_rest_call(rest_operation, request_data, dup_event, service_handler)
+            if self.dispatcher is None:
+                do_rest_call(rest_operation, request_data, dup_event, service_handler)
+            else:
+                self.dispatcher.submit(service.id, do_rest_call, rest_operation,
+                                       request_data, dup_event, service_handler)
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        super().consume_batch(events)
+        if self.dispatcher is None:
+            return
+
+        # Returning acknowledges the batch, so we wait for its
+        # requests to finish; if we're killed first, RabbitMQ delivers
+        # the batch again.  A slow bot mustn't hold up the queue for
+        # everyone, though, so once the batch has taken too long we
+        # send the requests still waiting their turn back to the
+        # queue.  Running requests finish within their own timeout.
+        if self.dispatcher.wait_until_idle(settings.OUTGOING_WEBHOOK_BATCH_TIMEOUT_SECONDS):
+            return
+        for func, args in self.dispatcher.take_waiting():
+            rest_operation, request_data, event, service_handler = args
+            logging.info("Trigger event %s on %s waited too long to start. Retrying" % (
+                event['command'], event['service_name']))
+            request_retry(event, request_data,
+                          'Timed out waiting for earlier requests to the bot.')
+
+    def stop(self) -> None:  # nocoverage
+        if self.dispatcher is not None:
+            # Give the requests in the current batch a chance to finish.
+            if not self.dispatcher.wait_until_idle(settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS):
+                logging.warning("Stopping with outgoing webhook requests still pending; "
+                                "their batch will be delivered again")
+        super().stop()
 
 @assign_queue('embedded_bots')
 class EmbeddedBotWorker(QueueProcessingWorker):
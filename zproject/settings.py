@@ -416,6 +416,30 @@ DEFAULT_SETTINGS.update({
     # value in static/js/presence.js.  Also, probably move it out of
     # DEFAULT_SETTINGS, since it likely isn't usefully user-configurable.
     'OFFLINE_THRESHOLD_SECS': 5 * 60,
+
+    # Number of pre-forked processes each Django and queue worker
+    # process renders markdown in (see zerver/lib/process_pool.py),
+    # which lets us kill renders that time out and render batches of
+    # messages in parallel.  With 0, we render in the calling process.
+    'BUGDOWN_RENDER_PROCESSES': 0 if DEVELOPMENT else 2,
+    # How long a message may take to render before we give up on it.
+    'BUGDOWN_TIMEOUT': 5,
+    # Whether to cache rendered messages that don't depend on who
+    # sends or receives them; see zerver.lib.bugdown.get_render_cache_key.
+    'BUGDOWN_RENDER_CACHE': True,
+
+    # The outgoing_webhooks queue worker makes requests to bots on
+    # this many threads, with at most OUTGOING_WEBHOOK_REQUESTS_PER_SERVICE
+    # of them going to any one bot service, so that a slow bot only
+    # delays its own messages.  With 0, requests are made one at a
+    # time by the worker itself.
+    'OUTGOING_WEBHOOK_THREADS': 16,
+    'OUTGOING_WEBHOOK_REQUESTS_PER_SERVICE': 4,
+    # How long we wait for a bot to respond before retrying.
+    'OUTGOING_WEBHOOK_TIMEOUT_SECONDS': 10,
+    # How long the worker waits for a batch's requests before sending
+    # the ones that haven't started back to the queue.
+    'OUTGOING_WEBHOOK_BATCH_TIMEOUT_SECONDS': 30,
 })
 
 
@@ -551,6 +575,15 @@ ZILENCER_ENABLED = 'zilencer' in INSTALLED_APPS
 # We override the port number when running frontend tests.
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
+# Number of Tornado processes to run.  Each one serves the event
+# queues for a hash partition of the users, and listens on the port of
+# TORNADO_SERVER plus its index; see zerver/tornado/sharding.py.
+# Sockjs connections are not routed by shard, so this requires
+# USE_WEBSOCKETS = False.
+if config_file.has_option('application_server', 'tornado_processes'):
+    TORNADO_PROCESSES = config_file.getint('application_server', 'tornado_processes')
+else:
+    TORNADO_PROCESSES = 1
 AUTORELOAD = DEBUG
 
 SILENCED_SYSTEM_CHECKS = [
@@ -1224,6 +1257,7 @@ ZULIP_PATHS = [
     ("MANAGEMENT_LOG_PATH", "/var/log/zulip/manage.log"),
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("JSON_PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.json"),
+    ("PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.marshal"),
     ("EMAIL_LOG_PATH", "/var/log/zulip/send_email.log"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email_mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
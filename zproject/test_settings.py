@@ -133,6 +133,11 @@ TERMS_OF_SERVICE = 'corporate/terms.md'
 
 INLINE_URL_EMBED_PREVIEW = False
 
+# Render markdown in the test process, and every time, so that tests
+# can mock it.
+BUGDOWN_RENDER_PROCESSES = 0
+BUGDOWN_RENDER_CACHE = False
+
 HOME_NOT_LOGGED_IN = '/login'
 LOGIN_URL = '/accounts/login'
 